@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator
+
+import asyncpg
+
+from bench.run import seed
+from bot.database import Database
+from bot.sql import DIGEST_PENDING, STATEMENTS, statement_name
+
+INDEX_SCANS = frozenset({"Index Only Scan", "Index Scan"})
+# Выборки одного пользователя по PK: bitmap тоже точечный.
+USER_SCANS = INDEX_SCANS | {"Bitmap Heap Scan"}
+# Агрегаты за всё время честно читают всю таблицу — допускаем и seq scan.
+FULL_SCANS = INDEX_SCANS | {"Seq Scan"}
+# Таблицы, к которым относятся проверки типа скана; types и users по PK не проверяем.
+CHECKED_RELATIONS = frozenset({"user_type_daily", "user_histogram", "user_activity", "weekly_digest"})
+
+
+@dataclass(frozen=True, slots=True)
+class PlanCheck:
+    name: str
+    query: str
+    args: tuple[Any, ...]
+    scans: frozenset[str]
+    # Бюджет буферов: доля страниц user_type_daily, но не меньше floor.
+    fraction: float
+    floor: int
+
+
+@dataclass(slots=True)
+class PlanResult:
+    name: str
+    scans: list[str]
+    buffers: int
+    budget: int
+    problems: list[str]
+
+
+def build_checks(user_id: int, week: Any) -> list[PlanCheck]:
+    checks: list[PlanCheck] = []
+    for period, fraction in (("day", 0.02), ("week", 0.05), ("month", 0.15)):
+        for base in ("top_joke", "top_story", "top_time"):
+            name = statement_name(base, period)
+            checks.append(PlanCheck(name, STATEMENTS[name], (5,), INDEX_SCANS, fraction, 50))
+    for base in ("top_joke", "top_story", "top_time"):
+        name = statement_name(base, "all")
+        checks.append(PlanCheck(name, STATEMENTS[name], (5,), FULL_SCANS, 1.2, 50))
+    checks.append(PlanCheck("rating_by_type", STATEMENTS["rating_by_type"], (5,), FULL_SCANS, 1.2, 50))
+    for period in ("day", "week", "month", "all"):
+        name = statement_name("personal_stats", period)
+        checks.append(PlanCheck(name, STATEMENTS[name], (user_id,), USER_SCANS, 0.0, 1000))
+    checks.append(PlanCheck("user_stats_hydrate", STATEMENTS["user_stats_hydrate"], (user_id,), USER_SCANS, 0.0, 1000))
+    checks.append(PlanCheck("weekly_summary", STATEMENTS["weekly_summary"], (user_id,), USER_SCANS, 0.1, 1000))
+    checks.append(PlanCheck("select_histogram", STATEMENTS["select_histogram"], (user_id,), INDEX_SCANS, 0.0, 20))
+    checks.append(PlanCheck("select_activity", STATEMENTS["select_activity"], (user_id,), INDEX_SCANS, 0.0, 20))
+    checks.append(PlanCheck("digest_pending", DIGEST_PENDING, (week, 0, 500), INDEX_SCANS, 0.0, 200))
+    return checks
+
+
+def _nodes(plan: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from _nodes(child)
+
+
+async def explain(conn: asyncpg.Connection, check: PlanCheck, pages: int) -> PlanResult:
+    rows = await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {check.query}", *check.args)
+    plan = (json.loads(rows) if isinstance(rows, str) else rows)[0]["Plan"]
+    problems: list[str] = []
+    scans: list[str] = []
+    for node in _nodes(plan):
+        relation = node.get("Relation Name")
+        if relation not in CHECKED_RELATIONS:
+            continue
+        node_type = node["Node Type"]
+        scans.append(f"{node_type} on {relation}" + (f" using {node['Index Name']}" if "Index Name" in node else ""))
+        if node_type not in check.scans:
+            problems.append(f"{node_type} on {relation}")
+        # Index-only scan, который всё равно ходит в heap, — признак устаревшей карты видимости.
+        if node_type == "Index Only Scan" and node.get("Heap Fetches", 0) > node.get("Actual Rows", 0) // 10:
+            problems.append(f"{node['Heap Fetches']} heap fetches on {relation}")
+    buffers = plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+    budget = max(check.floor, int(pages * check.fraction))
+    if buffers > budget:
+        problems.append(f"{buffers} buffers > budget {budget}")
+    return PlanResult(check.name, scans, buffers, budget, problems)
+
+
+async def run(args: argparse.Namespace) -> list[PlanResult]:
+    rng = random.Random(args.seed)
+    week = datetime.now(timezone.utc).date()
+    if args.seed_events:
+        await seed(
+            args.dsn, users=args.users, events=args.seed_events, days=args.history_days,
+            init_schema=args.init_schema, rng=rng,
+        )
+        database = Database(dsn=args.dsn)
+        await database.connect()
+        try:
+            await database.backfill_rollups()
+            await database.prepare_weekly_digest(week)
+        finally:
+            await database.close()
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        # Как после прохода autovacuum: статистика и карта видимости свежие.
+        await conn.execute("VACUUM (ANALYZE) user_type_daily, user_histogram, user_activity, weekly_digest, users")
+        pages = await conn.fetchval("SELECT relpages FROM pg_class WHERE relname = 'user_type_daily'")
+        user_id = args.user_id or await conn.fetchval(
+            "SELECT user_id FROM user_type_daily GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+        )
+        return [await explain(conn, check, pages) for check in build_checks(user_id, week)]
+    finally:
+        await conn.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Проверка планов запросов бота на синтетических данных")
+    parser.add_argument("--dsn", required=True, help="отдельная БД: при засеве таблицы очищаются")
+    parser.add_argument("--init-schema", action="store_true", help="применить db/init/init.sql перед засевом")
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--seed-events", type=int, default=0, help="сколько событий засеять (0 — проверить текущие данные)")
+    parser.add_argument("--history-days", type=int, default=365)
+    parser.add_argument("--user-id", type=int, default=None, help="чью статистику проверять (по умолчанию самого активного)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, default=None, help="куда сохранить JSON с результатами")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    results = asyncio.run(run(args))
+    failed = [result for result in results if result.problems]
+    for result in results:
+        status = "FAIL" if result.problems else "ok"
+        print(f"{status:4} {result.name:24} {result.buffers:>8}/{result.budget:<8} {'; '.join(result.scans)}")
+        for problem in result.problems:
+            print(f"     - {problem}")
+    if args.output is not None:
+        report = [
+            {"name": r.name, "scans": r.scans, "buffers": r.buffers, "budget": r.budget, "problems": r.problems}
+            for r in results
+        ]
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    if failed:
+        print(f"{len(failed)} of {len(results)} plans regressed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
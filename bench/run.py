@@ -0,0 +1,378 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncGenerator
+
+import asyncpg
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe, SendMessage, TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+
+from bot.database import Database
+from bot.handlers import register_handlers
+from bot.keyboards import JOKE_BUTTON, STORY_BUTTON, TOP_BUTTON
+from bot.outbox import Outbox
+from bot.storage import ImportedEvent, Storage
+
+INIT_SQL = Path(__file__).resolve().parent.parent / "db" / "init" / "init.sql"
+BOT_ID = 1_000_000_000
+
+_queries: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar("bench_queries", default=None)
+
+
+class RecordingSession(BaseSession):
+    # Вместо Telegram: считает исходящие вызовы и отвечает правдоподобными объектами.
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: dict[str, Any] | None = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        # Скачивание файлов: учитываем вызов и отдаём пустой файл.
+        self.calls["stream_content"] += 1
+        yield b""
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: int | None = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, GetMe):
+            return User(id=BOT_ID, is_bot=True, first_name="bench", username="bench_bot")
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(timezone.utc),
+                chat=Chat(id=int(method.chat_id), type="private"),
+                text=method.text,
+            )
+        return True
+
+
+def _count_queries() -> None:
+    def wrap(owner: type, name: str) -> None:
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        async def counted(self: Any, *args: Any, **kwargs: Any) -> Any:
+            counter = _queries.get()
+            if counter is not None:
+                counter[0] += 1
+            return await original(self, *args, **kwargs)
+
+        setattr(owner, name, counted)
+
+    for name in ("execute", "executemany", "fetch", "fetchrow", "fetchval", "copy_records_to_table"):
+        wrap(asyncpg.Connection, name)
+
+    # Сброс соединения при возврате в пул — запрос asyncpg, а не бота.
+    reset = asyncpg.Connection.reset
+
+    @functools.wraps(reset)
+    async def uncounted_reset(self: Any, *args: Any, **kwargs: Any) -> Any:
+        token = _queries.set(None)
+        try:
+            return await reset(self, *args, **kwargs)
+        finally:
+            _queries.reset(token)
+
+    setattr(asyncpg.Connection, "reset", uncounted_reset)
+
+
+class Traffic:
+    def __init__(self, bot: Bot) -> None:
+        self._bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> Update:
+        return self._update({"message": self._message_payload(user_id, text)})
+
+    def rating(self, user_id: int, value: int) -> Update:
+        return self._update(
+            {
+                "callback_query": {
+                    "id": str(next(self._update_ids)),
+                    "from": self._user(user_id),
+                    "chat_instance": str(user_id),
+                    "data": f"rating:{value}",
+                    "message": self._message_payload(BOT_ID, "Оценка? Жми звёзды.", chat_id=user_id),
+                }
+            }
+        )
+
+    def _update(self, payload: dict[str, Any]) -> Update:
+        return Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self._bot})
+
+    def _message_payload(self, user_id: int, text: str, chat_id: int | None = None) -> dict[str, Any]:
+        payload: dict[str, Any] = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id or user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            payload["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return payload
+
+    @staticmethod
+    def _user(user_id: int) -> dict[str, Any]:
+        return {"id": user_id, "is_bot": user_id == BOT_ID, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def _scenario(traffic: Traffic, user_id: int, rng: random.Random) -> list[tuple[str, Update]]:
+    minutes = rng.randint(1, 30)
+    rating = rng.randint(1, 5)
+    kind = rng.choices(
+        ["joke", "story", "flow", "me", "top", "top_button"],
+        weights=[25, 15, 20, 20, 10, 10],
+    )[0]
+    if kind in ("joke", "story"):
+        return [("cmd_add_event", traffic.message(user_id, f"/{kind} {minutes} {rating}"))]
+    if kind == "flow":
+        button = rng.choice([JOKE_BUTTON, STORY_BUTTON])
+        return [
+            ("choose_type", traffic.message(user_id, button)),
+            ("process_minutes", traffic.message(user_id, str(minutes))),
+            ("process_rating", traffic.rating(user_id, rating)),
+        ]
+    if kind == "me":
+        period = rng.choice(["day", "week", "month", "all"])
+        return [("cmd_me", traffic.message(user_id, f"/me {period}"))]
+    if kind == "top":
+        period = rng.choice(["day", "week", "month", "all"])
+        return [("cmd_top", traffic.message(user_id, f"/top {period} 1"))]
+    return [("btn_top", traffic.message(user_id, TOP_BUTTON))]
+
+
+async def seed(dsn: str, *, users: int, events: int, days: int, init_schema: bool, rng: random.Random) -> None:
+    conn = await asyncpg.connect(dsn)
+    try:
+        if init_schema:
+            await conn.execute(INIT_SQL.read_text(encoding="utf-8"))
+        now = datetime.now(timezone.utc)
+        await conn.execute(
+            "SELECT ensure_events_partitions($1, $2)", (now - timedelta(days=days)).date(), (now + timedelta(days=31)).date()
+        )
+        await conn.execute("TRUNCATE events, user_type_daily, user_histogram, user_histogram_archive, user_activity, weekly_digest, users")
+        type_ids = [row["id"] for row in await conn.fetch("SELECT id FROM types ORDER BY id")]
+        await conn.copy_records_to_table(
+            "users",
+            records=[(user_id, f"user{user_id}", f"user{user_id}") for user_id in range(1, users + 1)],
+            columns=("id", "username", "first_name"),
+        )
+        span = days * 86400
+        batch: list[tuple[Any, ...]] = []
+        for _ in range(events):
+            happened_at = now - timedelta(seconds=rng.randrange(span))
+            batch.append((rng.choice(type_ids), rng.randint(1, users), rng.randint(1, 60), rng.randint(1, 5), happened_at))
+            if len(batch) >= 50_000:
+                await _copy_events(conn, batch)
+                batch.clear()
+        if batch:
+            await _copy_events(conn, batch)
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+
+
+async def seed_columnar(storage: Storage, *, users: int, events: int, days: int, rng: random.Random) -> None:
+    now = datetime.now(timezone.utc)
+    span = days * 86400
+    batch: list[ImportedEvent] = []
+    for _ in range(events):
+        user_id = rng.randint(1, users)
+        batch.append(
+            ImportedEvent(
+                user_id=user_id,
+                username=f"user{user_id}",
+                first_name=f"user{user_id}",
+                type_code=rng.choice(["joke", "story"]),
+                spent_minutes=rng.randint(1, 60),
+                rating=rng.randint(1, 5),
+                happened_at=now - timedelta(seconds=rng.randrange(span)),
+            )
+        )
+        if len(batch) >= 50_000:
+            await storage.bulk_import(batch)
+            batch.clear()
+    if batch:
+        await storage.bulk_import(batch)
+
+
+async def _copy_events(conn: asyncpg.Connection, records: list[tuple[Any, ...]]) -> None:
+    await conn.copy_records_to_table(
+        "events",
+        records=records,
+        columns=("type_id", "user_id", "spent_minutes", "rating", "happened_at"),
+    )
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def _open_storage(args: argparse.Namespace, rng: random.Random) -> Storage:
+    if args.storage == "columnar":
+        from bot.columnar import ColumnarStorage
+
+        # Без файла: каждый прогон начинается с чистых колонок.
+        columnar = ColumnarStorage()
+        await columnar.connect()
+        await seed_columnar(columnar, users=args.users, events=args.seed_events, days=args.history_days, rng=rng)
+        return columnar
+
+    if args.dsn is None:
+        raise SystemExit("--dsn is required for --storage postgres")
+    if args.seed_events or args.init_schema:
+        await seed(
+            args.dsn, users=args.users, events=args.seed_events, days=args.history_days,
+            init_schema=args.init_schema, rng=rng,
+        )
+    if args.seed_events:
+        maintenance = Database(dsn=args.dsn)
+        await maintenance.connect()
+        try:
+            await maintenance.backfill_rollups()
+        finally:
+            await maintenance.close()
+
+    database = Database(dsn=args.dsn, leaderboard=args.leaderboard, batch_max_rows=args.batch_size)
+    await database.connect()
+    return database
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    _count_queries()
+    session = RecordingSession()
+    bot = Bot(token="42:BENCH", session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    dp = Dispatcher()
+    database = await _open_storage(args, rng)
+    # Без лимитов: меряем хендлеры и БД, а не троттлинг исходящих сообщений.
+    outbox = Outbox(bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9, max_in_flight=args.concurrency)
+    outbox.start()
+    register_handlers(dp, database, outbox)
+
+    traffic = Traffic(bot)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    queries: dict[str, list[int]] = defaultdict(list)
+    errors: Counter[str] = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(label: str, update: Update) -> None:
+        counter = [0]
+        token = _queries.set(counter)
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as err:
+            errors[f"{label}: {type(err).__name__}"] += 1
+        finally:
+            latencies[label].append((time.perf_counter() - started) * 1000)
+            queries[label].append(counter[0])
+            _queries.reset(token)
+
+    async def simulate(user_id: int, user_rng: random.Random) -> None:
+        async with semaphore:
+            for label, update in _scenario(traffic, user_id, user_rng):
+                await feed(label, update)
+
+    user_ids = [rng.randint(1, args.users) for _ in range(args.sessions)]
+    # Сессии одного пользователя не должны пересекаться, иначе FSM-поток перепутается.
+    by_user: dict[int, int] = Counter(user_ids)
+
+    async def simulate_user(user_id: int, count: int) -> None:
+        user_rng = random.Random(rng.random())
+        for _ in range(count):
+            await simulate(user_id, user_rng)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(simulate_user(user_id, count) for user_id, count in by_user.items()))
+    finally:
+        duration = time.perf_counter() - started
+        await outbox.close()
+        await database.close()
+        await bot.session.close()
+
+    total_updates = sum(len(values) for values in latencies.values())
+    total_queries = sum(sum(values) for values in queries.values())
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            key: value for key, value in vars(args).items() if key not in {"dsn", "output"}
+        },
+        "duration_s": round(duration, 3),
+        "updates": total_updates,
+        "throughput_ups": round(total_updates / duration, 2) if duration else 0.0,
+        "queries_per_update": round(total_queries / total_updates, 3) if total_updates else 0.0,
+        "telegram_calls": dict(session.calls),
+        "errors": dict(errors),
+        "handlers": {
+            label: {
+                "count": len(values),
+                "p50_ms": round(_percentile(values, 50), 3),
+                "p95_ms": round(_percentile(values, 95), 3),
+                "p99_ms": round(_percentile(values, 99), 3),
+                "queries_per_update": round(sum(queries[label]) / len(values), 3),
+            }
+            for label, values in sorted(latencies.items())
+        },
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон хендлеров бота на локальном Postgres")
+    parser.add_argument("--storage", choices=["postgres", "columnar"], default="postgres",
+                        help="columnar — колонки в памяти, Postgres не нужен")
+    parser.add_argument("--dsn", default=None, help="отдельная БД для бенчмарка: при засеве таблицы очищаются")
+    parser.add_argument("--init-schema", action="store_true", help="применить db/init/init.sql перед прогоном")
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--seed-events", type=int, default=0, help="сколько исторических событий засеять (0 — не засевать)")
+    parser.add_argument("--history-days", type=int, default=90)
+    parser.add_argument("--sessions", type=int, default=10_000, help="сколько пользовательских сценариев проиграть")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=0, help="EVENT_BATCH_SIZE для Database")
+    parser.add_argument("--leaderboard", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, default=None, help="куда сохранить JSON с результатами")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output is not None:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.fsm.storage.base import BaseStorage
+
+from .config import settings
+from .database import Database
+from .digest import WeeklyDigest
+from .fsm import BoundedMemoryStorage, PostgresStorage
+from .outbox import Outbox
+from .storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def build_bot() -> Bot:
+    return Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
+
+
+def build_storage(*, shared: bool = False) -> BaseStorage:
+    if shared or settings.fsm_storage == "postgres":
+        return PostgresStorage(database_url(), ttl=settings.fsm_ttl)
+    return BoundedMemoryStorage(ttl=settings.fsm_ttl, max_entries=settings.fsm_max_entries)
+
+
+def database_url() -> str:
+    if not settings.database_url:
+        raise RuntimeError("DATABASE_URL is required")
+    return settings.database_url
+
+
+def build_database(*, leaderboard: bool | None = None, shard: int | None = None) -> Storage:
+    if settings.storage == "columnar":
+        # numpy нужен только этому бэкенду: requirements-columnar.txt.
+        from .columnar import ColumnarStorage
+
+        return ColumnarStorage(settings.columnar_path)
+    snapshot_path = settings.cache_snapshot_path
+    if snapshot_path and shard is not None:
+        snapshot_path = f"{snapshot_path}.{shard}"
+    return Database(
+        dsn=database_url(),
+        user_cache_size=settings.user_cache_size,
+        user_cache_ttl=settings.user_cache_ttl,
+        batch_max_rows=settings.event_batch_size,
+        batch_max_delay_ms=settings.event_batch_delay_ms,
+        leaderboard=settings.leaderboard_in_memory if leaderboard is None else leaderboard,
+        top_cache_ttl=settings.top_cache_ttl,
+        slow_query_ms=settings.slow_query_ms,
+        read_dsn=settings.database_read_url,
+        read_your_writes_window=settings.read_your_writes_window,
+        pool_min_size=settings.db_pool_min_size,
+        pool_max_size=settings.db_pool_max_size,
+        pool_max_idle=settings.db_pool_max_idle,
+        acquire_timeout=settings.db_acquire_timeout,
+        read_acquire_timeout=(
+            settings.db_read_acquire_timeout
+            if settings.db_read_acquire_timeout is not None
+            else settings.db_acquire_timeout
+        ),
+        shed_queue_depth=settings.db_shed_queue_depth,
+        write_timeout_ms=settings.db_write_timeout_ms,
+        read_timeout_ms=settings.db_read_timeout_ms,
+        user_stats_cache_size=settings.user_stats_cache_size,
+        user_stats_ttl=settings.user_stats_ttl,
+        summary_deadline_ms=settings.summary_deadline_ms,
+        top_deadline_ms=settings.top_deadline_ms,
+        warmup=settings.db_warmup,
+        cache_snapshot_path=snapshot_path or None,
+        partition_check_interval=settings.partition_check_interval,
+        leaderboard_refresh_interval=settings.leaderboard_refresh_interval,
+    )
+
+
+def build_outbox(bot: Bot, *, share: int = 1) -> Outbox:
+    # Глобальный лимит бота делится между процессами-воркерами.
+    return Outbox(
+        bot,
+        global_rate=settings.outbox_global_rate / share,
+        chat_rate=settings.outbox_chat_rate,
+        chat_burst=settings.outbox_chat_burst,
+    )
+
+
+def build_digest(database: Storage, outbox: Outbox) -> WeeklyDigest:
+    if not isinstance(database, Database):
+        raise RuntimeError("Weekly digest requires STORAGE=postgres")
+    return WeeklyDigest(
+        database,
+        outbox,
+        weekday=settings.digest_weekday,
+        hour=settings.digest_hour,
+        chunk_size=settings.digest_chunk_size,
+    )
+
+
+def log_startup(started: float, database: Storage, *, name: str = "bot") -> None:
+    total = time.perf_counter() - started
+    phases = dict(database.startup_timings) if isinstance(database, Database) else {}
+    phases["other"] = max(0.0, total - sum(phases.values()))
+    breakdown = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in phases.items())
+    logger.info("%s started in %.0f ms (%s)", name, total * 1000, breakdown)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import csv
+import json
+from datetime import datetime, timezone
+from typing import IO, Any, AsyncIterator, Iterator, Mapping
+
+from .database import Database, ImportedEvent
+
+EVENT_FIELDS = ("user_id", "username", "first_name", "type", "spent_minutes", "rating", "happened_at")
+USER_STATS_FIELDS = ("user_id", "username", "first_name", "type", "total_events", "total_minutes", "avg_rating")
+
+
+def read_rows(stream: IO[str], fmt: str) -> Iterator[Mapping[str, Any]]:
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def parse_event(row: Mapping[str, Any]) -> ImportedEvent:
+    happened_at = row["happened_at"]
+    if not isinstance(happened_at, datetime):
+        happened_at = datetime.fromisoformat(str(happened_at))
+    if happened_at.tzinfo is None:
+        happened_at = happened_at.replace(tzinfo=timezone.utc)
+    user_id = int(row["user_id"])
+    return ImportedEvent(
+        user_id=user_id,
+        username=row.get("username") or None,
+        first_name=row.get("first_name") or f"user{user_id}",
+        type_code=str(row["type"]),
+        spent_minutes=int(row["spent_minutes"]),
+        rating=int(row["rating"]),
+        happened_at=happened_at,
+    )
+
+
+async def import_events(database: Database, stream: IO[str], fmt: str, *, chunk_size: int = 50_000) -> int:
+    total = 0
+    chunk: list[ImportedEvent] = []
+    for line_number, row in enumerate(read_rows(stream, fmt), start=1):
+        try:
+            chunk.append(parse_event(row))
+        except (KeyError, TypeError, ValueError) as err:
+            raise ValueError(f"Bad row {line_number}: {err}") from err
+        if len(chunk) >= chunk_size:
+            total += await database.bulk_import(chunk)
+            chunk = []
+    if chunk:
+        total += await database.bulk_import(chunk)
+    return total
+
+
+async def write_rows(rows: AsyncIterator[Mapping[str, Any]], stream: IO[str], fmt: str, fields: tuple[str, ...]) -> int:
+    count = 0
+    writer = csv.DictWriter(stream, fieldnames=fields) if fmt == "csv" else None
+    if writer is not None:
+        writer.writeheader()
+    async for row in rows:
+        record = {field: _plain(row[field]) for field in fields}
+        if writer is not None:
+            writer.writerow(record)
+        else:
+            stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is not None and not isinstance(value, (int, float, str)):
+        return str(value)
+    return value
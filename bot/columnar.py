@@ -0,0 +1,383 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import IO, Any, Mapping, Sequence
+
+import numpy as np
+
+from .leaderboard import PERIOD_DAYS
+from .metrics import timed_method
+from .sql import HIST_DOW, HIST_HOUR, HIST_MINUTES, HIST_RATING, MINUTES_BUCKETS
+from .storage import ImportedEvent, PersonalDetails, User, WeeklySummary
+
+logger = logging.getLogger(__name__)
+
+# Порядок задаёт номер типа в колонке и совпадает с ORDER BY t.code в SQL.
+TYPE_CODES = ("joke", "story")
+_TYPE_INDEX = {code: index for index, code in enumerate(TYPE_CODES)}
+_COLUMNS: dict[str, Any] = {
+    "type": np.int8,
+    "user": np.int64,
+    "minutes": np.int32,
+    "rating": np.int8,
+    "ts": np.int64,
+}
+_DAY = 86400
+_EPOCH = date(1970, 1, 1)
+_TOP_SIZE = 10
+_SNAPSHOT = "snapshot.npz"
+
+
+class _Columns:
+    # Колонки с запасом ёмкости: добавление амортизированно O(1), чтение — срезы без копий.
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.size = 0
+        self._data = {name: np.empty(capacity, dtype) for name, dtype in _COLUMNS.items()}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._data[name][: self.size]
+
+    def append(self, rows: Mapping[str, Any]) -> None:
+        count = len(rows["ts"])
+        needed = self.size + count
+        capacity = len(self._data["ts"])
+        if needed > capacity:
+            capacity = max(needed, capacity * 2)
+            for name, column in self._data.items():
+                grown = np.empty(capacity, column.dtype)
+                grown[: self.size] = column[: self.size]
+                self._data[name] = grown
+        for name, column in self._data.items():
+            column[self.size : needed] = rows[name]
+        self.size = needed
+
+    def copy(self) -> dict[str, np.ndarray]:
+        return {name: self[name].copy() for name in self._data}
+
+
+class ColumnarStorage:
+    # События в памяти процесса колонками numpy, агрегаты — векторно по маскам.
+    # Для одного процесса без Postgres; с path переживает рестарт: снимок +
+    # журнал дописываемых строк, который сворачивается в новый снимок.
+
+    def __init__(self, path: str | Path | None = None, *, snapshot_every: int = 10_000) -> None:
+        self._path = Path(path) if path is not None else None
+        self._snapshot_every = snapshot_every
+        self._columns = _Columns()
+        self._users: dict[int, User] = {}
+        # Поколение снимка; журнал поколения n дописывается после снимка n.
+        self._generation = 0
+        self._log: IO[str] | None = None
+        self._logged = 0
+        self._snapshot_task: asyncio.Task[None] | None = None
+        self._snapshot_lock = asyncio.Lock()
+
+    async def connect(self) -> None:
+        if self._path is None or self._log is not None:
+            return
+        self._path.mkdir(parents=True, exist_ok=True)
+        replayed = await asyncio.to_thread(self._restore)
+        self._log = self._open_log(self._generation)
+        if replayed:
+            # Журнал мог оборваться на середине строки — дописывать после неё нельзя.
+            await self._snapshot()
+
+    async def close(self) -> None:
+        if self._snapshot_task is not None:
+            await asyncio.gather(self._snapshot_task, return_exceptions=True)
+        if self._log is not None:
+            if self._logged:
+                await self._snapshot()
+            self._log.close()
+            self._log = None
+
+    @timed_method
+    async def get_or_create_user(self, telegram_id: int, username: str | None, first_name: str) -> User:
+        user = self._users.get(telegram_id)
+        if user is not None and user.username == username and user.first_name == first_name:
+            return user
+        joined_at = user.joined_at if user is not None else datetime.now(timezone.utc)
+        user = User(id=telegram_id, username=username, first_name=first_name, joined_at=joined_at)
+        self._users[telegram_id] = user
+        self._append_log({"u": _user_row(user)})
+        return user
+
+    @timed_method
+    async def insert_event(self, user_id: int, type_code: str, spent_minutes: int, rating: int) -> None:
+        type_index = _TYPE_INDEX.get(type_code)
+        if type_index is None:
+            raise ValueError(f"Unknown type_code: {type_code}")
+        ts = int(time.time())
+        self._columns.append(
+            {"type": [type_index], "user": [user_id], "minutes": [spent_minutes], "rating": [rating], "ts": [ts]}
+        )
+        self._append_log({"e": [type_code, user_id, spent_minutes, rating, ts]})
+
+    @timed_method
+    async def bulk_import(self, events: Sequence[ImportedEvent]) -> int:
+        if not events:
+            return 0
+        unknown = {event.type_code for event in events} - _TYPE_INDEX.keys()
+        if unknown:
+            raise ValueError(f"Unknown type_code: {', '.join(sorted(unknown))}")
+        now = datetime.now(timezone.utc)
+        for event in events:
+            if event.user_id not in self._users:
+                self._users[event.user_id] = User(event.user_id, event.username, event.first_name, now)
+        self._columns.append(
+            {
+                "type": [_TYPE_INDEX[event.type_code] for event in events],
+                "user": [event.user_id for event in events],
+                "minutes": [event.spent_minutes for event in events],
+                "rating": [event.rating for event in events],
+                "ts": [int(event.happened_at.timestamp()) for event in events],
+            }
+        )
+        # Импорт не гоняем через журнал строка за строкой — сразу в снимок.
+        if self._log is not None:
+            await self._snapshot()
+        return len(events)
+
+    @timed_method
+    async def personal_stats(self, user_id: int, period: str) -> Sequence[Mapping[str, Any]]:
+        mask = self._since(_period_days(period)) & (self._columns["user"] == user_id)
+        return self._personal_rows(mask)
+
+    @timed_method
+    async def personal_details(self, user_id: int) -> PersonalDetails:
+        mask = self._columns["user"] == user_id
+        minutes = self._columns["minutes"][mask]
+        ts = self._columns["ts"][mask]
+        if not len(ts):
+            return PersonalDetails(histogram=[], activity=None)
+        days = ts // _DAY
+        histogram: list[dict[str, Any]] = []
+        for dim, buckets in (
+            (HIST_RATING, self._columns["rating"][mask].astype(np.int64)),
+            (HIST_MINUTES, np.searchsorted(MINUTES_BUCKETS, minutes, side="right")),
+            # 1970-01-01 — четверг; 0 — воскресенье, как isoweekday() % 7.
+            (HIST_DOW, (days + 4) % 7),
+            (HIST_HOUR, ts % _DAY // 3600),
+        ):
+            events = np.bincount(buckets)
+            spent = np.bincount(buckets, weights=minutes)
+            histogram.extend(
+                {"dim": dim, "bucket": int(bucket), "events": int(events[bucket]), "minutes": int(spent[bucket])}
+                for bucket in np.flatnonzero(events)
+            )
+        active = np.unique(days)
+        # Серии — участки подряд идущих дней.
+        breaks = np.flatnonzero(np.diff(active) != 1)
+        lengths = np.diff(np.concatenate(([-1], breaks, [len(active) - 1])))
+        activity = {
+            "last_day": _EPOCH + timedelta(days=int(active[-1])),
+            "current_streak": int(lengths[-1]),
+            "best_streak": int(lengths.max()),
+            "active_days": len(active),
+        }
+        return PersonalDetails(histogram=histogram, activity=activity)
+
+    @timed_method
+    async def global_top(self, period: str, min_records: int = 5) -> dict[str, Sequence[Any]]:
+        user_ids, counts, minutes = self._per_user(self._since(_period_days(period)))
+        events = counts.sum(axis=0)
+        tops: dict[str, Sequence[Any]] = {
+            "joke_count": self._top(user_ids, counts[_TYPE_INDEX["joke"]], "total", min_records),
+            "story_count": self._top(user_ids, counts[_TYPE_INDEX["story"]], "total", min_records),
+            "time": self._top(user_ids, minutes, "total_minutes", min_records, eligible=events >= min_records),
+        }
+        # Средняя оценка по типам — за всё время, как RATING_BY_TYPE.
+        types = self._columns["type"]
+        cnt = np.bincount(types, minlength=len(TYPE_CODES))
+        rating_sum = np.bincount(types, weights=self._columns["rating"], minlength=len(TYPE_CODES))
+        tops["rating_by_type"] = [
+            {"code": code, "avg_rating": round(float(rating_sum[index] / cnt[index]), 2), "cnt": int(cnt[index])}
+            for index, code in enumerate(TYPE_CODES)
+            if cnt[index] and cnt[index] >= min_records
+        ]
+        return tops
+
+    @timed_method
+    async def weekly_summary(self, user_id: int) -> WeeklySummary:
+        window = self._since(PERIOD_DAYS["week"])
+        user_ids, counts, minutes = self._per_user(window)
+        position = int(np.searchsorted(user_ids, user_id))
+        if position == len(user_ids) or user_ids[position] != user_id:
+            return WeeklySummary(records=[], ranks={"joke_rank": None, "story_rank": None, "time_rank": None})
+        # Место — 1 + число пользователей строго впереди, как в WEEKLY_SUMMARY.
+        ranks: dict[str, int | None] = {}
+        for key, code in (("joke_rank", "joke"), ("story_rank", "story")):
+            row = counts[_TYPE_INDEX[code]]
+            mine = row[position]
+            ranks[key] = 1 + int((row > mine).sum()) if mine > 0 else None
+        ranks["time_rank"] = 1 + int((minutes > minutes[position]).sum())
+        records = self._personal_rows(window & (self._columns["user"] == user_id))
+        return WeeklySummary(records=records, ranks=ranks)
+
+    def _since(self, days: int | None) -> np.ndarray:
+        ts = self._columns["ts"]
+        if days is None:
+            return np.ones(len(ts), dtype=bool)
+        # Окно от начала суток (UTC), как _since в SQL.
+        return ts >= (int(time.time()) // _DAY - (days - 1)) * _DAY
+
+    def _personal_rows(self, mask: np.ndarray) -> list[dict[str, Any]]:
+        types = self._columns["type"][mask]
+        events = np.bincount(types, minlength=len(TYPE_CODES))
+        minutes = np.bincount(types, weights=self._columns["minutes"][mask], minlength=len(TYPE_CODES))
+        rating_sum = np.bincount(types, weights=self._columns["rating"][mask], minlength=len(TYPE_CODES))
+        return [
+            {
+                "code": code,
+                "total_events": int(events[index]),
+                "total_minutes": int(minutes[index]),
+                "avg_rating": round(float(rating_sum[index] / events[index]), 2),
+            }
+            for index, code in enumerate(TYPE_CODES)
+            if events[index]
+        ]
+
+    def _per_user(self, mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (id по возрастанию, события [тип, пользователь], минуты по пользователю)
+        user_ids, inverse = np.unique(self._columns["user"][mask], return_inverse=True)
+        types = self._columns["type"][mask].astype(np.int64)
+        size = len(user_ids)
+        counts = np.bincount(types * size + inverse, minlength=len(TYPE_CODES) * size).reshape(len(TYPE_CODES), size)
+        minutes = np.bincount(inverse, weights=self._columns["minutes"][mask], minlength=size).astype(np.int64)
+        return user_ids, counts, minutes
+
+    def _top(
+        self,
+        user_ids: np.ndarray,
+        scores: np.ndarray,
+        key: str,
+        min_records: int,
+        *,
+        eligible: np.ndarray | None = None,
+    ) -> list[dict[str, Any]]:
+        if eligible is None:
+            eligible = (scores > 0) & (scores >= min_records)
+        candidates = np.flatnonzero(eligible)
+        # argpartition: десятка без полной сортировки всех пользователей.
+        if len(candidates) > _TOP_SIZE:
+            candidates = candidates[np.argpartition(-scores[candidates], _TOP_SIZE - 1)[:_TOP_SIZE]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        rows: list[dict[str, Any]] = []
+        for index in candidates:
+            user = self._users.get(int(user_ids[index]))
+            if user is not None:
+                rows.append({"display_name": user.username or user.first_name, key: int(scores[index])})
+        return rows
+
+    def _append_log(self, entry: dict[str, Any]) -> None:
+        if self._log is None:
+            return
+        self._log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._log.flush()
+        self._logged += 1
+        if self._logged >= self._snapshot_every and self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self._snapshot())
+            self._snapshot_task.add_done_callback(self._snapshot_done)
+
+    def _snapshot_done(self, task: asyncio.Task[None]) -> None:
+        self._snapshot_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Columnar snapshot failed", exc_info=task.exception())
+
+    async def _snapshot(self) -> None:
+        async with self._snapshot_lock:
+            assert self._path is not None and self._log is not None
+            # Копия и новый журнал — на цикле событий; всё, что придёт во время
+            # записи, попадёт в журнал следующего поколения.
+            previous = self._generation
+            self._generation += 1
+            arrays = self._columns.copy()
+            users = json.dumps([_user_row(user) for user in self._users.values()], ensure_ascii=False)
+            self._log.close()
+            self._log = self._open_log(self._generation)
+            self._logged = 0
+            await asyncio.to_thread(self._write_snapshot, arrays, users, self._generation)
+            self._log_path(previous).unlink(missing_ok=True)
+
+    def _write_snapshot(self, arrays: dict[str, np.ndarray], users: str, generation: int) -> None:
+        assert self._path is not None
+        target = self._path / _SNAPSHOT
+        tmp = target.with_name(target.name + ".tmp")
+        with open(tmp, "wb") as fh:
+            np.savez(fh, generation=np.int64(generation), users=np.array(users), **arrays)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, target)
+
+    def _restore(self) -> int:
+        assert self._path is not None
+        snapshot = self._path / _SNAPSHOT
+        if snapshot.exists():
+            with np.load(snapshot) as data:
+                self._generation = int(data["generation"])
+                self._columns.append({name: data[name] for name in _COLUMNS})
+                for row in json.loads(str(data["users"])):
+                    user = _parse_user(row)
+                    self._users[user.id] = user
+        for stale in self._path.glob("append.*.log"):
+            if int(stale.stem.split(".")[1]) < self._generation:
+                stale.unlink()
+        # Снимок мог не записаться — тогда журналы следующих поколений тоже наши.
+        replayed = 0
+        generation = self._generation
+        while self._log_path(generation).exists():
+            replayed += self._replay(self._log_path(generation))
+            generation += 1
+        self._generation = max(self._generation, generation - 1)
+        return replayed
+
+    def _replay(self, path: Path) -> int:
+        count = 0
+        with open(path, encoding="utf-8") as fh:
+            for line_number, line in enumerate(fh, start=1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    count += 1
+                    logger.warning("Columnar log %s is truncated at line %s", path.name, line_number)
+                    break
+                if "u" in entry:
+                    user = _parse_user(entry["u"])
+                    self._users[user.id] = user
+                else:
+                    type_code, user_id, minutes, rating, ts = entry["e"]
+                    self._columns.append(
+                        {"type": [_TYPE_INDEX[type_code]], "user": [user_id], "minutes": [minutes], "rating": [rating], "ts": [ts]}
+                    )
+                count += 1
+        return count
+
+    def _open_log(self, generation: int) -> IO[str]:
+        return open(self._log_path(generation), "a", encoding="utf-8")
+
+    def _log_path(self, generation: int) -> Path:
+        assert self._path is not None
+        return self._path / f"append.{generation}.log"
+
+
+def _period_days(period: str) -> int | None:
+    period = period or "week"
+    if period not in PERIOD_DAYS:
+        raise ValueError("Unsupported period")
+    return PERIOD_DAYS[period]
+
+
+def _user_row(user: User) -> list[Any]:
+    return [user.id, user.username, user.first_name, user.joined_at.isoformat()]
+
+
+def _parse_user(row: list[Any]) -> User:
+    user_id, username, first_name, joined_at = row
+    return User(id=user_id, username=username, first_name=first_name, joined_at=datetime.fromisoformat(joined_at))
@@ -1,9 +1,83 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     bot_token: str
-    database_url: str
+    # postgres — основная БД; columnar — события в памяти одного процесса,
+    # с COLUMNAR_PATH переживают рестарт (снимок + журнал).
+    storage: Literal["postgres", "columnar"] = "postgres"
+    columnar_path: str | None = None
+    database_url: str | None = None
+    # Реплика для статистики; пусто — всё читается с primary.
+    database_read_url: str | None = None
+    read_your_writes_window: float = 5.0
+    db_pool_min_size: int = 1
+    db_pool_max_size: int = 10
+    db_pool_max_idle: float = 300.0
+    # При перегрузке запросы ждут соединение до db_acquire_timeout (чтения —
+    # до db_read_acquire_timeout, если задан). С db_shed_queue_depth чтения
+    # статистики сразу получают отказ, когда в очереди к пулу уже столько
+    # ожидающих. Таймауты запросов и отказы по умолчанию выключены — см. README.
+    db_acquire_timeout: float = 10.0
+    db_read_acquire_timeout: float | None = None
+    db_shed_queue_depth: int | None = None
+    db_write_timeout_ms: float | None = None
+    db_read_timeout_ms: float | None = None
+    run_mode: Literal["polling", "webhook"] = "polling"
+    webhook_url: str | None = None
+    webhook_path: str = "/webhook"
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_secret: str | None = None
+    update_workers: int = 16
+    update_queue_size: int = 1000
+    # >1 — отдельные процессы-обработчики, апдейты шардируются по from_user.id.
+    workers: int = 1
+    # Лимиты Telegram: ~30 сообщений/с на бота и ~1/с на чат.
+    outbox_global_rate: float = 30.0
+    outbox_chat_rate: float = 1.0
+    outbox_chat_burst: float = 3.0
+    fsm_storage: Literal["memory", "postgres"] = "memory"
+    fsm_ttl: float = 3600.0
+    fsm_max_entries: int = 100_000
+    user_cache_size: int = 10_000
+    user_cache_ttl: float = 3600.0
+    # Сколько пользователей держать в кеше личной статистики; 0 — выключен.
+    user_stats_cache_size: int = 50_000
+    # Через сколько секунд перечитывать пользователя: импорт из manage.py кеш не видит.
+    user_stats_ttl: float | None = 600.0
+    # 0 — писать события по одному, >1 — копить пачки через COPY.
+    event_batch_size: int = 0
+    event_batch_delay_ms: float = 20.0
+    # Топы и места из памяти процесса. Только для одного процесса на базу:
+    # записи других процессов он видит лишь при перечитывании.
+    leaderboard_in_memory: bool = False
+    # Как часто перечитывать лидерборд из БД — ради импорта и backfill из manage.py.
+    leaderboard_refresh_interval: float | None = 900.0
+    top_cache_ttl: float = 5.0
+    # Сколько ждать свежую сводку/топ; не успели — последнее известное значение.
+    # По умолчанию ждём сколько нужно.
+    summary_deadline_ms: float | None = None
+    top_deadline_ms: float | None = None
+    # Еженедельная рассылка итогов; день недели 0 — понедельник, час в UTC.
+    digest_enabled: bool = False
+    digest_weekday: int = 0
+    digest_hour: int = 10
+    digest_chunk_size: int = 500
+    # Как часто бот сам создаёт партиции events на месяц вперёд; архивирование
+    # старых — python manage.py partitions --retain-months N по cron.
+    partition_check_interval: float | None = 6 * 3600.0
+    # Перед опросом: все DB_POOL_MIN_SIZE соединений и каждый запрос чтения по разу.
+    db_warmup: bool = False
+    # Кеши пользователей и топов между рестартами; при WORKERS > 1 — файл на воркер.
+    cache_snapshot_path: str | None = None
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int | None = None
+    # Медленные запросы: счётчик всегда, EXPLAIN ANALYZE — выборочно и в фоне.
+    # Для полного охвата на стороне БД лучше auto_explain.
+    slow_query_ms: float | None = None
 
     model_config = {
         "env_file": ".env",
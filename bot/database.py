@@ -1,239 +1,832 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from typing import Any, Sequence
+import asyncio
+import json
+import logging
+import re
+import time
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, AsyncIterator, Iterator, Mapping, Sequence
 
 import asyncpg
 
+from .cache import TTLCache
+from .ingest import EventBatcher
+from .leaderboard import PERIOD_DAYS, Leaderboard
+from .metrics import InstrumentedConnection, SlowQueryExplainer, observe_pool_wait, observe_shed, timed_method
+from .sql import (
+    ACTIVITY_REBUILD,
+    BACKFILL_HISTOGRAM,
+    BACKFILL_HISTOGRAM_ARCHIVE,
+    BACKFILL_ROLLUP,
+    DIGEST_MARK_SENT,
+    DIGEST_PENDING,
+    DIGEST_PURGE,
+    DIGEST_SNAPSHOT,
+    EXPORT_EVENTS,
+    EXPORT_USER_STATS,
+    HISTOGRAM_ARCHIVE_PARTITION,
+    IMPORT_EVENTS,
+    IMPORT_RETIRED_MONTHS,
+    IMPORT_STAGE,
+    IMPORT_USERS,
+    ROLLUP_PARTITION,
+    ROLLUP_RANGE_DELETE,
+    STATEMENTS,
+    UNTIMED_STATEMENTS,
+    WRITE_STATEMENTS,
+    statement_name,
+)
+from .storage import DatabaseBusy, ImportedEvent, PersonalDetails, User, WeeklySummary
+from .user_stats import UserStats, UserStatsCache, utc_today
 
-@dataclass(slots=True)
-class User:
-    id: int
-    username: str | None
-    first_name: str
-    joined_at: Any
+logger = logging.getLogger(__name__)
+
+_PARTITION_NAME = re.compile(r"^events_(\d{4})_(\d{2})$")
+# Прогрев: топы с порогом по умолчанию (/top без аргументов) и личные
+# выборки для несуществующего пользователя — план и индексы, без данных.
+_WARMUP_MIN_RECORDS = 5
+_WARMUP_USER_STATEMENTS = (
+    "select_user",
+    "select_histogram",
+    "select_activity",
+    "user_stats_hydrate",
+    "weekly_summary",
+    *(statement_name("personal_stats", period) for period in PERIOD_DAYS),
+)
+_TOP_STATEMENTS = (("joke_count", "top_joke"), ("story_count", "top_story"), ("time", "top_time"))
+# Снимок старше этого не поднимаем: топы в нём уже не «последние известные».
+_SNAPSHOT_MAX_AGE = 3600.0
 
 
 class Database:
-    def __init__(self, dsn: str) -> None:
+    def __init__(
+        self,
+        dsn: str,
+        *,
+        user_cache_size: int = 10_000,
+        user_cache_ttl: float = 3600.0,
+        batch_max_rows: int = 0,
+        batch_max_delay_ms: float = 20.0,
+        leaderboard: bool = False,
+        top_cache_ttl: float = 5.0,
+        slow_query_ms: float | None = None,
+        read_dsn: str | None = None,
+        read_your_writes_window: float = 5.0,
+        pool_min_size: int = 1,
+        pool_max_size: int = 10,
+        pool_max_idle: float = 300.0,
+        acquire_timeout: float | None = None,
+        read_acquire_timeout: float | None = None,
+        shed_queue_depth: int | None = None,
+        write_timeout_ms: float | None = None,
+        read_timeout_ms: float | None = None,
+        user_stats_cache_size: int = 0,
+        user_stats_ttl: float | None = None,
+        summary_deadline_ms: float | None = None,
+        top_deadline_ms: float | None = None,
+        warmup: bool = False,
+        cache_snapshot_path: str | Path | None = None,
+        partition_check_interval: float | None = None,
+        leaderboard_refresh_interval: float | None = None,
+    ) -> None:
         self._dsn = dsn
+        # Бот живёт дольше заготовленных месяцев: без партиции на текущий месяц INSERT падает.
+        self._partition_check_interval = partition_check_interval
+        self._partition_task: asyncio.Task[None] | None = None
+        self._warmup = warmup
+        self._cache_snapshot_path = Path(cache_snapshot_path) if cache_snapshot_path is not None else None
+        # Фазы последнего connect() в секундах — для лога старта.
+        self.startup_timings: dict[str, float] = {}
+        self._pool_min_size = pool_min_size
+        self._pool_max_size = pool_max_size
+        self._pool_max_idle = pool_max_idle
+        self._acquire_timeout = acquire_timeout
+        self._read_acquire_timeout = read_acquire_timeout
+        # Сколько чтений может ждать соединение, прежде чем новые получат отказ.
+        self._shed_queue_depth = shed_queue_depth
+        self._waiting: dict[asyncpg.Pool, int] = {}
+        self._statement_timeouts = _statement_timeouts(write_timeout_ms, read_timeout_ms)
+        self._read_dsn = read_dsn
+        self._read_pool: asyncpg.Pool | None = None
+        # Кто недавно писал, читает свою статистику с primary, пока реплика догоняет.
+        self._recent_writers: TTLCache[int, bool] = TTLCache(maxsize=100_000, ttl=read_your_writes_window)
+        self._slow_query_threshold = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self._explainer: SlowQueryExplainer | None = None
+        if slow_query_ms is not None:
+            self._explainer = SlowQueryExplainer(lambda: self._acquire(self._reader(), read=True))
         self._pool: asyncpg.Pool | None = None
+        self._batch_max_rows = batch_max_rows
+        self._batch_max_delay = batch_max_delay_ms / 1000
+        self._batcher: EventBatcher | None = None
+        self._users: TTLCache[int, User] = TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        # Окна day/week/month/all для активных пользователей без похода в БД.
+        self._user_stats: UserStatsCache | None = None
+        if user_stats_cache_size > 0:
+            self._user_stats = UserStatsCache(user_stats_cache_size, user_stats_ttl)
+        self._types: Mapping[str, int] = MappingProxyType({})
+        self._leaderboard: Leaderboard | None = Leaderboard() if leaderboard else None
+        # Импорт и backfill из manage.py лидерборд процесса не видит: он периодически
+        # перечитывается целиком. Счётчики записей нужны, чтобы не подменить его
+        # снимком, который мог как увидеть, так и не увидеть параллельную запись.
+        self._leaderboard_refresh_interval = leaderboard_refresh_interval
+        self._leaderboard_task: asyncio.Task[None] | None = None
+        self._leaderboard_writes = 0
+        self._leaderboard_writing = 0
+        self._top_cache: TTLCache[tuple[str, int], dict[str, Sequence[Any]]] = TTLCache(maxsize=64, ttl=top_cache_ttl)
+        self._top_inflight: dict[tuple[str, int], asyncio.Task[dict[str, Sequence[Any]]]] = {}
+        self._top_generation = 0
+        # Последний посчитанный топ: отдаётся, когда база не успевает.
+        self._top_last: TTLCache[tuple[str, int], dict[str, Sequence[Any]]] = TTLCache(maxsize=64, ttl=3600.0)
+        self._top_deadline = top_deadline_ms / 1000 if top_deadline_ms is not None else None
+        self._summary_deadline = summary_deadline_ms / 1000 if summary_deadline_ms is not None else None
+        self._summary_last: TTLCache[int, WeeklySummary] = TTLCache(maxsize=user_cache_size, ttl=3600.0)
+        self._summary_inflight: dict[int, asyncio.Task[WeeklySummary]] = {}
 
     async def connect(self) -> None:
         if self._pool is None:
-            self._pool = await asyncpg.create_pool(dsn=self._dsn, min_size=1, max_size=10)
+            timings = self.startup_timings
+            timings.clear()
+            with _phase(timings, "pool"):
+                self._pool = await self._create_pool(self._dsn)
+                if self._read_dsn:
+                    self._read_pool = await self._create_pool(self._read_dsn)
+            with _phase(timings, "types"):
+                await self.refresh_types()
+            with _phase(timings, "partitions"):
+                await self.maintain_partitions(months_ahead=1)
+            if self._leaderboard is not None:
+                with _phase(timings, "leaderboard"):
+                    await self._seed_leaderboard()
+            if self._cache_snapshot_path is not None:
+                with _phase(timings, "cache_snapshot"):
+                    await self.restore_cache_snapshot(self._cache_snapshot_path)
+            if self._warmup:
+                with _phase(timings, "preflight"):
+                    await self._preflight()
+                with _phase(timings, "warmup"):
+                    await self.warm_up()
+            if self._partition_check_interval is not None:
+                self._partition_task = asyncio.create_task(self._maintain_partitions_forever(), name="partitions")
+            if self._leaderboard is not None and self._leaderboard_refresh_interval is not None:
+                self._leaderboard_task = asyncio.create_task(self._refresh_leaderboard_forever(), name="leaderboard")
+            if self._batch_max_rows > 1:
+                self._batcher = EventBatcher(
+                    self._acquire, max_rows=self._batch_max_rows, max_delay=self._batch_max_delay
+                )
+                self._batcher.start()
+
+    async def _create_pool(self, dsn: str) -> asyncpg.Pool:
+        # Пул растёт до max_size под нагрузкой и сбрасывает простаивающие соединения.
+        return await asyncpg.create_pool(
+            dsn=dsn,
+            min_size=self._pool_min_size,
+            max_size=self._pool_max_size,
+            max_inactive_connection_lifetime=self._pool_max_idle,
+            connection_class=InstrumentedConnection,
+            init=self._init_connection,
+        )
+
+    async def _init_connection(self, conn: InstrumentedConnection) -> None:
+        conn.slow_query_threshold = self._slow_query_threshold
+        conn.slow_query_explainer = self._explainer
+        conn.statement_timeouts = self._statement_timeouts
+        # Ошибка подготовки любого запроса роняет create_pool, то есть старт бота.
+        await conn.prepare_statements(STATEMENTS)
+
+    def _reader(self, user_id: int | None = None) -> asyncpg.Pool | None:
+        if self._read_pool is None:
+            return None
+        if user_id is not None and self._recent_writers.get(user_id):
+            return None
+        return self._read_pool
+
+    @asynccontextmanager
+    async def _acquire(
+        self, pool: asyncpg.Pool | None = None, *, read: bool = False
+    ) -> AsyncIterator[InstrumentedConnection]:
+        pool = pool or self._pool
+        assert pool is not None
+        waiting = self._waiting.get(pool, 0)
+        # Чтения статистики не встают в хвост очереди к пулу: записи важнее.
+        if read and self._shed_queue_depth is not None and waiting >= self._shed_queue_depth:
+            observe_shed("saturated")
+            raise DatabaseBusy("Connection pool is saturated")
+        timeout = self._read_acquire_timeout if read else self._acquire_timeout
+        started = time.perf_counter()
+        self._waiting[pool] = waiting + 1
+        try:
+            conn = await pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError as err:
+            observe_shed("acquire_timeout")
+            raise DatabaseBusy("Timed out waiting for a connection") from err
+        finally:
+            self._waiting[pool] -= 1
+        observe_pool_wait(time.perf_counter() - started)
+        try:
+            yield conn
+        except asyncio.TimeoutError as err:
+            observe_shed("statement_timeout")
+            raise DatabaseBusy("Statement timed out") from err
+        finally:
+            await pool.release(conn)
+
+    @property
+    def types(self) -> Mapping[str, int]:
+        return self._types
+
+    async def refresh_types(self) -> Mapping[str, int]:
+        assert self._pool is not None
+        async with self._acquire() as conn:
+            rows = await conn.fetch_prepared("select_types")
+        self._types = MappingProxyType({row["code"]: row["id"] for row in rows})
+        return self._types
+
+    async def _seed_leaderboard(self) -> None:
+        assert self._leaderboard is not None
+        await self._load_leaderboard(self._leaderboard)
+
+    async def _load_leaderboard(self, leaderboard: Leaderboard) -> None:
+        assert self._pool is not None
+        async with self._acquire() as conn:
+            names = await conn.fetch_prepared("seed_names")
+            totals = await conn.fetch_prepared("seed_totals")
+            days = await conn.fetch_prepared("seed_days")
+        for row in names:
+            leaderboard.set_display_name(row["id"], row["display_name"])
+        for row in totals:
+            leaderboard.load_total(row["user_id"], row["code"], row["events"], row["minutes"], row["rating_sum"])
+        for row in days:
+            leaderboard.load_day(row["day"], row["user_id"], row["code"], row["events"], row["minutes"])
+
+    async def refresh_leaderboard(self) -> bool:
+        assert self._leaderboard is not None
+        writes = self._leaderboard_writes
+        if self._leaderboard_writing:
+            return False
+        leaderboard = Leaderboard()
+        await self._load_leaderboard(leaderboard)
+        if self._leaderboard_writes != writes or self._leaderboard_writing:
+            return False
+        leaderboard.adopt_names(self._leaderboard)
+        self._leaderboard = leaderboard
+        self._invalidate_top()
+        return True
+
+    async def _refresh_leaderboard_forever(self) -> None:
+        assert self._leaderboard_refresh_interval is not None
+        while True:
+            await asyncio.sleep(self._leaderboard_refresh_interval)
+            # Запись во время перечитывания — пробуем ещё раз чуть позже.
+            for delay in (1.0, 5.0, 30.0, None):
+                try:
+                    if await self.refresh_leaderboard():
+                        break
+                except Exception:
+                    logger.exception("Leaderboard refresh failed")
+                    break
+                if delay is None:
+                    logger.warning("Leaderboard refresh skipped: writes kept overlapping the reload")
+                    break
+                await asyncio.sleep(delay)
+
+    async def _preflight(self) -> None:
+        # Все min_size соединений разом: битые всплывут до первого апдейта, а не под нагрузкой.
+        for pool in (self._pool, self._read_pool):
+            if pool is None:
+                continue
+            async with AsyncExitStack() as stack:
+                conns = [await stack.enter_async_context(self._acquire(pool)) for _ in range(self._pool_min_size)]
+                await asyncio.gather(*(conn.execute("SELECT 1") for conn in conns))
+
+    async def warm_up(self) -> None:
+        # Каждый запрос чтения по разу до старта опроса: первый всплеск после
+        # деплоя не платит за холодные планы и буферы Postgres под топами.
+        assert self._pool is not None
+        jobs: dict[str, tuple[Any, ...]] = {name: (0,) for name in _WARMUP_USER_STATEMENTS}
+        if self._leaderboard is None:
+            jobs["rating_by_type"] = (_WARMUP_MIN_RECORDS,)
+            for period in PERIOD_DAYS:
+                for _, base in _TOP_STATEMENTS:
+                    jobs[statement_name(base, period)] = (_WARMUP_MIN_RECORDS,)
+        # Не больше min_size запросов сразу: прогрев не должен растить пул.
+        slots = asyncio.Semaphore(self._pool_min_size)
+
+        async def run(name: str, args: tuple[Any, ...]) -> Sequence[asyncpg.Record]:
+            async with slots, self._acquire(self._reader()) as conn:
+                return await conn.fetch_prepared(name, *args)
+
+        results = await asyncio.gather(*(run(name, args) for name, args in jobs.items()), return_exceptions=True)
+        fetched: dict[str, Sequence[asyncpg.Record]] = {}
+        for name, result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                # Медленный запрос на холодной базе не повод не стартовать.
+                logger.warning("Warm-up query %s failed: %r", name, result)
+            else:
+                fetched[name] = result
+        if "rating_by_type" not in fetched:
+            return
+        for period in PERIOD_DAYS:
+            names = {key: statement_name(base, period) for key, base in _TOP_STATEMENTS}
+            if all(name in fetched for name in names.values()):
+                top = {key: fetched[name] for key, name in names.items()}
+                top["rating_by_type"] = fetched["rating_by_type"]
+                self._top_last.set((period, _WARMUP_MIN_RECORDS), top)
+                self._top_cache.set((period, _WARMUP_MIN_RECORDS), top)
+
+    async def save_cache_snapshot(self, path: str | Path) -> None:
+        snapshot = {
+            "saved_at": time.time(),
+            "users": [
+                [telegram_id, user.id, user.username, user.first_name, user.joined_at.isoformat()]
+                for telegram_id, user in self._users.items()
+            ],
+            "tops": [
+                [period, min_records, {key: [dict(row) for row in rows] for key, rows in top.items() if key != "approximate"}]
+                for (period, min_records), top in self._top_last.items()
+            ],
+        }
+        await asyncio.to_thread(_write_json, Path(path), snapshot)
+
+    async def restore_cache_snapshot(self, path: str | Path) -> None:
+        path = Path(path)
+        try:
+            snapshot = await asyncio.to_thread(lambda: json.loads(path.read_text(encoding="utf-8")))
+            if time.time() - snapshot["saved_at"] > _SNAPSHOT_MAX_AGE:
+                return
+            users = [
+                (telegram_id, User(id=user_id, username=username, first_name=first_name, joined_at=datetime.fromisoformat(joined_at)))
+                for telegram_id, user_id, username, first_name, joined_at in snapshot["users"]
+            ]
+            tops = [((period, min_records), top) for period, min_records, top in snapshot["tops"]]
+        except FileNotFoundError:
+            return
+        except (OSError, KeyError, TypeError, ValueError) as err:
+            logger.warning("Ignoring cache snapshot %s: %r", path, err)
+            return
+        for telegram_id, user in users:
+            self._users.set(telegram_id, user)
+            if self._leaderboard is not None:
+                self._leaderboard.set_display_name(user.id, user.username or user.first_name)
+        # Только как запасной ответ по дедлайну: свежий кеш топа заполнит прогрев.
+        for key, top in tops:
+            self._top_last.set(key, top)
 
     async def close(self) -> None:
+        if self._partition_task is not None:
+            self._partition_task.cancel()
+            await asyncio.gather(self._partition_task, return_exceptions=True)
+            self._partition_task = None
+        if self._leaderboard_task is not None:
+            self._leaderboard_task.cancel()
+            await asyncio.gather(self._leaderboard_task, return_exceptions=True)
+            self._leaderboard_task = None
+        if self._explainer is not None:
+            await self._explainer.close()
+        if self._batcher is not None:
+            await self._batcher.close()
+            self._batcher = None
+        if self._read_pool is not None:
+            await self._read_pool.close()
+            self._read_pool = None
         if self._pool is not None:
             await self._pool.close()
             self._pool = None
+            if self._cache_snapshot_path is not None:
+                try:
+                    await self.save_cache_snapshot(self._cache_snapshot_path)
+                except OSError:
+                    logger.exception("Failed to save cache snapshot")
+        self._users.clear()
+        if self._user_stats is not None:
+            self._user_stats.clear()
 
+    @timed_method
     async def get_or_create_user(self, telegram_id: int, username: str | None, first_name: str) -> User:
         assert self._pool is not None
-        async with self._pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                INSERT INTO users (id, username, first_name)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name
-                RETURNING id, username, first_name, joined_at
-                """,
-                telegram_id,
-                username,
-                first_name,
-            )
-        return User(id=row["id"], username=row["username"], first_name=row["first_name"], joined_at=row["joined_at"])
+        cached = self._users.get(telegram_id)
+        if cached is not None and cached.username == username and cached.first_name == first_name:
+            return cached
 
+        async with self._acquire() as conn:
+            # Пишем только если пользователь новый или профиль изменился.
+            row = await conn.fetchrow_prepared("upsert_user", telegram_id, username, first_name)
+            if row is None:
+                row = await conn.fetchrow_prepared("select_user", telegram_id)
+        user = User(id=row["id"], username=row["username"], first_name=row["first_name"], joined_at=row["joined_at"])
+        self._users.set(telegram_id, user)
+        if self._leaderboard is not None:
+            self._leaderboard.set_display_name(user.id, user.username or user.first_name)
+        return user
+
+    @timed_method
     async def insert_event(self, user_id: int, type_code: str, spent_minutes: int, rating: int) -> None:
         assert self._pool is not None
-        async with self._pool.acquire() as conn:
-            type_row = await conn.fetchrow("SELECT id FROM types WHERE code = $1", type_code)
-            if type_row is None:
+        user_stats = self._user_stats
+        if user_stats is not None:
+            user_stats.begin_write(user_id)
+        self._leaderboard_writes += 1
+        self._leaderboard_writing += 1
+        try:
+            await self._write_event(user_id, type_code, spent_minutes, rating)
+        except BaseException:
+            if user_stats is not None:
+                # Запись могла и закоммититься — кешу такого пользователя не верим.
+                user_stats.discard([user_id])
+            raise
+        else:
+            if user_stats is not None:
+                user_stats.record(user_id, type_code, spent_minutes, rating)
+        finally:
+            self._leaderboard_writing -= 1
+            if user_stats is not None:
+                user_stats.end_write(user_id)
+        self._invalidate_top()
+        # Сводка после записи не должна присоединиться к запросу, начатому до неё.
+        self._summary_inflight.pop(user_id, None)
+        if self._read_pool is not None:
+            self._recent_writers.set(user_id, True)
+        if self._leaderboard is not None:
+            self._leaderboard.record(user_id, type_code, spent_minutes, rating)
+
+    async def _write_event(self, user_id: int, type_code: str, spent_minutes: int, rating: int) -> None:
+        type_id = self._types.get(type_code)
+        if type_id is not None and self._batcher is not None:
+            await self._batcher.submit((type_id, user_id, spent_minutes, rating))
+        elif type_id is not None:
+            async with self._acquire() as conn:
+                await conn.fetch_prepared("insert_event", type_id, user_id, spent_minutes, rating)
+        else:
+            # Тип добавили в БД после старта — резолвим прямо в INSERT.
+            async with self._acquire() as conn:
+                row = await conn.fetchrow_prepared("insert_event_by_code", type_code, user_id, spent_minutes, rating)
+            if row is None:
                 raise ValueError(f"Unknown type_code: {type_code}")
-            await conn.execute(
-                """
-                INSERT INTO events (type_id, user_id, spent_minutes, rating)
-                VALUES ($1, $2, $3, $4)
-                """,
-                type_row["id"],
-                user_id,
-                spent_minutes,
-                rating,
-            )
+            await self.refresh_types()
 
-    async def personal_stats(self, user_id: int, period: str) -> Sequence[asyncpg.Record]:
-        assert self._pool is not None
-        since = self._period_to_since(period)
-        params: list[Any] = [user_id]
-        clause = ""
-        if since is not None:
-            clause = " AND e.happened_at >= $2"
-            params.append(since)
-
-        query = f"""
-            SELECT t.code,
-                   COUNT(*) AS total_events,
-                   COALESCE(SUM(e.spent_minutes), 0) AS total_minutes,
-                   ROUND(AVG(e.rating)::numeric, 2) AS avg_rating
-            FROM events e
-            JOIN types t ON t.id = e.type_id
-            WHERE e.user_id = $1{clause}
-            GROUP BY t.code
-            ORDER BY t.code
-        """
-        async with self._pool.acquire() as conn:
-            return await conn.fetch(query, *params)
-
-    async def global_top(self, period: str, min_records: int = 5) -> dict[str, Sequence[asyncpg.Record]]:
+    @timed_method
+    async def bulk_import(self, events: Sequence[ImportedEvent]) -> int:
         assert self._pool is not None
-        since = self._period_to_since(period)
-        params: list[Any] = []
-        clause = ""
-        if since is not None:
-            clause = " AND e.happened_at >= $1"
-            params.append(since)
-
-        async with self._pool.acquire() as conn:
-            results: dict[str, Sequence[asyncpg.Record]] = {}
-            results["joke_count"] = await conn.fetch(
-                f"""
-                SELECT COALESCE(u.username, u.first_name) AS display_name,
-                       COUNT(*) AS total
-                FROM events e
-                JOIN users u ON u.id = e.user_id
-                JOIN types t ON t.id = e.type_id
-                WHERE t.code = 'joke'{clause}
-                GROUP BY u.id
-                ORDER BY total DESC
-                LIMIT 10
-                """,
-                *params,
-            )
-            results["story_count"] = await conn.fetch(
-                f"""
-                SELECT COALESCE(u.username, u.first_name) AS display_name,
-                       COUNT(*) AS total
-                FROM events e
-                JOIN users u ON u.id = e.user_id
-                JOIN types t ON t.id = e.type_id
-                WHERE t.code = 'story'{clause}
-                GROUP BY u.id
-                ORDER BY total DESC
-                LIMIT 10
-                """,
-                *params,
-            )
-            results["time"] = await conn.fetch(
-                f"""
-                SELECT COALESCE(u.username, u.first_name) AS display_name,
-                       SUM(e.spent_minutes) AS total_minutes
-                FROM events e
-                JOIN users u ON u.id = e.user_id
-                WHERE TRUE{clause}
-                GROUP BY u.id
-                ORDER BY total_minutes DESC
-                LIMIT 10
-                """,
-                *params,
+        if not events:
+            return 0
+        codes = {event.type_code for event in events}
+        if codes - self._types.keys():
+            await self.refresh_types()
+        unknown = codes - self._types.keys()
+        if unknown:
+            raise ValueError(f"Unknown type_code: {', '.join(sorted(unknown))}")
+
+        users = {event.user_id: (event.user_id, event.username, event.first_name) for event in events}
+        records = [
+            (self._types[event.type_code], event.user_id, event.spent_minutes, event.rating, event.happened_at)
+            for event in events
+        ]
+        first_day = min(record[4] for record in records).astimezone(timezone.utc).date()
+        last_day = max(record[4] for record in records).astimezone(timezone.utc).date()
+
+        async with self._acquire() as conn, conn.transaction():
+            # Новая партиция на архивный месяц: следующий ретеншен пересчитал бы
+            # его агрегаты только по импорту и упал бы на SET SCHEMA archive.
+            retired = await conn.fetch(IMPORT_RETIRED_MONTHS, first_day, last_day)
+            if retired:
+                months = ", ".join(row["month"] for row in retired)
+                raise ValueError(f"Cannot import events into retired months: {months}")
+            await conn.execute("SELECT ensure_events_partitions($1, $2)", first_day, last_day)
+            await conn.execute("CREATE TEMP TABLE import_users (id BIGINT, username TEXT, first_name TEXT) ON COMMIT DROP")
+            await conn.copy_records_to_table("import_users", records=list(users.values()))
+            await conn.execute(IMPORT_USERS)
+            await conn.execute(IMPORT_STAGE)
+            await conn.copy_records_to_table(
+                "import_events",
+                records=records,
+                columns=("type_id", "user_id", "spent_minutes", "rating", "happened_at"),
             )
-            results["rating_by_type"] = await conn.fetch(
+            await conn.execute(IMPORT_EVENTS)
+            # История может лечь в любые дни — серии пересчитываем целиком.
+            await conn.execute(ACTIVITY_REBUILD, list(users))
+        self._invalidate_top()
+        for user_id in users:
+            self._summary_inflight.pop(user_id, None)
+        if self._user_stats is not None:
+            self._user_stats.discard(users)
+        return len(records)
+
+    async def export_events(self, *, prefetch: int = 5000) -> AsyncIterator[asyncpg.Record]:
+        async for row in self._stream(EXPORT_EVENTS, prefetch):
+            yield row
+
+    async def export_user_stats(self, *, prefetch: int = 5000) -> AsyncIterator[asyncpg.Record]:
+        async for row in self._stream(EXPORT_USER_STATS, prefetch):
+            yield row
+
+    async def _stream(self, query: str, prefetch: int) -> AsyncIterator[asyncpg.Record]:
+        # Серверный курсор: память не зависит от размера выгрузки.
+        async with self._acquire(self._reader()) as conn, conn.transaction(readonly=True):
+            async for row in conn.cursor(query, prefetch=prefetch):
+                yield row
+
+    @timed_method
+    async def backfill_rollups(self) -> int:
+        assert self._pool is not None
+        async with self._acquire() as conn, conn.transaction():
+            await conn.execute("LOCK TABLE events IN SHARE MODE")
+            # Месяцы из отцепленных партиций живут только в агрегатах — их не трогаем.
+            await conn.execute(
                 """
-                SELECT t.code,
-                       ROUND(AVG(e.rating)::numeric, 2) AS avg_rating,
-                       COUNT(*) AS cnt
-                FROM events e
-                JOIN types t ON t.id = e.type_id
-                GROUP BY t.code
-                ORDER BY t.code
+                DELETE FROM user_type_daily
+                WHERE day >= (SELECT (MIN(happened_at) AT TIME ZONE 'UTC')::date FROM events)
                 """
             )
-        return results
+            status = await conn.execute(BACKFILL_ROLLUP)
+            # Гистограммы: вклад отцеплённых партиций из архива плюс всё, что ещё в events.
+            await conn.execute("TRUNCATE user_histogram")
+            await conn.execute(BACKFILL_HISTOGRAM_ARCHIVE)
+            await conn.execute(BACKFILL_HISTOGRAM)
+            # Серии строятся из user_type_daily, а там старые месяцы сохранились.
+            await conn.execute("TRUNCATE user_activity")
+            await conn.execute(ACTIVITY_REBUILD, None)
+        if self._user_stats is not None:
+            self._user_stats.clear()
+        return int(status.split()[-1])
 
-    async def weekly_personal_summary(self, user_id: int) -> Sequence[asyncpg.Record]:
-        assert self._pool is not None
-        since = datetime.now(timezone.utc) - timedelta(days=7)
-        query = """
-            SELECT t.code,
-                   COUNT(*) AS total_events,
-                   COALESCE(SUM(e.spent_minutes), 0) AS total_minutes,
-                   ROUND(AVG(e.rating)::numeric, 2) AS avg_rating
-            FROM events e
-            JOIN types t ON t.id = e.type_id
-            WHERE e.user_id = $1 AND e.happened_at >= $2
-            GROUP BY t.code
-            ORDER BY t.code
-        """
-        async with self._pool.acquire() as conn:
-            return await conn.fetch(query, user_id, since)
+    async def _maintain_partitions_forever(self) -> None:
+        assert self._partition_check_interval is not None
+        while True:
+            await asyncio.sleep(self._partition_check_interval)
+            try:
+                created, _ = await self.maintain_partitions(months_ahead=1)
+            except Exception:
+                logger.exception("Partition maintenance failed")
+                continue
+            if created:
+                logger.info("Created %s events partitions", created)
 
-    async def weekly_global_positions(self, user_id: int) -> dict[str, int | None]:
+    @timed_method
+    async def maintain_partitions(
+        self, *, months_ahead: int = 3, retain_months: int | None = None, drop: bool = False
+    ) -> tuple[int, list[str]]:
         assert self._pool is not None
-        since = datetime.now(timezone.utc) - timedelta(days=7)
-        async with self._pool.acquire() as conn:
-            joke_rank = await conn.fetchrow(
-                """
-                SELECT rank
-                FROM (
-                    SELECT user_id,
-                           ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) AS rank
-                    FROM events e
-                    JOIN types t ON t.id = e.type_id
-                    WHERE t.code = 'joke' AND e.happened_at >= $1
-                    GROUP BY user_id
-                ) ranked
-                WHERE user_id = $2
-                """,
-                since,
-                user_id,
+        today = datetime.now(timezone.utc).date()
+        this_month = today.replace(day=1)
+        async with self._acquire() as conn:
+            created = await conn.fetchval(
+                "SELECT ensure_events_partitions($1, $2)", this_month, _add_months(this_month, months_ahead)
             )
-            story_rank = await conn.fetchrow(
+            if retain_months is None:
+                return created, []
+            cutoff = _add_months(this_month, -retain_months)
+            names = await conn.fetch(
                 """
-                SELECT rank
-                FROM (
-                    SELECT user_id,
-                           ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) AS rank
-                    FROM events e
-                    JOIN types t ON t.id = e.type_id
-                    WHERE t.code = 'story' AND e.happened_at >= $1
-                    GROUP BY user_id
-                ) ranked
-                WHERE user_id = $2
-                """,
-                since,
-                user_id,
-            )
-            time_rank = await conn.fetchrow(
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'events'::regclass
+                ORDER BY c.relname
                 """
-                SELECT rank
-                FROM (
-                    SELECT user_id,
-                           ROW_NUMBER() OVER (ORDER BY SUM(spent_minutes) DESC) AS rank
-                    FROM events
-                    WHERE happened_at >= $1
-                    GROUP BY user_id
-                ) ranked
-                WHERE user_id = $2
-                """,
-                since,
-                user_id,
             )
+            retired: list[str] = []
+            for row in names:
+                match = _PARTITION_NAME.match(row["relname"])
+                if match is None:
+                    continue
+                month = date(int(match.group(1)), int(match.group(2)), 1)
+                if month >= cutoff:
+                    continue
+                partition = row["relname"]
+                async with conn.transaction():
+                    await conn.execute(ROLLUP_RANGE_DELETE, month, _add_months(month, 1))
+                    await conn.execute(ROLLUP_PARTITION.format(partition=partition))
+                    await conn.execute(HISTOGRAM_ARCHIVE_PARTITION.format(partition=partition))
+                    await conn.execute(f"ALTER TABLE events DETACH PARTITION {partition}")
+                    if drop:
+                        await conn.execute(f"DROP TABLE {partition}")
+                    else:
+                        await conn.execute("CREATE SCHEMA IF NOT EXISTS archive")
+                        await conn.execute(f"ALTER TABLE {partition} SET SCHEMA archive")
+                retired.append(partition)
+        return created, retired
+
+    @timed_method
+    async def personal_stats(self, user_id: int, period: str) -> Sequence[Mapping[str, Any]]:
+        assert self._pool is not None
+        name = self._period_statement("personal_stats", period)
+        if self._user_stats is not None:
+            stats = self._user_stats.get(user_id) or await self._load_user_stats(user_id)
+            return stats.rows(period or "week", utc_today())
+        async with self._acquire(self._reader(user_id), read=True) as conn:
+            return await conn.fetch_prepared(name, user_id)
+
+    async def _load_user_stats(self, user_id: int) -> UserStats:
+        assert self._user_stats is not None
+        self._user_stats.begin_load(user_id)
+        stats: UserStats | None = None
+        try:
+            async with self._acquire(self._reader(user_id), read=True) as conn:
+                stats = UserStats.from_rows(await conn.fetch_prepared("user_stats_hydrate", user_id))
+        finally:
+            self._user_stats.finish_load(user_id, stats)
+        return stats
+
+    @timed_method
+    async def personal_details(self, user_id: int) -> PersonalDetails:
+        assert self._pool is not None
+        async with self._acquire(self._reader(user_id), read=True) as conn:
+            histogram = await conn.fetch_prepared("select_histogram", user_id)
+            activity = await conn.fetchrow_prepared("select_activity", user_id)
+        return PersonalDetails(histogram=histogram, activity=activity)
+
+    @timed_method
+    async def global_top(self, period: str, min_records: int = 5) -> dict[str, Sequence[Any]]:
+        assert self._pool is not None
+        period = period or "week"
+        if period not in PERIOD_DAYS:
+            raise ValueError("Unsupported period")
+        if self._leaderboard is not None:
+            return self._leaderboard.top(period, min_records=min_records)
+
+        key = (period, min_records)
+        cached = self._top_cache.get(key)
+        if cached is not None:
+            return cached
+        task = self._top_inflight.get(key)
+        if task is None:
+            # Одинаковые запросы топа ждут одно вычисление, а не бьют в БД толпой.
+            task = asyncio.create_task(self._compute_global_top(period, min_records))
+            generation = self._top_generation
+
+            def _store(done: asyncio.Task[dict[str, Sequence[Any]]]) -> None:
+                self._top_inflight.pop(key, None)
+                if done.cancelled() or done.exception() is not None:
+                    return
+                self._top_last.set(key, done.result())
+                if generation == self._top_generation:
+                    self._top_cache.set(key, done.result())
+
+            task.add_done_callback(_store)
+            self._top_inflight[key] = task
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self._top_deadline)
+        except (asyncio.TimeoutError, DatabaseBusy) as err:
+            # Вычисление продолжается в фоне и обновит кеш для следующих запросов.
+            stale = self._top_last.get(key)
+            if stale is None:
+                raise DatabaseBusy("Global top is not ready") from err
+            return {**stale, "approximate": True}
+
+    def _invalidate_top(self) -> None:
+        self._top_generation += 1
+        self._top_cache.clear()
+
+    async def _compute_global_top(self, period: str, min_records: int) -> dict[str, Sequence[Any]]:
+        joke_count, story_count, time, rating_by_type = await asyncio.gather(
+            self._fetch(self._period_statement("top_joke", period), min_records),
+            self._fetch(self._period_statement("top_story", period), min_records),
+            self._fetch(self._period_statement("top_time", period), min_records),
+            self._fetch("rating_by_type", min_records),
+        )
         return {
-            "joke_rank": joke_rank["rank"] if joke_rank else None,
-            "story_rank": story_rank["rank"] if story_rank else None,
-            "time_rank": time_rank["rank"] if time_rank else None,
+            "joke_count": joke_count,
+            "story_count": story_count,
+            "time": time,
+            "rating_by_type": rating_by_type,
         }
 
-    def _period_to_since(self, period: str) -> datetime | None:
-        now = datetime.now(timezone.utc)
-        period = period or "week"
-        if period == "day":
-            return now - timedelta(days=1)
-        if period == "week":
-            return now - timedelta(days=7)
-        if period == "month":
-            return now - timedelta(days=30)
-        if period == "all":
-            return None
-        raise ValueError("Unsupported period")
+    async def _fetch(self, name: str, *args: Any) -> Sequence[asyncpg.Record]:
+        async with self._acquire(self._reader(), read=True) as conn:
+            return await conn.fetch_prepared(name, *args)
+
+    @timed_method
+    async def weekly_personal_summary(self, user_id: int) -> Sequence[Mapping[str, Any]]:
+        return await self.personal_stats(user_id, "week")
+
+    @timed_method
+    async def weekly_global_positions(self, user_id: int) -> dict[str, int | None]:
+        if self._leaderboard is not None:
+            return self._leaderboard.ranks("week", user_id)
+        summary = await self.weekly_summary(user_id)
+        return summary.ranks
+
+    @timed_method
+    async def weekly_summary(self, user_id: int) -> WeeklySummary:
+        assert self._pool is not None
+        task = self._summary_inflight.get(user_id)
+        if task is None:
+            # Один запрос на пользователя: медленная база не копит фоновые задачи.
+            task = asyncio.create_task(self._fetch_weekly_summary(user_id))
+
+            def _store(done: asyncio.Task[WeeklySummary]) -> None:
+                # Запрос, отцеплённый записью, не трогает новый и не затирает его результат.
+                if self._summary_inflight.get(user_id) is not done:
+                    return
+                del self._summary_inflight[user_id]
+                if not done.cancelled() and done.exception() is None:
+                    self._summary_last.set(user_id, done.result())
+
+            task.add_done_callback(_store)
+            self._summary_inflight[user_id] = task
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self._summary_deadline)
+        except (asyncio.TimeoutError, DatabaseBusy) as err:
+            stale = self._summary_last.get(user_id)
+            if stale is None:
+                raise DatabaseBusy("Weekly summary is not ready") from err
+            return self._approximate_summary(user_id, stale)
+
+    def _approximate_summary(self, user_id: int, stale: WeeklySummary) -> WeeklySummary:
+        # Места из лидерборда в памяти всегда свежие, иначе — из последней сводки.
+        if self._leaderboard is not None:
+            ranks, stale_ranks = self._leaderboard.ranks("week", user_id), False
+        else:
+            ranks, stale_ranks = stale.ranks, True
+        # Личные цифры из кеша статистики точные — устаревшими остаются только места.
+        stats = self._user_stats.get(user_id) if self._user_stats is not None else None
+        if stats is not None:
+            return WeeklySummary(records=stats.rows("week", utc_today()), ranks=ranks, stale_ranks=stale_ranks)
+        return WeeklySummary(records=stale.records, ranks=ranks, stale_records=True, stale_ranks=stale_ranks)
+
+    async def _fetch_weekly_summary(self, user_id: int) -> WeeklySummary:
+        if self._leaderboard is not None:
+            records = await self.weekly_personal_summary(user_id)
+            return WeeklySummary(records=records, ranks=self._leaderboard.ranks("week", user_id))
+        async with self._acquire(self._reader(user_id), read=True) as conn:
+            rows = await conn.fetch_prepared("weekly_summary", user_id)
+        first = rows[0] if rows else None
+        return WeeklySummary(
+            records=rows,
+            ranks={
+                "joke_rank": first["joke_rank"] if first else None,
+                "story_rank": first["story_rank"] if first else None,
+                "time_rank": first["time_rank"] if first else None,
+            },
+        )
+
+    @timed_method
+    async def prepare_weekly_digest(self, week: date, *, keep_weeks: int = 4) -> int:
+        assert self._pool is not None
+        async with self._acquire() as conn, conn.transaction():
+            await conn.execute(DIGEST_PURGE, week - timedelta(weeks=keep_weeks))
+            # Повторный вызов за ту же неделю ничего не пересчитывает.
+            status = await conn.execute(DIGEST_SNAPSHOT, week)
+        return int(status.split()[-1])
+
+    @timed_method
+    async def weekly_digest_pending(self, week: date, *, after_user_id: int, limit: int) -> Sequence[asyncpg.Record]:
+        assert self._pool is not None
+        async with self._acquire() as conn:
+            return await conn.fetch(DIGEST_PENDING, week, after_user_id, limit)
+
+    @timed_method
+    async def mark_digest_sent(self, week: date, user_ids: Sequence[int]) -> None:
+        assert self._pool is not None
+        async with self._acquire() as conn:
+            await conn.execute(DIGEST_MARK_SENT, week, list(user_ids))
+
+    def _period_statement(self, base: str, period: str) -> str:
+        name = statement_name(base, period or "week")
+        if name not in STATEMENTS:
+            raise ValueError("Unsupported period")
+        return name
+
+
+def _statement_timeouts(write_timeout_ms: float | None, read_timeout_ms: float | None) -> dict[str, float]:
+    timeouts: dict[str, float] = {}
+    for name in STATEMENTS:
+        if name in UNTIMED_STATEMENTS:
+            continue
+        timeout_ms = write_timeout_ms if name in WRITE_STATEMENTS else read_timeout_ms
+        if timeout_ms is not None:
+            timeouts[name] = timeout_ms / 1000
+    return timeouts
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+@contextmanager
+def _phase(timings: dict[str, float], name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+
+
+def _write_json(path: Path, data: Any) -> None:
+    # Через временный файл: оборванная запись не испортит прошлый снимок.
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, default=_json_default), encoding="utf-8")
+    tmp.replace(path)
+
 
+def _json_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import date, datetime, timedelta, timezone
+from typing import Any
+
+from .database import Database
+from .outbox import BROADCAST, Outbox
+from .texts import TYPE_LABELS, global_summary_text, personal_summary_text, weekly_digest_message
+from .utils import build_personal_summary, ensure_all_types
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 60.0
+
+
+class WeeklyDigest:
+    # Рассылка идёт по снимку weekly_digest пачками: когда полоса BROADCAST
+    # в outbox опустела, доставленные из пачки отмечаются отправленными, а
+    # недоставленные ждут следующего запуска. После рестарта повторно уйдёт
+    # максимум одна пачка.
+
+    def __init__(
+        self,
+        database: Database,
+        outbox: Outbox,
+        *,
+        weekday: int = 0,
+        hour: int = 10,
+        chunk_size: int = 500,
+        catch_up: timedelta = timedelta(hours=12),
+    ) -> None:
+        self._database = database
+        self._outbox = outbox
+        self._weekday = weekday
+        self._hour = hour
+        self._chunk_size = chunk_size
+        self._catch_up = catch_up
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="weekly-digest")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def send(self, week: date) -> int:
+        prepared = await self._database.prepare_weekly_digest(week)
+        logger.info("Weekly digest %s: %s new recipients", week, prepared)
+        sent = 0
+        after_user_id = 0
+        while True:
+            rows = await self._database.weekly_digest_pending(week, after_user_id=after_user_id, limit=self._chunk_size)
+            if not rows:
+                break
+            failed: set[int] = set()
+            for row in rows:
+                # users.id — Telegram id пользователя, он же id личного чата с ботом.
+                chat_id = row["user_id"]
+                self._outbox.send(chat_id, render_digest(row), lane=BROADCAST, on_failure=failed.add)
+            await self._outbox.drain(BROADCAST)
+            # Недоставленные остаются в снимке неотправленными — их возьмёт следующий запуск.
+            user_ids = [row["user_id"] for row in rows if row["user_id"] not in failed]
+            if user_ids:
+                await self._database.mark_digest_sent(week, user_ids)
+            sent += len(user_ids)
+            if failed:
+                logger.warning("Weekly digest %s: %s recipients not delivered", week, len(failed))
+            after_user_id = rows[-1]["user_id"]
+        logger.info("Weekly digest %s: sent %s", week, sent)
+        return sent
+
+    async def _run(self) -> None:
+        while True:
+            now = datetime.now(timezone.utc)
+            slot = self._last_slot(now)
+            # Бот мог лежать в момент рассылки — догоняем, но не через неделю.
+            if now - slot <= self._catch_up:
+                try:
+                    await self.send(slot.date())
+                except Exception:
+                    logger.exception("Weekly digest %s failed", slot.date())
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+            next_slot = slot + timedelta(weeks=1)
+            await asyncio.sleep(max(0.0, (next_slot - datetime.now(timezone.utc)).total_seconds()))
+
+    def _last_slot(self, now: datetime) -> datetime:
+        slot = now.replace(hour=self._hour, minute=0, second=0, microsecond=0)
+        slot -= timedelta(days=(now.weekday() - self._weekday) % 7)
+        if slot > now:
+            slot -= timedelta(weeks=1)
+        return slot
+
+
+def render_digest(row: Any) -> str:
+    records = [
+        {"code": code, "total_events": events, "total_minutes": minutes, "avg_rating": avg_rating}
+        for code, events, minutes, avg_rating in zip(row["codes"], row["events"], row["minutes"], row["avg_ratings"])
+    ]
+    personal = ensure_all_types(build_personal_summary(records), TYPE_LABELS)
+    ranks = {"joke_rank": row["joke_rank"], "story_rank": row["story_rank"], "time_rank": row["time_rank"]}
+    return weekly_digest_message(personal_summary_text(personal), global_summary_text(ranks))
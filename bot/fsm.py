@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+_CompactKey = tuple[int, int, int, int | None, str]
+
+
+def _compact(key: StorageKey) -> _CompactKey:
+    return (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.destiny)
+
+
+def _state_name(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+
+class _Entry:
+    __slots__ = ("state", "data", "touched_at")
+
+    def __init__(self) -> None:
+        self.state: str | None = None
+        self.data: dict[str, Any] | None = None
+        self.touched_at = 0.0
+
+
+class BoundedMemoryStorage(BaseStorage):
+    # Брошенные на полпути сценарии вытесняются по TTL, а общее число
+    # записей ограничено — память процесса не растёт с числом пользователей.
+
+    def __init__(self, *, ttl: float = 3600.0, max_entries: int = 100_000) -> None:
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries: OrderedDict[_CompactKey, _Entry] = OrderedDict()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = self._touch(key)
+        entry.state = _state_name(state)
+        self._drop_if_empty(key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        entry = self._lookup(key)
+        return entry.state if entry is not None else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        entry = self._touch(key)
+        entry.data = dict(data) if data else None
+        self._drop_if_empty(key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        entry = self._lookup(key)
+        if entry is None or entry.data is None:
+            return {}
+        return dict(entry.data)
+
+    async def close(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: StorageKey) -> _Entry | None:
+        self._evict(time.monotonic())
+        return self._entries.get(_compact(key))
+
+    def _touch(self, key: StorageKey) -> _Entry:
+        now = time.monotonic()
+        compact = _compact(key)
+        entry = self._entries.get(compact)
+        if entry is None:
+            entry = self._entries[compact] = _Entry()
+        else:
+            self._entries.move_to_end(compact)
+        entry.touched_at = now
+        self._evict(now)
+        return entry
+
+    def _drop_if_empty(self, key: StorageKey, entry: _Entry) -> None:
+        if entry.state is None and entry.data is None:
+            self._entries.pop(_compact(key), None)
+
+    def _evict(self, now: float) -> None:
+        # Записи упорядочены по последнему касанию, так что старые всегда в начале.
+        deadline = now - self._ttl
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest.touched_at > deadline and len(self._entries) <= self._max_entries:
+                break
+            self._entries.popitem(last=False)
+
+
+class PostgresStorage(BaseStorage):
+    _CLEANUP_EVERY = 1000
+
+    def __init__(self, dsn: str, *, ttl: float = 3600.0) -> None:
+        self._dsn = dsn
+        self._ttl = ttl
+        self._pool: asyncpg.Pool | None = None
+        # Первые апдейты воркера приходят пачкой — пул создаёт только один из них.
+        self._pool_lock = asyncio.Lock()
+        self._writes = 0
+
+    # Строка старше TTL для get_* уже не существует: новый сценарий не должен
+    # унаследовать её данные (или состояние), пока уборка до неё не дошла.
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(
+            """
+            INSERT INTO fsm_state (key, state, data)
+            VALUES ($1, $2, NULL)
+            ON CONFLICT (key) DO UPDATE SET
+                state = EXCLUDED.state,
+                data = CASE
+                    WHEN fsm_state.updated_at <= CURRENT_TIMESTAMP - make_interval(secs => $3) THEN NULL
+                    ELSE fsm_state.data
+                END,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            self._key(key),
+            _state_name(state),
+            self._ttl,
+        )
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        row = await self._read(key)
+        return row["state"] if row is not None else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self._write(
+            """
+            INSERT INTO fsm_state (key, state, data)
+            VALUES ($1, NULL, $2::jsonb)
+            ON CONFLICT (key) DO UPDATE SET
+                state = CASE
+                    WHEN fsm_state.updated_at <= CURRENT_TIMESTAMP - make_interval(secs => $3) THEN NULL
+                    ELSE fsm_state.state
+                END,
+                data = EXCLUDED.data,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            self._key(key),
+            json.dumps(data, ensure_ascii=False) if data else None,
+            self._ttl,
+        )
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        row = await self._read(key)
+        if row is None or row["data"] is None:
+            return {}
+        return json.loads(row["data"])
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def _connect(self) -> asyncpg.Pool:
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(dsn=self._dsn, min_size=1, max_size=5)
+        return self._pool
+
+    async def _read(self, key: StorageKey) -> asyncpg.Record | None:
+        pool = await self._connect()
+        async with pool.acquire() as conn:
+            return await conn.fetchrow(
+                """
+                SELECT state, data
+                FROM fsm_state
+                WHERE key = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+                """,
+                self._key(key),
+                self._ttl,
+            )
+
+    async def _write(self, query: str, *args: Any) -> None:
+        pool = await self._connect()
+        async with pool.acquire() as conn:
+            await conn.execute(query, *args)
+            if args[1] is None:
+                await conn.execute("DELETE FROM fsm_state WHERE key = $1 AND state IS NULL AND data IS NULL", args[0])
+            self._writes += 1
+            if self._writes % self._CLEANUP_EVERY == 0:
+                await conn.execute(
+                    "DELETE FROM fsm_state WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1)",
+                    self._ttl,
+                )
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in _compact(key) if part is not None)
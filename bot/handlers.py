@@ -1,41 +1,51 @@
 from __future__ import annotations
 
+from datetime import date, datetime, timezone
 from typing import Any
 
 from aiogram import Dispatcher, F, Router
-from aiogram.filters import Command, CommandObject
+from aiogram.filters import Command, CommandObject, ExceptionTypeFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove
+from aiogram.types import CallbackQuery, ErrorEvent, Message, ReplyKeyboardRemove
 
-from .database import Database
 from .keyboards import JOKE_BUTTON, STORY_BUTTON, TOP_BUTTON, main_menu_keyboard, rating_keyboard
+from .outbox import Outbox
 from .schemas import RatingCallback
 from .states import AddEventState
-from .texts import HELP_TEXT, START_GREETING, added_event_message, global_summary_text, personal_summary_text
-from .utils import build_personal_summary, parse_period
+from .storage import DatabaseBusy, Storage
+from .texts import (
+    BUSY_TEXT,
+    HELP_TEXT,
+    STATS_BUSY_TEXT,
+    START_GREETING,
+    TOP_APPROXIMATE_NOTE,
+    TYPE_LABELS,
+    added_event_message,
+    global_summary_text,
+    personal_details_text,
+    personal_summary_text,
+)
+from .utils import build_personal_details, build_personal_summary, ensure_all_types, parse_period
 
 TYPE_BY_TEXT = {
     JOKE_BUTTON: "joke",
     STORY_BUTTON: "story",
 }
 
-TYPE_LABELS = {
-    "joke": "анекдот",
-    "story": "кулстори",
-}
+DETAILS_ARGS = {"details", "detail", "full"}
 
 
-def register_handlers(dp: Dispatcher, database: Database) -> None:
+def register_handlers(dp: Dispatcher, database: Storage, outbox: Outbox) -> None:
     router = Router()
 
     async def handle_top(message: Message, args: str | None) -> None:
-        await _handle_top(database, message, args)
+        await _handle_top(database, outbox, message, args)
 
     @router.message(Command("start"))
     async def cmd_start(message: Message, state: FSMContext) -> None:
         await state.clear()
         user = await _ensure_user(database, message)
-        await message.answer(START_GREETING, reply_markup=main_menu_keyboard())
+        outbox.answer(message, START_GREETING, reply_markup=main_menu_keyboard())
         await _debug_user(message, user)
 
     @router.message(Command(commands=["joke", "story"]))
@@ -44,26 +54,26 @@ def register_handlers(dp: Dispatcher, database: Database) -> None:
         assert type_code in TYPE_LABELS
         user = await _ensure_user(database, message)
         if not command.args:
-            await message.reply("Формат: /{} <минуты> <оценка (1-5)>".format(type_code))
+            outbox.reply(message, "Формат: /{} <минуты> <оценка (1-5)>".format(type_code))
             return
         parts = command.args.split()
         if len(parts) != 2:
-            await message.reply("Нужно передать ровно два параметра: минуты и оценку.")
+            outbox.reply(message, "Нужно передать ровно два параметра: минуты и оценку.")
             return
         minutes, rating = parts
         if not minutes.isdigit() or int(minutes) <= 0:
-            await message.reply("Минуты должны быть положительным числом.")
+            outbox.reply(message, "Минуты должны быть положительным числом.")
             return
         if not rating.isdigit():
-            await message.reply("Оценка должна быть числом 1-5.")
+            outbox.reply(message, "Оценка должна быть числом 1-5.")
             return
         rating_value = int(rating)
         if rating_value < 1 or rating_value > 5:
-            await message.reply("Оценка должна быть в диапазоне 1-5.")
+            outbox.reply(message, "Оценка должна быть в диапазоне 1-5.")
             return
 
         await database.insert_event(user_id=user.id, type_code=type_code, spent_minutes=int(minutes), rating=rating_value)
-        await _send_summary(message, database, user_id=user.id, type_code=type_code, minutes=int(minutes), rating=rating_value)
+        await _send_summary(message, database, outbox, user_id=user.id, type_code=type_code, minutes=int(minutes), rating=rating_value)
 
     @router.message(F.text.in_(TYPE_BY_TEXT.keys()))
     async def choose_type(message: Message, state: FSMContext) -> None:
@@ -71,20 +81,20 @@ def register_handlers(dp: Dispatcher, database: Database) -> None:
         type_code = TYPE_BY_TEXT[message.text]
         await state.update_data(user_id=user.id, type_code=type_code)
         await state.set_state(AddEventState.waiting_for_minutes)
-        await message.answer("Сколько минут заняло?", reply_markup=ReplyKeyboardRemove())
+        outbox.answer(message, "Сколько минут заняло?", reply_markup=ReplyKeyboardRemove())
 
     @router.message(AddEventState.waiting_for_minutes)
     async def process_minutes(message: Message, state: FSMContext) -> None:
         if message.text is None or not message.text.isdigit():
-            await message.reply("Введи количество минут, целое число больше нуля.")
+            outbox.reply(message, "Введи количество минут, целое число больше нуля.")
             return
         minutes = int(message.text)
         if minutes <= 0:
-            await message.reply("Минуты должны быть положительным числом.")
+            outbox.reply(message, "Минуты должны быть положительным числом.")
             return
         await state.update_data(minutes=minutes)
         await state.set_state(AddEventState.waiting_for_rating)
-        await message.answer("Оценка? Жми звёзды.", reply_markup=rating_keyboard())
+        outbox.answer(message, "Оценка? Жми звёзды.", reply_markup=rating_keyboard())
 
     @router.callback_query(AddEventState.waiting_for_rating, RatingCallback.filter())
     async def process_rating(callback: CallbackQuery, callback_data: RatingCallback, state: FSMContext) -> None:
@@ -106,23 +116,28 @@ def register_handlers(dp: Dispatcher, database: Database) -> None:
 
         if callback.message:
             await callback.message.edit_reply_markup()
-            await _send_summary(callback.message, database, user_id=user_id, type_code=type_code, minutes=minutes, rating=rating)
+            await _send_summary(callback.message, database, outbox, user_id=user_id, type_code=type_code, minutes=minutes, rating=rating)
         await callback.answer("Зафиксировано!")
         await state.clear()
 
     @router.message(Command("me"))
     async def cmd_me(message: Message, command: CommandObject) -> None:
         user = await _ensure_user(database, message)
+        if command.args and command.args.strip().lower() in DETAILS_ARGS:
+            details = await database.personal_details(user.id)
+            text = personal_details_text(build_personal_details(details.histogram, details.activity, _today()))
+            outbox.answer(message, text, reply_markup=main_menu_keyboard(), parse_mode=None)
+            return
         period = parse_period(command.args.strip()) if command.args else "week"
         records = await database.personal_stats(user.id, period)
         summary = build_personal_summary(records)
-        enriched = _ensure_all_types(summary)
+        enriched = ensure_all_types(summary, TYPE_LABELS)
         text = personal_summary_text(enriched)
-        await message.answer(text, reply_markup=main_menu_keyboard(), parse_mode=None)
+        outbox.answer(message, text, reply_markup=main_menu_keyboard(), parse_mode=None)
 
     @router.message(Command("help"))
     async def cmd_help(message: Message) -> None:
-        await message.answer(HELP_TEXT, reply_markup=main_menu_keyboard())
+        outbox.answer(message, HELP_TEXT, reply_markup=main_menu_keyboard())
 
     @router.message(Command("top"))
     async def cmd_top(message: Message, command: CommandObject) -> None:
@@ -135,12 +150,20 @@ def register_handlers(dp: Dispatcher, database: Database) -> None:
     @router.message(Command("cancel"))
     async def cmd_cancel(message: Message, state: FSMContext) -> None:
         await state.clear()
-        await message.answer("Отменил. Жми кнопку, чтобы начать снова.", reply_markup=main_menu_keyboard())
+        outbox.answer(message, "Отменил. Жми кнопку, чтобы начать снова.", reply_markup=main_menu_keyboard())
+
+    @router.errors(ExceptionTypeFilter(DatabaseBusy))
+    async def on_database_busy(event: ErrorEvent) -> None:
+        # Состояние FSM не сбрасываем: можно просто повторить шаг.
+        if event.update.callback_query is not None:
+            await event.update.callback_query.answer(BUSY_TEXT, show_alert=True)
+        elif event.update.message is not None:
+            outbox.reply(event.update.message, BUSY_TEXT)
 
     dp.include_router(router)
 
 
-async def _ensure_user(database: Database, message: Message) -> Any:
+async def _ensure_user(database: Storage, message: Message) -> Any:
     user_obj = message.from_user
     if user_obj is None:
         raise RuntimeError("No user information in message")
@@ -152,13 +175,17 @@ async def _ensure_user(database: Database, message: Message) -> Any:
     )
 
 
-async def _send_summary(message: Message, database: Database, *, user_id: int, type_code: str, minutes: int, rating: int) -> None:
-    weekly_records = await database.weekly_personal_summary(user_id)
-    personal_summary = build_personal_summary(weekly_records)
-    enriched_summary = _ensure_all_types(personal_summary)
-    personal_text = personal_summary_text(enriched_summary)
-    ranks = await database.weekly_global_positions(user_id)
-    global_text = global_summary_text(ranks)
+async def _send_summary(message: Message, database: Storage, outbox: Outbox, *, user_id: int, type_code: str, minutes: int, rating: int) -> None:
+    try:
+        summary = await database.weekly_summary(user_id)
+    except DatabaseBusy:
+        # Событие уже записано — подтверждаем его и без статистики.
+        personal_text, global_text = STATS_BUSY_TEXT, ""
+    else:
+        personal_summary = build_personal_summary(summary.records)
+        enriched_summary = ensure_all_types(personal_summary, TYPE_LABELS)
+        personal_text = personal_summary_text(enriched_summary, approximate=summary.stale_records)
+        global_text = global_summary_text(summary.ranks, approximate=summary.stale_ranks)
     text = added_event_message(
         TYPE_LABELS[type_code],
         minutes,
@@ -166,15 +193,12 @@ async def _send_summary(message: Message, database: Database, *, user_id: int, t
         personal_text,
         global_text,
     )
-    await message.answer(text, reply_markup=main_menu_keyboard())
+    # В группе сводки разных людей делят чат: схлопываем только свои.
+    outbox.answer(message, text, reply_markup=main_menu_keyboard(), coalesce_key=f"summary:{user_id}")
 
 
-def _ensure_all_types(stats: dict[str, dict[str, int | float]]) -> dict[str, dict[str, int | float]]:
-    enriched: dict[str, dict[str, int | float]] = {}
-    for code, label in TYPE_LABELS.items():
-        record = stats.get(code, {"count": 0, "minutes": 0, "rating": 0.0})
-        enriched[label] = record
-    return enriched
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
 
 
 def _format_top(tops: dict[str, Any]) -> str:
@@ -183,6 +207,8 @@ def _format_top(tops: dict[str, Any]) -> str:
     sections.append(_format_top_block("Топ кулстори", tops.get("story_count", []), key="total"))
     sections.append(_format_top_block("Топ по времени", tops.get("time", []), key="total_minutes", suffix=" мин"))
     sections.append(_format_rating_block(tops.get("rating_by_type", [])))
+    if tops.get("approximate"):
+        sections.append(TOP_APPROXIMATE_NOTE)
     return "\n\n".join(sections)
 
 
@@ -224,7 +250,7 @@ def _format_rating_block(rows: Any) -> str:
     return "\n".join(lines)
 
 
-async def _handle_top(database: Database, message: Message, args: str | None) -> None:
+async def _handle_top(database: Storage, outbox: Outbox, message: Message, args: str | None) -> None:
     await _ensure_user(database, message)
     period = "week"
     min_records = 5
@@ -237,5 +263,5 @@ async def _handle_top(database: Database, message: Message, args: str | None) ->
 
     tops = await database.global_top(period, min_records)
     text = _format_top(tops)
-    await message.answer(text, reply_markup=main_menu_keyboard())
+    outbox.answer(message, text, reply_markup=main_menu_keyboard())
 
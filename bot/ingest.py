@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, AsyncContextManager, Callable
+
+EVENT_COLUMNS = ("type_id", "user_id", "spent_minutes", "rating")
+
+EventRecord = tuple[int, int, int, int]
+# Database._acquire: те же дедлайны пула и DatabaseBusy, что у одиночных записей.
+Acquire = Callable[[], AsyncContextManager[Any]]
+
+
+class EventBatcher:
+    def __init__(self, acquire: Acquire, *, max_rows: int, max_delay: float) -> None:
+        self._acquire = acquire
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._pending: list[tuple[EventRecord, asyncio.Future[None]]] = []
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closing = False
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="event-batcher")
+
+    async def close(self) -> None:
+        self._closing = True
+        self._has_items.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def submit(self, record: EventRecord) -> None:
+        if self._closing or self._task is None:
+            raise RuntimeError("EventBatcher is not running")
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._pending.append((record, future))
+        self._has_items.set()
+        if len(self._pending) >= self._max_rows:
+            self._full.set()
+        # Ответ пользователю уходит только после коммита его пачки.
+        await future
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self._max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._pending = self._pending, []
+            self._has_items.clear()
+            self._full.clear()
+            if batch:
+                try:
+                    await self._flush(batch)
+                except Exception as err:
+                    # Цикл живёт дальше: иначе все следующие submit() повиснут.
+                    for _, future in batch:
+                        _resolve(future, err)
+            if self._closing and not self._pending:
+                return
+
+    async def _flush(self, batch: list[tuple[EventRecord, asyncio.Future[None]]]) -> None:
+        records = [record for record, _ in batch]
+        try:
+            async with self._acquire() as conn, conn.transaction():
+                await conn.copy_records_to_table("events", records=records, columns=EVENT_COLUMNS)
+                await conn.fetch_prepared("aggregates_batch_upsert", *(list(column) for column in zip(*records)))
+        except Exception as err:
+            if len(batch) == 1:
+                _resolve(batch[0][1], err)
+                return
+            # Одна битая строка не должна ронять всю пачку — досылаем по одной.
+            await self._flush_one_by_one(batch)
+            return
+        for _, future in batch:
+            _resolve(future, None)
+
+    async def _flush_one_by_one(self, batch: list[tuple[EventRecord, asyncio.Future[None]]]) -> None:
+        try:
+            async with self._acquire() as conn:
+                for record, future in batch:
+                    try:
+                        await conn.fetch_prepared("insert_event", *record)
+                    except Exception as err:
+                        _resolve(future, err)
+                    else:
+                        _resolve(future, None)
+        except Exception as err:
+            # Не дали соединение (или оно умерло посреди пачки) — ошибка всем, кто ещё ждёт.
+            for _, future in batch:
+                _resolve(future, err)
+
+
+def _resolve(future: asyncio.Future[None], error: BaseException | None) -> None:
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
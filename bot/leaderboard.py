@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import heapq
+import random
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
+from typing import Any, Iterable, Iterator
+
+PERIOD_DAYS: dict[str, int | None] = {"day": 1, "week": 7, "month": 30, "all": None}
+TYPE_METRICS = ("joke", "story")
+METRICS = (*TYPE_METRICS, "minutes", "events")
+_MAX_WINDOW = max(days for days in PERIOD_DAYS.values() if days is not None)
+
+
+class _Node:
+    __slots__ = ("key", "priority", "left", "right", "size")
+
+    def __init__(self, key: Any) -> None:
+        self.key = key
+        self.priority = random.random()
+        self.left: _Node | None = None
+        self.right: _Node | None = None
+        self.size = 1
+
+
+def _size(node: _Node | None) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node) -> _Node:
+    node.size = 1 + _size(node.left) + _size(node.right)
+    return node
+
+
+def _split(node: _Node | None, key: Any) -> tuple[_Node | None, _Node | None]:
+    # (< key, >= key)
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        return _update(node), right
+    left, right = _split(node.left, key)
+    node.left = right
+    return left, _update(node)
+
+
+def _merge(left: _Node | None, right: _Node | None) -> _Node | None:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _remove(node: _Node | None, key: Any) -> _Node | None:
+    if node is None:
+        return None
+    if key == node.key:
+        return _merge(node.left, node.right)
+    if key < node.key:
+        node.left = _remove(node.left, key)
+    else:
+        node.right = _remove(node.right, key)
+    return _update(node)
+
+
+class RankedSet:
+    # Декартово дерево с размерами поддеревьев: вставка, удаление и
+    # порядковые запросы за O(log n).
+
+    def __init__(self) -> None:
+        self._root: _Node | None = None
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def add(self, key: Any) -> None:
+        left, right = _split(self._root, key)
+        self._root = _merge(_merge(left, _Node(key)), right)
+
+    def remove(self, key: Any) -> None:
+        self._root = _remove(self._root, key)
+
+    def count_less(self, key: Any) -> int:
+        count = 0
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                count += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def head(self, limit: int) -> list[Any]:
+        return list(islice(self, limit))
+
+    def __iter__(self) -> Iterator[Any]:
+        stack: list[_Node] = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.key
+            node = node.right
+
+
+class _Board:
+    def __init__(self) -> None:
+        self.scores: dict[str, dict[int, int]] = {metric: {} for metric in METRICS}
+        self.ranked: dict[str, RankedSet] = {metric: RankedSet() for metric in METRICS}
+
+    def add(self, metric: str, user_id: int, delta: int) -> None:
+        scores = self.scores[metric]
+        ranked = self.ranked[metric]
+        old = scores.get(user_id, 0)
+        if old:
+            ranked.remove((-old, user_id))
+        new = old + delta
+        if new > 0:
+            scores[user_id] = new
+            ranked.add((-new, user_id))
+        else:
+            scores.pop(user_id, None)
+
+    def rank(self, metric: str, user_id: int) -> int | None:
+        score = self.scores[metric].get(user_id)
+        if not score:
+            return None
+        # Место = 1 + число пользователей со строго большим счётом.
+        return 1 + self.ranked[metric].count_less((-score, float("-inf")))
+
+    def top(self, metric: str, limit: int, min_records: int = 1) -> list[tuple[int, int]]:
+        # Порог — по событиям своего типа для joke/story и по всем для минут, как HAVING в SQL.
+        ranked = self.ranked[metric]
+        if metric in TYPE_METRICS:
+            # Порог по тому же счёту, по которому отсортировано дерево: подходят ровно первые.
+            eligible = self._eligible(metric, min_records)
+            return [(user_id, -neg_score) for neg_score, user_id in ranked.head(min(limit, eligible))]
+        # Минуты с порогом по событиям: подходящие разбросаны по дереву минут.
+        # Их число известно из дерева событий за O(log n); если их мало, берём
+        # их оттуда и выбираем лучших кучей, иначе идём по дереву минут — там
+        # подходящие попадаются часто и скан быстро набирает limit.
+        eligible = self._eligible("events", min_records)
+        scores = self.scores[metric]
+        if eligible * eligible <= limit * len(ranked):
+            users = (user_id for _, user_id in self.ranked["events"].head(eligible))
+            keys = [(-scores[user_id], user_id) for user_id in users if user_id in scores]
+            return [(user_id, -neg_score) for neg_score, user_id in heapq.nsmallest(limit, keys)]
+        counts = self.scores["events"]
+        result: list[tuple[int, int]] = []
+        for neg_score, user_id in ranked:
+            if len(result) >= limit:
+                break
+            if counts.get(user_id, 0) >= min_records:
+                result.append((user_id, -neg_score))
+        return result
+
+    def _eligible(self, metric: str, min_records: int) -> int:
+        # Сколько пользователей набрали по metric не меньше min_records.
+        return self.ranked[metric].count_less((-min_records, float("inf")))
+
+
+class Leaderboard:
+    def __init__(self) -> None:
+        self._boards = {period: _Board() for period in PERIOD_DAYS}
+        self._buckets: dict[date, dict[tuple[str, int], int]] = {}
+        self._names: dict[int, str] = {}
+        self._ratings: dict[str, list[int]] = {}
+        self._today = _utc_today()
+
+    def set_display_name(self, user_id: int, name: str) -> None:
+        self._names[user_id] = name
+
+    def adopt_names(self, other: Leaderboard) -> None:
+        # Имена, выставленные процессом, не старше прочитанных из БД.
+        self._names.update(other._names)
+
+    def record(self, user_id: int, type_code: str, minutes: int, rating: int) -> None:
+        self._advance(_utc_today())
+        self._apply(self._today, user_id, type_code, 1, minutes)
+        totals = self._ratings.setdefault(type_code, [0, 0])
+        totals[0] += rating
+        totals[1] += 1
+
+    def load_day(self, day: date, user_id: int, type_code: str, events: int, minutes: int) -> None:
+        self._advance(_utc_today())
+        if day < self._today - timedelta(days=_MAX_WINDOW - 1):
+            return
+        self._apply(day, user_id, type_code, events, minutes, include_all=False)
+
+    def load_total(self, user_id: int, type_code: str, events: int, minutes: int, rating_sum: int) -> None:
+        board = self._boards["all"]
+        if type_code in TYPE_METRICS:
+            board.add(type_code, user_id, events)
+        board.add("minutes", user_id, minutes)
+        board.add("events", user_id, events)
+        totals = self._ratings.setdefault(type_code, [0, 0])
+        totals[0] += rating_sum
+        totals[1] += events
+
+    def rank(self, period: str, metric: str, user_id: int) -> int | None:
+        self._advance(_utc_today())
+        return self._boards[period].rank(metric, user_id)
+
+    def ranks(self, period: str, user_id: int) -> dict[str, int | None]:
+        return {
+            "joke_rank": self.rank(period, "joke", user_id),
+            "story_rank": self.rank(period, "story", user_id),
+            "time_rank": self.rank(period, "minutes", user_id),
+        }
+
+    def top(self, period: str, limit: int = 10, min_records: int = 1) -> dict[str, list[dict[str, Any]]]:
+        self._advance(_utc_today())
+        board = self._boards[period]
+        return {
+            "joke_count": self._rows(board.top("joke", limit, min_records), "total"),
+            "story_count": self._rows(board.top("story", limit, min_records), "total"),
+            "time": self._rows(board.top("minutes", limit, min_records), "total_minutes"),
+            "rating_by_type": [
+                {"code": code, "avg_rating": round(total / count, 2), "cnt": count}
+                for code, (total, count) in sorted(self._ratings.items())
+                if count and count >= min_records
+            ],
+        }
+
+    def _rows(self, entries: Iterable[tuple[int, int]], key: str) -> list[dict[str, Any]]:
+        return [{"display_name": self._names.get(user_id), key: score} for user_id, score in entries]
+
+    def _apply(
+        self, day: date, user_id: int, type_code: str, events: int, minutes: int, include_all: bool = True
+    ) -> None:
+        bucket = self._buckets.setdefault(day, {})
+        deltas: list[tuple[str, int]] = [("minutes", minutes), ("events", events)]
+        if type_code in TYPE_METRICS:
+            deltas.append((type_code, events))
+        for metric, delta in deltas:
+            key = (metric, user_id)
+            bucket[key] = bucket.get(key, 0) + delta
+            for period, days in PERIOD_DAYS.items():
+                if days is None:
+                    if include_all:
+                        self._boards[period].add(metric, user_id, delta)
+                elif day >= self._today - timedelta(days=days - 1):
+                    self._boards[period].add(metric, user_id, delta)
+
+    def _advance(self, today: date) -> None:
+        if today <= self._today:
+            return
+        # Скользящее окно: вычитаем дни, выпавшие из периода.
+        for period, days in PERIOD_DAYS.items():
+            if days is None:
+                continue
+            old_cutoff = self._today - timedelta(days=days - 1)
+            new_cutoff = today - timedelta(days=days - 1)
+            board = self._boards[period]
+            for day, bucket in self._buckets.items():
+                if old_cutoff <= day < new_cutoff:
+                    for (metric, user_id), amount in bucket.items():
+                        board.add(metric, user_id, -amount)
+        horizon = today - timedelta(days=_MAX_WINDOW - 1)
+        for day in [day for day in self._buckets if day < horizon]:
+            del self._buckets[day]
+        self._today = today
+
+
+def _utc_today() -> date:
+    return datetime.now(timezone.utc).date()
@@ -0,0 +1,418 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Awaitable, Callable, Mapping, TypeVar
+
+import asyncpg
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+slow_query_logger = logging.getLogger("bot.slow_query")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = ([0] * len(self.buckets), [0.0, 0.0])
+        counts, totals = state
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, (total, count)) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {int(count)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {int(count)}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+DB_METHOD_SECONDS = REGISTRY.histogram("bot_db_method_seconds", "Database method latency", ("method",))
+DB_METHOD_ERRORS = REGISTRY.counter("bot_db_method_errors_total", "Database method failures", ("method",))
+SQL_SECONDS = REGISTRY.histogram("bot_sql_seconds", "SQL statement latency", ("statement",))
+SQL_ROWS = REGISTRY.counter("bot_sql_rows_total", "Rows returned by SQL statements", ("statement",))
+SLOW_QUERIES = REGISTRY.counter("bot_sql_slow_total", "Statements over the slow query threshold", ("statement",))
+POOL_WAIT_SECONDS = REGISTRY.histogram("bot_db_pool_wait_seconds", "Time spent waiting for a pool connection")
+DB_SHED = REGISTRY.counter("bot_db_shed_total", "Database calls rejected while overloaded", ("reason",))
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Update processing latency", ("event_type",))
+UPDATE_DB_SECONDS = REGISTRY.histogram("bot_update_db_seconds", "Database time per update", ("event_type",))
+UPDATE_API_SECONDS = REGISTRY.histogram("bot_update_api_seconds", "Telegram API time per update", ("event_type",))
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Handler latency", ("handler",))
+API_SECONDS = REGISTRY.histogram("bot_telegram_api_seconds", "Telegram API request latency", ("method",))
+
+
+@dataclass(slots=True)
+class UpdateTimings:
+    db: float = 0.0
+    api: float = 0.0
+    # Ответы через Outbox уходят после возврата хендлера: время API апдейта
+    # записывается, когда доставлен последний из них.
+    pending: int = 0
+    on_done: Callable[[], None] | None = None
+
+    def hold(self) -> None:
+        self.pending += 1
+
+    def release(self) -> None:
+        self.pending -= 1
+        if not self.pending and self.on_done is not None:
+            on_done, self.on_done = self.on_done, None
+            on_done()
+
+
+_update_timings: contextvars.ContextVar[UpdateTimings | None] = contextvars.ContextVar("update_timings", default=None)
+# Вложенность timed_method: в время апдейта идёт только внешний вызов,
+# иначе weekly_summary → personal_stats посчитались бы дважды.
+_db_depth: contextvars.ContextVar[int] = contextvars.ContextVar("db_depth", default=0)
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def current_update_timings() -> UpdateTimings | None:
+    return _update_timings.get()
+
+
+def bind_update_timings(timings: UpdateTimings | None) -> contextvars.Token[UpdateTimings | None]:
+    return _update_timings.set(timings)
+
+
+def unbind_update_timings(token: contextvars.Token[UpdateTimings | None]) -> None:
+    _update_timings.reset(token)
+
+
+def timed_method(func: F) -> F:
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        depth = _db_depth.get()
+        token = _db_depth.set(depth + 1)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_METHOD_ERRORS.inc(method=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _db_depth.reset(token)
+            DB_METHOD_SECONDS.observe(elapsed, method=name)
+            timings = _update_timings.get()
+            if timings is not None and depth == 0:
+                timings.db += elapsed
+
+    return wrapper  # type: ignore[return-value]
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_label(query: str) -> str:
+    return _WHITESPACE.sub(" ", query).strip()[:80]
+
+
+class SlowQueryExplainer:
+    # EXPLAIN ANALYZE повторяет запрос, поэтому не в запросе пользователя: в
+    # фоне, на другом соединении, по одному, не чаще раза в interval на
+    # оператор и с таймаутом. Для полного охвата — auto_explain в Postgres.
+
+    def __init__(
+        self, acquire: Callable[[], AsyncContextManager[Any]], *, interval: float = 300.0, timeout: float = 5.0
+    ) -> None:
+        self._acquire = acquire
+        self._interval = interval
+        self._timeout = timeout
+        self._explained_at: dict[str, float] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def submit(self, query: str, args: tuple[Any, ...], elapsed: float) -> None:
+        label = statement_label(query)
+        now = time.monotonic()
+        if (
+            not _is_read_only(query)
+            or self._task is not None
+            or now - self._explained_at.get(label, float("-inf")) < self._interval
+        ):
+            slow_query_logger.warning("slow query %.1f ms: %s", elapsed * 1000, label)
+            return
+        self._explained_at[label] = now
+        self._task = asyncio.create_task(self._explain(query, args, elapsed))
+        self._task.add_done_callback(self._done)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _done(self, task: asyncio.Task[None]) -> None:
+        self._task = None
+
+    async def _explain(self, query: str, args: tuple[Any, ...], elapsed: float) -> None:
+        label = statement_label(query)
+        try:
+            async with self._acquire() as conn:
+                # Медленный EXPLAIN не должен объяснять сам себя.
+                rows = await conn.fetch_uninstrumented(
+                    f"EXPLAIN (ANALYZE, BUFFERS) {query}", *args, timeout=self._timeout
+                )
+        except Exception as err:
+            slow_query_logger.warning("slow query %.1f ms: %s (EXPLAIN failed: %r)", elapsed * 1000, label, err)
+            return
+        plan = "\n".join(row[0] for row in rows)
+        slow_query_logger.warning("slow query %.1f ms: %s\n%s", elapsed * 1000, label, plan)
+
+
+def _is_read_only(query: str) -> bool:
+    head = query.lstrip().split(None, 1)[0].upper() if query.strip() else ""
+    return head in {"SELECT", "WITH"} and not re.search(r"\b(INSERT|UPDATE|DELETE)\b", query, re.IGNORECASE)
+
+
+class InstrumentedConnection(asyncpg.Connection):
+    slow_query_threshold: float | None = None
+    slow_query_explainer: SlowQueryExplainer | None = None
+    statement_timeouts: Mapping[str, float] = {}
+
+    async def prepare_statements(self, statements: Mapping[str, str]) -> None:
+        # PreparedStatement из init пула умирает при первом возврате соединения
+        # в пул: держим только текст, а план живёт в кеше запросов asyncpg.
+        # Подготовка здесь лишь проверяет, что каждый запрос вообще собирается.
+        for name, query in statements.items():
+            try:
+                await self.prepare(query)
+            except asyncpg.PostgresError as err:
+                raise RuntimeError(f"Failed to prepare statement {name!r}: {err}") from err
+        self.statements = dict(statements)
+
+    async def fetch_prepared(self, name: str, *args: Any) -> list[Any]:
+        query = self.statements[name]
+        call = super().fetch(query, *args, timeout=self.statement_timeouts.get(name))
+        return await self._timed(query, args, call, label=name)
+
+    async def fetchrow_prepared(self, name: str, *args: Any) -> Any:
+        query = self.statements[name]
+        call = super().fetchrow(query, *args, timeout=self.statement_timeouts.get(name))
+        return await self._timed(query, args, call, label=name)
+
+    async def fetchval_prepared(self, name: str, *args: Any) -> Any:
+        query = self.statements[name]
+        call = super().fetchval(query, *args, timeout=self.statement_timeouts.get(name))
+        return await self._timed(query, args, call, label=name)
+
+    async def execute(self, query: str, *args: Any, timeout: float | None = None) -> str:
+        return await self._timed(query, args, super().execute(query, *args, timeout=timeout))
+
+    async def executemany(self, command: str, args: Any, *, timeout: float | None = None) -> None:
+        return await self._timed(command, (), super().executemany(command, args, timeout=timeout))
+
+    async def fetch(self, query: str, *args: Any, timeout: float | None = None, record_class: Any = None) -> list[Any]:
+        return await self._timed(query, args, super().fetch(query, *args, timeout=timeout, record_class=record_class))
+
+    async def fetchrow(self, query: str, *args: Any, timeout: float | None = None, record_class: Any = None) -> Any:
+        return await self._timed(query, args, super().fetchrow(query, *args, timeout=timeout, record_class=record_class))
+
+    async def fetchval(self, query: str, *args: Any, column: int = 0, timeout: float | None = None) -> Any:
+        return await self._timed(query, args, super().fetchval(query, *args, column=column, timeout=timeout))
+
+    async def fetch_uninstrumented(self, query: str, *args: Any, timeout: float | None = None) -> list[Any]:
+        # Без метрик и порога медленных запросов — для служебных запросов вроде EXPLAIN.
+        return await super().fetch(query, *args, timeout=timeout)
+
+    async def _timed(
+        self, query: str, args: tuple[Any, ...], call: Awaitable[Any], label: str | None = None
+    ) -> Any:
+        label = label or statement_label(query)
+        started = time.perf_counter()
+        result = await call
+        elapsed = time.perf_counter() - started
+        SQL_SECONDS.observe(elapsed, statement=label)
+        if isinstance(result, list):
+            SQL_ROWS.inc(len(result), statement=label)
+        elif result is not None and not isinstance(result, str):
+            SQL_ROWS.inc(1, statement=label)
+        threshold = self.slow_query_threshold
+        if threshold is not None and elapsed >= threshold:
+            SLOW_QUERIES.inc(statement=label)
+            if self.slow_query_explainer is not None:
+                self.slow_query_explainer.submit(query, args, elapsed)
+            else:
+                slow_query_logger.warning("slow query %.1f ms: %s", elapsed * 1000, label)
+        return result
+
+
+def observe_pool_wait(seconds: float) -> None:
+    POOL_WAIT_SECONDS.observe(seconds)
+
+
+def observe_shed(reason: str) -> None:
+    DB_SHED.inc(reason=reason)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        event_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        timings = UpdateTimings()
+        token = _update_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, event_type=event_type)
+            UPDATE_DB_SECONDS.observe(timings.db, event_type=event_type)
+            _update_timings.reset(token)
+            if timings.pending:
+                timings.on_done = functools.partial(_observe_update_api, timings, event_type)
+            else:
+                _observe_update_api(timings, event_type)
+
+
+def _observe_update_api(timings: UpdateTimings, event_type: str) -> None:
+    UPDATE_API_SECONDS.observe(timings.api, event_type=event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            API_SECONDS.observe(elapsed, method=type(method).__name__)
+            timings = _update_timings.get()
+            if timings is not None:
+                timings.api += elapsed
+
+
+def setup_metrics(dp: Dispatcher, bot: Bot) -> None:
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+from .cache import TTLCache
+from .metrics import UpdateTimings, bind_update_timings, current_update_timings, unbind_update_timings
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BROADCAST = 1
+LANES = (INTERACTIVE, BROADCAST)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+@dataclass(slots=True)
+class _Outgoing:
+    kwargs: dict[str, Any]
+    coalesce_key: str | None = None
+    attempts: int = field(default=0)
+    timings: UpdateTimings | None = None
+    on_failure: Callable[[int], None] | None = None
+
+
+class Outbox:
+    # Все ответы бота идут через очередь: лимиты Telegram на чат и на бота
+    # соблюдаются заранее, а не через шторм 429.
+
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_in_flight: int = 32,
+        max_attempts: int = 3,
+    ) -> None:
+        self._bot = bot
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        # Корзина, не трогавшаяся дольше времени полного пополнения, равна новой.
+        self._chat_buckets: TTLCache[int, TokenBucket] = TTLCache(maxsize=100_000, ttl=chat_burst / chat_rate)
+        # retry_after от Telegram живёт дольше корзины в кеше — держим его отдельно.
+        self._blocked_until: dict[int, float] = {}
+        self._queues: dict[int, dict[int, deque[_Outgoing]]] = {lane: {} for lane in LANES}
+        self._in_flight: set[int] = set()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Очередь + в полёте по каждой полосе: рассылка ждёт, пока её пачка уйдёт.
+        self._lane_busy = {lane: 0 for lane in LANES}
+        self._lane_idle = {lane: asyncio.Event() for lane in LANES}
+        for event in self._lane_idle.values():
+            event.set()
+        self._task: asyncio.Task[None] | None = None
+        self._deliveries: set[asyncio.Task[None]] = set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            await self._idle.wait()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def answer(self, message: Message, text: str, *, coalesce_key: str | None = None, **kwargs: Any) -> None:
+        self.send(message.chat.id, text, coalesce_key=coalesce_key, **kwargs)
+
+    def reply(self, message: Message, text: str, **kwargs: Any) -> None:
+        self.send(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def send(
+        self,
+        chat_id: int,
+        text: str,
+        *,
+        lane: int = INTERACTIVE,
+        coalesce_key: str | None = None,
+        on_failure: Callable[[int], None] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        queue = self._queues[lane].setdefault(chat_id, deque())
+        payload = {"chat_id": chat_id, "text": text, **kwargs}
+        timings = current_update_timings()
+        if timings is not None:
+            timings.hold()
+        if coalesce_key is not None:
+            # Несколько сводок подряд в один чат схлопываются в последнюю.
+            for item in queue:
+                if item.coalesce_key == coalesce_key:
+                    item.kwargs = payload
+                    # Схлопнутый ответ больше не держит метрики своего апдейта.
+                    if item.timings is not None:
+                        item.timings.release()
+                    item.timings = timings
+                    item.on_failure = on_failure
+                    return
+        queue.append(_Outgoing(kwargs=payload, coalesce_key=coalesce_key, timings=timings, on_failure=on_failure))
+        self._lane_busy[lane] += 1
+        self._lane_idle[lane].clear()
+        self._idle.clear()
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return sum(len(queue) for queues in self._queues.values() for queue in queues.values())
+
+    async def drain(self, lane: int) -> None:
+        await self._lane_idle[lane].wait()
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            picked, wait = self._pick(now)
+            if picked is None:
+                if not self._in_flight and not self.pending():
+                    self._idle.set()
+                    self._blocked_until = {
+                        chat_id: until for chat_id, until in self._blocked_until.items() if until > now
+                    }
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self._global.delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            lane, chat_id = picked
+            await self._slots.acquire()
+            now = time.monotonic()
+            self._global.take(now)
+            self._chat_bucket(chat_id).take(now)
+            item = self._pop(lane, chat_id)
+            self._in_flight.add(chat_id)
+            task = asyncio.create_task(self._deliver(lane, chat_id, item))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    def _pick(self, now: float) -> tuple[tuple[int, int] | None, float | None]:
+        wait: float | None = None
+        for lane in LANES:
+            for chat_id in self._queues[lane]:
+                if chat_id in self._in_flight:
+                    continue
+                delay = self._chat_delay(chat_id, now)
+                if delay == 0:
+                    return (lane, chat_id), None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _pop(self, lane: int, chat_id: int) -> _Outgoing:
+        queues = self._queues[lane]
+        queue = queues.pop(chat_id)
+        item = queue.popleft()
+        if queue:
+            # В конец очереди чатов — чтобы один болтливый чат не занимал всех.
+            queues[chat_id] = queue
+        return item
+
+    def _chat_delay(self, chat_id: int, now: float) -> float:
+        blocked_until = self._blocked_until.get(chat_id)
+        if blocked_until is not None:
+            if blocked_until > now:
+                return blocked_until - now
+            del self._blocked_until[chat_id]
+        return self._chat_bucket(chat_id).delay(now)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _deliver(self, lane: int, chat_id: int, item: _Outgoing) -> None:
+        requeued = False
+        failed = False
+        # Время отправки идёт в апдейт, который поставил ответ в очередь.
+        token = bind_update_timings(item.timings)
+        try:
+            item.attempts += 1
+            await self._bot.send_message(**item.kwargs)
+        except TelegramRetryAfter as err:
+            blocked_until = time.monotonic() + err.retry_after
+            self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), blocked_until)
+            if item.attempts < self._max_attempts:
+                self._queues[lane].setdefault(chat_id, deque()).appendleft(item)
+                requeued = True
+            else:
+                logger.warning("Dropping message to chat %s after %s attempts", chat_id, item.attempts)
+                failed = True
+        except Exception:
+            logger.exception("Failed to send message to chat %s", chat_id)
+            failed = True
+        finally:
+            unbind_update_timings(token)
+            if not requeued:
+                if failed and item.on_failure is not None:
+                    item.on_failure(chat_id)
+                if item.timings is not None:
+                    item.timings.release()
+                self._lane_busy[lane] -= 1
+                if not self._lane_busy[lane]:
+                    self._lane_idle[lane].set()
+            self._in_flight.discard(chat_id)
+            self._slots.release()
+            self._wakeup.set()
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from multiprocessing.queues import Queue
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import GetUpdates
+from aiogram.types import Update
+
+from .app import build_bot, build_database, build_digest, build_outbox, build_storage, log_startup
+from .config import settings
+from .handlers import register_handlers
+from .metrics import setup_metrics, start_metrics_server
+from .webhook import serve_webhook
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+POLL_TIMEOUT = 30
+
+
+def shard_for(payload: dict[str, Any], shards: int) -> int:
+    for key, value in payload.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for owner in ("from", "user", "chat"):
+            entity = value.get(owner)
+            if isinstance(entity, dict) and "id" in entity:
+                return int(entity["id"]) % shards
+    return 0
+
+
+class ShardRouter:
+    def __init__(self, queues: list[Queue[str | None]]) -> None:
+        self._queues = queues
+
+    async def submit(self, payload: dict[str, Any]) -> None:
+        target = self._queues[shard_for(payload, len(self._queues))]
+        data = json.dumps(payload, ensure_ascii=False)
+        try:
+            target.put_nowait(data)
+        except queue.Full:
+            # Воркер не успевает — ждём места, не читая новые апдейты.
+            await asyncio.get_running_loop().run_in_executor(None, target.put, data)
+
+    async def stop(self) -> None:
+        loop = asyncio.get_running_loop()
+        for target in self._queues:
+            await loop.run_in_executor(None, target.put, None)
+
+
+async def run_sharded(workers: int) -> None:
+    if settings.storage != "postgres":
+        # Колонки в памяти у каждого процесса свои — шардам нужна общая БД.
+        raise RuntimeError("WORKERS > 1 requires STORAGE=postgres")
+    context = multiprocessing.get_context("spawn")
+    queues: list[Queue[str | None]] = [context.Queue(maxsize=settings.update_queue_size) for _ in range(workers)]
+    processes = [
+        context.Process(target=worker_process, args=(index, workers, queues[index]), name=f"bot-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    loop = asyncio.get_running_loop()
+    current = asyncio.current_task()
+    assert current is not None
+    loop.add_signal_handler(signal.SIGTERM, current.cancel)
+
+    bot = build_bot()
+    router = ShardRouter(queues)
+    try:
+        if settings.run_mode == "webhook":
+            if not settings.webhook_url:
+                raise RuntimeError("WEBHOOK_URL is required in webhook mode")
+            await serve_webhook(
+                bot,
+                router.submit,
+                url=settings.webhook_url,
+                path=settings.webhook_path,
+                host=settings.webhook_host,
+                port=settings.webhook_port,
+                secret=settings.webhook_secret,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            await _poll(bot, router)
+    finally:
+        # Плавная остановка: воркеры дорабатывают всё, что уже в очередях.
+        await router.stop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        await bot.session.close()
+
+
+async def _poll(bot: Bot, router: ShardRouter) -> None:
+    await bot.delete_webhook()
+    offset: int | None = None
+    try:
+        while True:
+            try:
+                updates = await bot(
+                    GetUpdates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=ALLOWED_UPDATES),
+                    request_timeout=POLL_TIMEOUT + 10,
+                )
+            except Exception:
+                logger.exception("getUpdates failed")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await router.submit(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            await _confirm_offset(bot, offset)
+
+
+async def _confirm_offset(bot: Bot, offset: int) -> None:
+    # Telegram считает апдейт полученным только по следующему getUpdates с
+    # большим offset. Без него после рестарта последняя пачка придёт снова.
+    try:
+        await bot(GetUpdates(offset=offset, limit=1, timeout=0, allowed_updates=ALLOWED_UPDATES))
+    except Exception:
+        logger.exception("Failed to confirm update offset %s", offset)
+
+
+def worker_process(index: int, shards: int, updates: Queue[str | None]) -> None:
+    # Ctrl+C получает вся группа процессов; останавливает воркеры только ingress.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(index, shards, updates))
+
+
+class _OrderedFeeder:
+    # Апдейты разных пользователей идут параллельно, одного — строго по порядку.
+
+    def __init__(self, dp: Dispatcher, bot: Bot, *, concurrency: int) -> None:
+        self._dp = dp
+        self._bot = bot
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails: dict[int, asyncio.Task[None]] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def submit(self, update: Update) -> None:
+        await self._slots.acquire()
+        from_user = getattr(update.event, "from_user", None)
+        key = from_user.id if from_user is not None else 0
+        task = asyncio.create_task(self._process(update, key, self._tails.get(key)))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self) -> None:
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _process(self, update: Update, key: int, previous: asyncio.Task[None] | None) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self._dp.feed_update(self._bot, update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+        finally:
+            self._slots.release()
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+
+async def _worker(index: int, shards: int, updates: Queue[str | None]) -> None:
+    started = time.perf_counter()
+    bot = build_bot()
+    storage = build_storage(shared=True)
+    dp = Dispatcher(storage=storage)
+    # Лидерборд в памяти видел бы только свой шард — читаем топы из БД.
+    database = build_database(leaderboard=False, shard=index)
+    await database.connect()
+    outbox = build_outbox(bot, share=shards)
+    outbox.start()
+    register_handlers(dp, database, outbox)
+    setup_metrics(dp, bot)
+    metrics_runner = None
+    if settings.metrics_port is not None:
+        metrics_runner = await start_metrics_server(settings.metrics_host, settings.metrics_port + index + 1)
+    log_startup(started, database, name=f"worker {index}")
+
+    # Рассылку ведёт только первый воркер, иначе каждый шард отправил бы её заново.
+    digest = build_digest(database, outbox) if settings.digest_enabled and index == 0 else None
+    if digest is not None:
+        digest.start()
+
+    feeder = _OrderedFeeder(dp, bot, concurrency=settings.update_workers)
+    loop = asyncio.get_running_loop()
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await feeder.submit(Update.model_validate_json(data, context={"bot": bot}))
+        await feeder.drain()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        if digest is not None:
+            await digest.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await outbox.close()
+        await storage.close()
+        await database.close()
+        await bot.session.close()
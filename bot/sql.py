@@ -0,0 +1,488 @@
+from .leaderboard import PERIOD_DAYS
+
+# Измерения гистограмм user_histogram (/me details).
+HIST_RATING = 1
+HIST_MINUTES = 2
+HIST_DOW = 3
+HIST_HOUR = 4
+HIST_DIMENSIONS = {
+    "rating": HIST_RATING,
+    "minutes": HIST_MINUTES,
+    "dow": HIST_DOW,
+    "hour": HIST_HOUR,
+}
+# Нижние границы корзин по минутам: 1-5, 6-10, 11-20, 21-30, 31-60, 61+.
+MINUTES_BUCKETS = (1, 6, 11, 21, 31, 61)
+
+_MINUTES_BUCKET_ARRAY = "ARRAY[{}]".format(", ".join(str(bound) for bound in MINUTES_BUCKETS))
+
+
+# Агрегаты пишутся из любого источника строк (user_id, type_id, spent_minutes,
+# rating, happened_at) в том же запросе, что и сами события.
+def _rollup_upsert(source: str) -> str:
+    return f"""
+        INSERT INTO user_type_daily (user_id, type_id, day, events, minutes, rating_sum)
+        SELECT user_id, type_id, (happened_at AT TIME ZONE 'UTC')::date, COUNT(*), SUM(spent_minutes), SUM(rating)
+        FROM {source}
+        GROUP BY 1, 2, 3
+        ON CONFLICT (user_id, type_id, day) DO UPDATE
+        SET events = user_type_daily.events + EXCLUDED.events,
+            minutes = user_type_daily.minutes + EXCLUDED.minutes,
+            rating_sum = user_type_daily.rating_sum + EXCLUDED.rating_sum
+    """
+
+
+# День недели и час считаем в UTC, как и дневные агрегаты. Единственное место,
+# где события раскладываются по корзинам гистограмм.
+def _histogram_upsert(source: str, table: str = "user_histogram") -> str:
+    return f"""
+        INSERT INTO {table} (user_id, dim, bucket, events, minutes)
+        SELECT s.user_id, h.dim, h.bucket, COUNT(*), SUM(s.spent_minutes)
+        FROM {source} s
+        CROSS JOIN LATERAL (VALUES
+            ({HIST_RATING}, s.rating::int),
+            ({HIST_MINUTES}, width_bucket(s.spent_minutes, {_MINUTES_BUCKET_ARRAY})),
+            ({HIST_DOW}, EXTRACT(DOW FROM s.happened_at AT TIME ZONE 'UTC')::int),
+            ({HIST_HOUR}, EXTRACT(HOUR FROM s.happened_at AT TIME ZONE 'UTC')::int)
+        ) AS h(dim, bucket)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (user_id, dim, bucket) DO UPDATE
+        SET events = {table}.events + EXCLUDED.events,
+            minutes = {table}.minutes + EXCLUDED.minutes
+    """
+
+
+# Серии дней двигаются только вперёд: событие за уже учтённый день ничего не
+# пишет. Исторический импорт пересчитывает серии через ACTIVITY_REBUILD.
+def _activity_upsert(source: str) -> str:
+    return f"""
+        INSERT INTO user_activity (user_id, last_day, current_streak, best_streak, active_days)
+        SELECT user_id, MAX((happened_at AT TIME ZONE 'UTC')::date), 1, 1, 1
+        FROM {source}
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET current_streak = CASE WHEN EXCLUDED.last_day = user_activity.last_day + 1
+                                  THEN user_activity.current_streak + 1 ELSE 1 END,
+            best_streak = GREATEST(
+                user_activity.best_streak,
+                CASE WHEN EXCLUDED.last_day = user_activity.last_day + 1
+                     THEN user_activity.current_streak + 1 ELSE 1 END
+            ),
+            active_days = user_activity.active_days + 1,
+            last_day = EXCLUDED.last_day
+        WHERE EXCLUDED.last_day > user_activity.last_day
+    """
+
+
+def _record_events(source: str) -> str:
+    return f"""
+        rollup AS ({_rollup_upsert(source)}),
+        histogram AS ({_histogram_upsert(source)}),
+        activity AS ({_activity_upsert(source)})
+    """
+
+
+def _insert_event(values: str) -> str:
+    return f"""
+        WITH ins AS (
+            INSERT INTO events (type_id, user_id, spent_minutes, rating)
+            {values}
+            RETURNING type_id, user_id, spent_minutes, rating, happened_at
+        ),
+        {_record_events("ins")}
+        SELECT type_id FROM ins
+    """
+
+
+INSERT_EVENT = _insert_event("VALUES ($1, $2, $3, $4)")
+
+INSERT_EVENT_BY_CODE = _insert_event("SELECT id, $2, $3, $4 FROM types WHERE code = $1")
+
+# happened_at у строк из COPY — CURRENT_TIMESTAMP транзакции, поэтому день
+# берём оттуда же.
+AGGREGATES_BATCH_UPSERT = f"""
+    WITH batch AS (
+        SELECT b.type_id, b.user_id, b.spent_minutes, b.rating, CURRENT_TIMESTAMP AS happened_at
+        FROM unnest($1::smallint[], $2::bigint[], $3::int[], $4::int[]) AS b(type_id, user_id, spent_minutes, rating)
+    ),
+    {_record_events("batch")}
+    SELECT COUNT(*) FROM batch
+"""
+
+BACKFILL_ROLLUP = """
+    INSERT INTO user_type_daily (user_id, type_id, day, events, minutes, rating_sum)
+    SELECT user_id, type_id, (happened_at AT TIME ZONE 'UTC')::date,
+           COUNT(*), SUM(spent_minutes), SUM(rating)
+    FROM events
+    GROUP BY 1, 2, 3
+"""
+
+ROLLUP_RANGE_DELETE = """
+    DELETE FROM user_type_daily WHERE day >= $1 AND day < $2
+"""
+
+# Перед отцеплением партиции её месяц пересчитывается в user_type_daily.
+ROLLUP_PARTITION = """
+    INSERT INTO user_type_daily (user_id, type_id, day, events, minutes, rating_sum)
+    SELECT user_id, type_id, (happened_at AT TIME ZONE 'UTC')::date,
+           COUNT(*), SUM(spent_minutes), SUM(rating)
+    FROM {partition}
+    GROUP BY 1, 2, 3
+"""
+
+IMPORT_USERS = """
+    INSERT INTO users (id, username, first_name)
+    SELECT id, username, first_name FROM import_users
+    ON CONFLICT (id) DO NOTHING
+"""
+
+IMPORT_STAGE = """
+    CREATE TEMP TABLE import_events (
+        type_id SMALLINT, user_id BIGINT, spent_minutes INT, rating SMALLINT, happened_at TIMESTAMPTZ
+    ) ON COMMIT DROP
+"""
+
+# Месяцы диапазона импорта, уже отправленные в архив ретеншеном: живой
+# партиции нет, а данные остались в агрегатах или в archive.events_YYYY_MM.
+IMPORT_RETIRED_MONTHS = """
+    SELECT to_char(m.month, 'YYYY-MM') AS month
+    FROM generate_series(date_trunc('month', $1::date), $2::date, INTERVAL '1 month') AS m(month)
+    WHERE to_regclass(format('events_%s', to_char(m.month, 'YYYY_MM'))) IS NULL
+      AND (
+          to_regclass(format('archive.events_%s', to_char(m.month, 'YYYY_MM'))) IS NOT NULL
+          OR EXISTS (
+              SELECT 1 FROM user_type_daily d
+              WHERE d.day >= m.month AND d.day < m.month + INTERVAL '1 month'
+          )
+      )
+    ORDER BY m.month
+"""
+
+# Импорт идёт через временную таблицу, чтобы агрегаты считались тем же SQL,
+# что и у живых событий. Серии пересчитывает ACTIVITY_REBUILD.
+IMPORT_EVENTS = f"""
+    WITH ins AS (
+        INSERT INTO events (type_id, user_id, spent_minutes, rating, happened_at)
+        SELECT type_id, user_id, spent_minutes, rating, happened_at FROM import_events
+        RETURNING type_id, user_id, spent_minutes, rating, happened_at
+    ),
+    rollup AS ({_rollup_upsert("ins")}),
+    histogram AS ({_histogram_upsert("ins")})
+    SELECT COUNT(*) FROM ins
+"""
+
+# Гистограммы — за всё время, а сырые события отцепленных партиций уже не в
+# events: их вклад копится в user_histogram_archive при отцеплении.
+HISTOGRAM_ARCHIVE_PARTITION = _histogram_upsert("{partition}", "user_histogram_archive")
+
+BACKFILL_HISTOGRAM_ARCHIVE = """
+    INSERT INTO user_histogram (user_id, dim, bucket, events, minutes)
+    SELECT user_id, dim, bucket, events, minutes FROM user_histogram_archive
+"""
+
+BACKFILL_HISTOGRAM = _histogram_upsert("events")
+
+# Серии пересчитываются из дневных агрегатов: они переживают отцепление
+# партиций. $1 — список пользователей или NULL для всех.
+ACTIVITY_REBUILD = """
+    WITH days AS (
+        SELECT DISTINCT user_id, day
+        FROM user_type_daily
+        WHERE $1::bigint[] IS NULL OR user_id = ANY($1::bigint[])
+    ),
+    runs AS (
+        SELECT user_id, day, day - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day))::int AS run
+        FROM days
+    ),
+    streaks AS (
+        SELECT user_id, MAX(day) AS last_day, COUNT(*)::int AS length
+        FROM runs
+        GROUP BY user_id, run
+    )
+    INSERT INTO user_activity (user_id, last_day, current_streak, best_streak, active_days)
+    SELECT user_id, MAX(last_day), (ARRAY_AGG(length ORDER BY last_day DESC))[1], MAX(length), SUM(length)
+    FROM streaks
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET last_day = EXCLUDED.last_day,
+        current_streak = EXCLUDED.current_streak,
+        best_streak = EXCLUDED.best_streak,
+        active_days = EXCLUDED.active_days
+"""
+
+EXPORT_EVENTS = """
+    SELECT e.user_id, u.username, u.first_name, t.code AS type, e.spent_minutes, e.rating, e.happened_at
+    FROM events e
+    JOIN users u ON u.id = e.user_id
+    JOIN types t ON t.id = e.type_id
+"""
+
+EXPORT_USER_STATS = """
+    SELECT d.user_id, u.username, u.first_name, t.code AS type,
+           SUM(d.events) AS total_events,
+           SUM(d.minutes) AS total_minutes,
+           ROUND(SUM(d.rating_sum)::numeric / NULLIF(SUM(d.events), 0), 2) AS avg_rating
+    FROM user_type_daily d
+    JOIN users u ON u.id = d.user_id
+    JOIN types t ON t.id = d.type_id
+    GROUP BY d.user_id, u.username, u.first_name, t.code
+"""
+
+UPSERT_USER = """
+    INSERT INTO users (id, username, first_name)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name
+    WHERE users.username IS DISTINCT FROM EXCLUDED.username
+       OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+    RETURNING id, username, first_name, joined_at
+"""
+
+SELECT_USER = """
+    SELECT id, username, first_name, joined_at FROM users WHERE id = $1
+"""
+
+SELECT_TYPES = """
+    SELECT id, code FROM types
+"""
+
+SELECT_HISTOGRAM = """
+    SELECT dim, bucket, events, minutes FROM user_histogram WHERE user_id = $1
+"""
+
+SELECT_ACTIVITY = """
+    SELECT last_day, current_streak, best_streak, active_days FROM user_activity WHERE user_id = $1
+"""
+
+SEED_NAMES = """
+    SELECT id, COALESCE(username, first_name) AS display_name FROM users
+"""
+
+SEED_TOTALS = """
+    SELECT d.user_id, t.code, SUM(d.events) AS events, SUM(d.minutes) AS minutes,
+           SUM(d.rating_sum) AS rating_sum
+    FROM user_type_daily d
+    JOIN types t ON t.id = d.type_id
+    GROUP BY d.user_id, t.code
+"""
+
+
+def _window_start(days: int) -> str:
+    # Окно в N дней — сегодня и N-1 предыдущих суток (UTC): агрегаты дневные.
+    return f"(CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date - {days - 1}"
+
+
+def _since(days: int | None) -> str:
+    if days is None:
+        return ""
+    return f" AND d.day >= {_window_start(days)}"
+
+
+SEED_DAYS = f"""
+    SELECT d.user_id, t.code, d.day, d.events, d.minutes
+    FROM user_type_daily d
+    JOIN types t ON t.id = d.type_id
+    WHERE TRUE{_since(PERIOD_DAYS["month"])}
+"""
+
+
+# Всё, что старше самого длинного окна, схлопывается в одну строку с day = NULL.
+USER_STATS_HYDRATE = f"""
+    SELECT t.code,
+           CASE WHEN d.day >= {_window_start(PERIOD_DAYS["month"])}
+                THEN d.day END AS day,
+           SUM(d.events)::int AS events,
+           SUM(d.minutes)::bigint AS minutes,
+           SUM(d.rating_sum)::bigint AS rating_sum
+    FROM user_type_daily d
+    JOIN types t ON t.id = d.type_id
+    WHERE d.user_id = $1
+    GROUP BY 1, 2
+"""
+
+
+def _personal_stats(days: int | None) -> str:
+    return f"""
+        SELECT t.code,
+               SUM(d.events) AS total_events,
+               COALESCE(SUM(d.minutes), 0) AS total_minutes,
+               ROUND(SUM(d.rating_sum)::numeric / NULLIF(SUM(d.events), 0), 2) AS avg_rating
+        FROM user_type_daily d
+        JOIN types t ON t.id = d.type_id
+        WHERE d.user_id = $1{_since(days)}
+        GROUP BY t.code
+        ORDER BY t.code
+    """
+
+
+# Сначала агрегат и LIMIT по одному покрывающему индексу user_type_daily,
+# потом имена только для десятки, а не JOIN всей таблицы users.
+def _top_count(type_code: str, days: int | None) -> str:
+    return f"""
+        SELECT COALESCE(u.username, u.first_name) AS display_name, top.total
+        FROM (
+            SELECT d.user_id, SUM(d.events) AS total
+            FROM user_type_daily d
+            WHERE d.type_id = (SELECT id FROM types WHERE code = '{type_code}'){_since(days)}
+            GROUP BY d.user_id
+            HAVING SUM(d.events) >= $1
+            ORDER BY total DESC
+            LIMIT 10
+        ) top
+        JOIN users u ON u.id = top.user_id
+        ORDER BY top.total DESC
+    """
+
+
+def _top_time(days: int | None) -> str:
+    return f"""
+        SELECT COALESCE(u.username, u.first_name) AS display_name, top.total_minutes
+        FROM (
+            SELECT d.user_id, SUM(d.minutes) AS total_minutes
+            FROM user_type_daily d
+            WHERE TRUE{_since(days)}
+            GROUP BY d.user_id
+            HAVING SUM(d.events) >= $1
+            ORDER BY total_minutes DESC
+            LIMIT 10
+        ) top
+        JOIN users u ON u.id = top.user_id
+        ORDER BY top.total_minutes DESC
+    """
+
+
+RATING_BY_TYPE = """
+    SELECT t.code,
+           ROUND(SUM(d.rating_sum)::numeric / NULLIF(SUM(d.events), 0), 2) AS avg_rating,
+           SUM(d.events) AS cnt
+    FROM user_type_daily d
+    JOIN types t ON t.id = d.type_id
+    GROUP BY t.code
+    HAVING SUM(d.events) >= $1
+    ORDER BY t.code
+"""
+
+# Личная статистика и все три места одним запросом: место считаем как число
+# пользователей строго впереди, без ранжирования всех подряд.
+WEEKLY_SUMMARY = f"""
+    WITH totals AS (
+        SELECT d.user_id,
+               SUM(d.events) FILTER (WHERE t.code = 'joke') AS jokes,
+               SUM(d.events) FILTER (WHERE t.code = 'story') AS stories,
+               SUM(d.minutes) AS minutes
+        FROM user_type_daily d
+        JOIN types t ON t.id = d.type_id
+        WHERE TRUE{_since(PERIOD_DAYS["week"])}
+        GROUP BY d.user_id
+    ),
+    ranks AS (
+        SELECT CASE WHEN me.jokes > 0
+                    THEN 1 + (SELECT COUNT(*) FROM totals o WHERE o.jokes > me.jokes) END AS joke_rank,
+               CASE WHEN me.stories > 0
+                    THEN 1 + (SELECT COUNT(*) FROM totals o WHERE o.stories > me.stories) END AS story_rank,
+               1 + (SELECT COUNT(*) FROM totals o WHERE o.minutes > me.minutes) AS time_rank
+        FROM totals me
+        WHERE me.user_id = $1
+    ),
+    personal AS (
+        SELECT t.code,
+               SUM(d.events) AS total_events,
+               COALESCE(SUM(d.minutes), 0) AS total_minutes,
+               ROUND(SUM(d.rating_sum)::numeric / NULLIF(SUM(d.events), 0), 2) AS avg_rating
+        FROM user_type_daily d
+        JOIN types t ON t.id = d.type_id
+        WHERE d.user_id = $1{_since(PERIOD_DAYS["week"])}
+        GROUP BY t.code
+    )
+    SELECT p.code, p.total_events, p.total_minutes, p.avg_rating,
+           r.joke_rank, r.story_rank, r.time_rank
+    FROM personal p
+    CROSS JOIN ranks r
+    ORDER BY p.code
+"""
+
+
+# Снимок еженедельной рассылки одним запросом: личные итоги и места всех
+# активных за неделю пользователей. Места — RANK(), то есть те же
+# «1 + число строго впереди», что и в WEEKLY_SUMMARY. Окно — семь полных
+# дней до $1, а не от текущей даты: догоняющая или возобновлённая рассылка
+# считает ту же неделю, под которой хранится снимок.
+DIGEST_SNAPSHOT = f"""
+    WITH per_type AS (
+        SELECT d.user_id, t.code,
+               SUM(d.events)::bigint AS events,
+               SUM(d.minutes)::bigint AS minutes,
+               ROUND(SUM(d.rating_sum)::numeric / NULLIF(SUM(d.events), 0), 2) AS avg_rating
+        FROM user_type_daily d
+        JOIN types t ON t.id = d.type_id
+        WHERE d.day >= $1::date - {PERIOD_DAYS["week"]} AND d.day < $1::date
+        GROUP BY d.user_id, t.code
+    ),
+    totals AS (
+        SELECT user_id,
+               SUM(events) FILTER (WHERE code = 'joke') AS jokes,
+               SUM(events) FILTER (WHERE code = 'story') AS stories,
+               SUM(minutes) AS total_minutes,
+               array_agg(code ORDER BY code) AS codes,
+               array_agg(events ORDER BY code) AS events,
+               array_agg(minutes ORDER BY code) AS minutes,
+               array_agg(avg_rating ORDER BY code) AS avg_ratings
+        FROM per_type
+        GROUP BY user_id
+    )
+    INSERT INTO weekly_digest (week, user_id, codes, events, minutes, avg_ratings, joke_rank, story_rank, time_rank)
+    SELECT $1, user_id, codes, events, minutes, avg_ratings,
+           CASE WHEN jokes > 0 THEN RANK() OVER (ORDER BY jokes DESC NULLS LAST) END,
+           CASE WHEN stories > 0 THEN RANK() OVER (ORDER BY stories DESC NULLS LAST) END,
+           RANK() OVER (ORDER BY total_minutes DESC)
+    FROM totals
+    ON CONFLICT (week, user_id) DO NOTHING
+"""
+
+DIGEST_PENDING = """
+    SELECT user_id, codes, events, minutes, avg_ratings, joke_rank, story_rank, time_rank
+    FROM weekly_digest
+    WHERE week = $1 AND sent_at IS NULL AND user_id > $2
+    ORDER BY user_id
+    LIMIT $3
+"""
+
+DIGEST_MARK_SENT = """
+    UPDATE weekly_digest SET sent_at = CURRENT_TIMESTAMP WHERE week = $1 AND user_id = ANY($2::bigint[])
+"""
+
+DIGEST_PURGE = """
+    DELETE FROM weekly_digest WHERE week < $1
+"""
+
+
+def statement_name(base: str, period: str) -> str:
+    return f"{base}:{period}"
+
+
+# Всё, что выполняется на горячем пути, готовится один раз на соединение.
+STATEMENTS: dict[str, str] = {
+    "upsert_user": UPSERT_USER,
+    "select_user": SELECT_USER,
+    "select_types": SELECT_TYPES,
+    "select_histogram": SELECT_HISTOGRAM,
+    "select_activity": SELECT_ACTIVITY,
+    "insert_event": INSERT_EVENT,
+    "insert_event_by_code": INSERT_EVENT_BY_CODE,
+    "aggregates_batch_upsert": AGGREGATES_BATCH_UPSERT,
+    "seed_names": SEED_NAMES,
+    "seed_totals": SEED_TOTALS,
+    "seed_days": SEED_DAYS,
+    "rating_by_type": RATING_BY_TYPE,
+    "user_stats_hydrate": USER_STATS_HYDRATE,
+    "weekly_summary": WEEKLY_SUMMARY,
+}
+for _period, _days in PERIOD_DAYS.items():
+    STATEMENTS[statement_name("personal_stats", _period)] = _personal_stats(_days)
+    STATEMENTS[statement_name("top_joke", _period)] = _top_count("joke", _days)
+    STATEMENTS[statement_name("top_story", _period)] = _top_count("story", _days)
+    STATEMENTS[statement_name("top_time", _period)] = _top_time(_days)
+
+# Классы запросов для statement timeout: записи, загрузка лидерборда на старте
+# (без таймаута) и всё остальное — чтения.
+WRITE_STATEMENTS = frozenset({"upsert_user", "insert_event", "insert_event_by_code", "aggregates_batch_upsert"})
+UNTIMED_STATEMENTS = frozenset({"seed_names", "seed_totals", "seed_days"})
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Mapping, Protocol, Sequence
+
+
+class DatabaseBusy(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class User:
+    id: int
+    username: str | None
+    first_name: str
+    joined_at: Any
+
+
+@dataclass(slots=True)
+class ImportedEvent:
+    user_id: int
+    username: str | None
+    first_name: str
+    type_code: str
+    spent_minutes: int
+    rating: int
+    happened_at: datetime
+
+
+@dataclass(slots=True)
+class WeeklySummary:
+    records: Sequence[Mapping[str, Any]]
+    ranks: dict[str, int | None]
+    # Не успели к дедлайну — отдали последнее известное значение.
+    stale_records: bool = False
+    stale_ranks: bool = False
+
+
+@dataclass(slots=True)
+class PersonalDetails:
+    histogram: Sequence[Mapping[str, Any]]
+    activity: Mapping[str, Any] | None
+
+
+class Storage(Protocol):
+    # То, чем пользуются хендлеры: Postgres (Database) или колонки в памяти (ColumnarStorage).
+    # Еженедельная рассылка сюда не входит — она работает только с Database.
+
+    async def connect(self) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def get_or_create_user(self, telegram_id: int, username: str | None, first_name: str) -> User: ...
+
+    async def insert_event(self, user_id: int, type_code: str, spent_minutes: int, rating: int) -> None: ...
+
+    async def bulk_import(self, events: Sequence[ImportedEvent]) -> int: ...
+
+    async def personal_stats(self, user_id: int, period: str) -> Sequence[Mapping[str, Any]]: ...
+
+    async def personal_details(self, user_id: int) -> PersonalDetails: ...
+
+    async def global_top(self, period: str, min_records: int = 5) -> dict[str, Sequence[Any]]: ...
+
+    async def weekly_summary(self, user_id: int) -> WeeklySummary: ...
@@ -1,3 +1,10 @@
+from typing import Any
+
+TYPE_LABELS = {
+    "joke": "анекдот",
+    "story": "кулстори",
+}
+
 START_GREETING = "йо! готов считать анекдоты и кулстори. жми кнопку."
 
 HELP_TEXT = (
@@ -7,21 +14,35 @@ HELP_TEXT = (
     "/joke &lt;минуты&gt; &lt;оценка&gt; — добавить анекдот в один шаг.\n"
     "/story &lt;минуты&gt; &lt;оценка&gt; — добавить кулстори в один шаг.\n"
     "/me [period] — личная статистика. Периоды: day, week, month, all (по умолчанию week).\n"
+    "Периоды — календарные дни по UTC: day — с 00:00 UTC сегодня, week — сегодня и 6 дней до него, month — 30 дней.\n"
+    "/me details — оценки, минуты, дни недели, часы и серии за всё время.\n"
     "/top [period] [min] — глобальные топы. Период как выше, min — минимум записей для рейтинга (по умолчанию 5).\n"
     "/cancel — отменить текущий ввод."
 )
 
 
+TOP_APPROXIMATE_NOTE = "Топ мог немного отстать — обновляется."
+
+BUSY_TEXT = "База сейчас не успевает, попробуй через минуту."
+
+STATS_BUSY_TEXT = "Статистику покажу позже — база сейчас занята."
+
+
 def added_event_message(type_label: str, minutes: int, rating: int, personal_summary: str, global_summary: str) -> str:
-    return (
-        f"Добавил: {type_label}, потрачено твоего времени: {minutes} мин, оценка {rating}.\n"
-        f"{personal_summary}\n"
-        f"{global_summary}"
-    )
+    lines = [
+        f"Добавил: {type_label}, потрачено твоего времени: {minutes} мин, оценка {rating}.",
+        personal_summary,
+        global_summary,
+    ]
+    return "\n".join(line for line in lines if line)
+
+
+def weekly_digest_message(personal_summary: str, global_summary: str) -> str:
+    return f"Итоги недели!\n{personal_summary}\n{global_summary}"
 
 
-def personal_summary_text(stats: dict[str, dict[str, int | float]]) -> str:
-    lines = ["Твоя неделя:"]
+def personal_summary_text(stats: dict[str, dict[str, int | float]], *, approximate: bool = False) -> str:
+    lines = ["Твоя неделя (примерно):" if approximate else "Твоя неделя:"]
     for type_label, values in stats.items():
         lines.append(
             f"{type_label}: {values['count']} шт, {values['minutes']} мин, средняя оценка {values['rating']}"
@@ -29,7 +50,7 @@ def personal_summary_text(stats: dict[str, dict[str, int | float]]) -> str:
     return "\n".join(lines)
 
 
-def global_summary_text(ranks: dict[str, int | None]) -> str:
+def global_summary_text(ranks: dict[str, int | None], *, approximate: bool = False) -> str:
     parts: list[str] = []
     joke_rank = ranks.get("joke_rank")
     story_rank = ranks.get("story_rank")
@@ -43,5 +64,44 @@ def global_summary_text(ranks: dict[str, int | None]) -> str:
     if not parts:
         return "Пока без глобальных позиций, но всё впереди!"
     joined = ", ".join(parts)
+    if approximate:
+        return f"Глобал (примерно, обновляется): ты на {joined} за неделю."
     return f"Глобал: ты на {joined} за неделю."
 
+
+WEEKDAY_LABELS = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+MINUTES_LABELS = ("1-5", "6-10", "11-20", "21-30", "31-60", "61+")
+BAR_WIDTH = 10
+
+
+def _bar(value: int, peak: int) -> str:
+    if not value:
+        return ""
+    return "▇" * max(1, round(value * BAR_WIDTH / peak))
+
+
+def _histogram_lines(title: str, labels: list[str], values: list[int]) -> list[str]:
+    peak = max(values, default=0)
+    if not peak:
+        return [f"{title} пока пусто"]
+    lines = [title]
+    for label, value in zip(labels, values):
+        lines.append(" ".join(part for part in (label, _bar(value, peak), str(value)) if part))
+    return lines
+
+
+def personal_details_text(details: dict[str, Any]) -> str:
+    lines = ["Подробно, за всё время:"]
+    lines += _histogram_lines("Оценки:", [f"{stars}★" for stars in range(1, 6)], details["rating"][1:])
+    lines += _histogram_lines("Минуты:", list(MINUTES_LABELS), details["minutes"][1:])
+    # В events воскресенье — 0, в тексте неделя начинается с понедельника.
+    dow = details["dow"]
+    lines += _histogram_lines("Дни недели:", list(WEEKDAY_LABELS), dow[1:] + dow[:1])
+    hours = details["hour"]
+    active_hours = [hour for hour, value in enumerate(hours) if value]
+    lines += _histogram_lines("Часы (UTC):", [f"{hour:02d}" for hour in active_hours], [hours[hour] for hour in active_hours])
+    streak = details["streak"]
+    lines.append(
+        f"Серия: сейчас {streak['current']} дн., рекорд {streak['best']} дн., активных дней {streak['active_days']}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Iterable
+
+from .leaderboard import PERIOD_DAYS
+
+_MAX_WINDOW = max(days for days in PERIOD_DAYS.values() if days is not None)
+
+# [events, minutes, rating_sum]
+Totals = list[int]
+
+
+class UserStats:
+    __slots__ = ("totals", "days")
+
+    def __init__(self) -> None:
+        self.totals: dict[str, Totals] = {}
+        self.days: dict[date, dict[str, Totals]] = {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Any]) -> UserStats:
+        # Строки USER_STATS_HYDRATE: day = NULL у всего, что старше окна.
+        stats = cls()
+        for row in rows:
+            values = (row["events"], row["minutes"], row["rating_sum"])
+            _add(stats.totals, row["code"], *values)
+            if row["day"] is not None:
+                _add(stats.days.setdefault(row["day"], {}), row["code"], *values)
+        return stats
+
+    def record(self, day: date, type_code: str, minutes: int, rating: int) -> None:
+        _add(self.totals, type_code, 1, minutes, rating)
+        _add(self.days.setdefault(day, {}), type_code, 1, minutes, rating)
+
+    def rows(self, period: str, today: date) -> list[dict[str, Any]]:
+        horizon = today - timedelta(days=_MAX_WINDOW - 1)
+        for day in [day for day in self.days if day < horizon]:
+            del self.days[day]
+        days = PERIOD_DAYS[period]
+        if days is None:
+            window = self.totals
+        else:
+            cutoff = today - timedelta(days=days - 1)
+            window = {}
+            for day, by_type in self.days.items():
+                if day >= cutoff:
+                    for code, (events, minutes, rating_sum) in by_type.items():
+                        _add(window, code, events, minutes, rating_sum)
+        # Те же поля и порядок, что у personal_stats из SQL.
+        return [
+            {
+                "code": code,
+                "total_events": events,
+                "total_minutes": minutes,
+                "avg_rating": round(rating_sum / events, 2) if events else None,
+            }
+            for code, (events, minutes, rating_sum) in sorted(window.items())
+            if events
+        ]
+
+
+class UserStatsCache:
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self._maxsize = maxsize
+        # Записи других процессов (manage.py import, backfill-rollups) сюда не
+        # доходят: через ttl после загрузки пользователь перечитывается из БД.
+        self._ttl = ttl
+        self._data: OrderedDict[int, tuple[float, UserStats]] = OrderedDict()
+        # Пользователи, которых сейчас грузят из БД; True — пока грузили, была запись.
+        self._loading: dict[int, bool] = {}
+        # Записи в полёте: от начала INSERT до record(). Загрузка, пересёкшаяся
+        # с такой записью, могла уже увидеть её коммит — record() посчитал бы дважды.
+        self._writing: dict[int, int] = {}
+
+    def get(self, user_id: int) -> UserStats | None:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        expires_at, stats = item
+        if expires_at <= time.monotonic():
+            del self._data[user_id]
+            return None
+        self._data.move_to_end(user_id)
+        return stats
+
+    def begin_load(self, user_id: int) -> None:
+        self._loading.setdefault(user_id, False)
+
+    def finish_load(self, user_id: int, stats: UserStats | None) -> None:
+        dirty = self._loading.pop(user_id, True) or user_id in self._writing
+        # Загрузка могла не увидеть параллельную запись — такой снимок не кешируем.
+        if stats is None or dirty:
+            return
+        expires_at = time.monotonic() + self._ttl if self._ttl is not None else float("inf")
+        self._data[user_id] = (expires_at, stats)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def begin_write(self, user_id: int) -> None:
+        self._writing[user_id] = self._writing.get(user_id, 0) + 1
+        if user_id in self._loading:
+            self._loading[user_id] = True
+
+    def end_write(self, user_id: int) -> None:
+        left = self._writing.pop(user_id, 1) - 1
+        if left > 0:
+            self._writing[user_id] = left
+
+    def record(self, user_id: int, type_code: str, minutes: int, rating: int) -> None:
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        item = self._data.get(user_id)
+        if item is not None:
+            item[1].record(utc_today(), type_code, minutes, rating)
+
+    def discard(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            self._data.pop(user_id, None)
+            if user_id in self._loading:
+                self._loading[user_id] = True
+
+    def clear(self) -> None:
+        self._data.clear()
+        for user_id in self._loading:
+            self._loading[user_id] = True
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _add(totals: dict[str, Totals], code: str, events: int, minutes: int, rating_sum: int) -> None:
+    current = totals.get(code)
+    if current is None:
+        totals[code] = [events, minutes, rating_sum]
+    else:
+        current[0] += events
+        current[1] += minutes
+        current[2] += rating_sum
@@ -1,7 +1,17 @@
 from __future__ import annotations
 
+from datetime import date
 from typing import Any, Iterable
 
+from .sql import HIST_DIMENSIONS, MINUTES_BUCKETS
+
+HISTOGRAM_SIZES = {
+    "rating": 6,
+    "minutes": len(MINUTES_BUCKETS) + 1,
+    "dow": 7,
+    "hour": 24,
+}
+
 
 def parse_period(period: str | None) -> str:
     if period is None:
@@ -22,3 +32,30 @@ def build_personal_summary(records: Iterable[Any]) -> dict[str, dict[str, int |
         }
     return summary
 
+
+def ensure_all_types(
+    stats: dict[str, dict[str, int | float]], labels: dict[str, str]
+) -> dict[str, dict[str, int | float]]:
+    enriched: dict[str, dict[str, int | float]] = {}
+    for code, label in labels.items():
+        record = stats.get(code, {"count": 0, "minutes": 0, "rating": 0.0})
+        enriched[label] = record
+    return enriched
+
+
+def build_personal_details(histogram: Iterable[Any], activity: Any | None, today: date) -> dict[str, Any]:
+    names = {dim: name for name, dim in HIST_DIMENSIONS.items()}
+    details: dict[str, Any] = {name: [0] * size for name, size in HISTOGRAM_SIZES.items()}
+    for row in histogram:
+        name = names.get(row["dim"])
+        if name is not None and 0 <= row["bucket"] < HISTOGRAM_SIZES[name]:
+            details[name][row["bucket"]] = row["events"]
+    current = best = active_days = 0
+    if activity is not None:
+        # Серия жива, пока вчерашний или сегодняшний день активны.
+        if (today - activity["last_day"]).days <= 1:
+            current = activity["current_streak"]
+        best = activity["best_streak"]
+        active_days = activity["active_days"]
+    details["streak"] = {"current": current, "best": best, "active_days": active_days}
+    return details
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import secrets
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateWorkerPool:
+    def __init__(self, dp: Dispatcher, bot: Bot, *, workers: int, queue_size: int) -> None:
+        self._dp = dp
+        self._bot = bot
+        self._workers = workers
+        # Ограниченная очередь: когда она полна, вебхук ждёт, а не плодит задачи.
+        self._queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        for index in range(self._workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"update-worker-{index}"))
+
+    async def submit(self, update: Update) -> None:
+        await self._queue.put(update)
+
+    async def close(self) -> None:
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self._queue.get()
+            try:
+                await self._dp.feed_update(self._bot, update)
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                self._queue.task_done()
+
+
+def build_app(submit: Callable[[dict[str, Any]], Awaitable[None]], *, path: str, secret: str) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        await submit(await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def serve_webhook(
+    bot: Bot,
+    submit: Callable[[dict[str, Any]], Awaitable[None]],
+    *,
+    url: str,
+    path: str,
+    host: str,
+    port: int,
+    secret: str | None,
+    allowed_updates: list[str],
+) -> None:
+    secret = secret or secrets.token_urlsafe(32)
+    runner = web.AppRunner(build_app(submit, path=path, secret=secret))
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    await bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret, allowed_updates=allowed_updates)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(
+    bot: Bot,
+    dp: Dispatcher,
+    *,
+    url: str,
+    path: str,
+    host: str,
+    port: int,
+    secret: str | None,
+    workers: int,
+    queue_size: int,
+) -> None:
+    pool = UpdateWorkerPool(dp, bot, workers=workers, queue_size=queue_size)
+
+    async def submit(payload: dict[str, Any]) -> None:
+        await pool.submit(Update.model_validate(payload, context={"bot": bot}))
+
+    await dp.emit_startup(bot=bot)
+    pool.start()
+    try:
+        await serve_webhook(
+            bot,
+            submit,
+            url=url,
+            path=path,
+            host=host,
+            port=port,
+            secret=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    finally:
+        await pool.close()
+        await dp.emit_shutdown(bot=bot)
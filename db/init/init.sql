@@ -17,16 +17,133 @@ INSERT INTO types (code, title) VALUES
     ('story', 'Кулстори')
 ON CONFLICT (code) DO NOTHING;
 
+-- События разбиты на помесячные партиции по happened_at (UTC).
+-- Миграция существующей таблицы: db/migrations/001_partition_events.sql
 CREATE TABLE IF NOT EXISTS events (
-    id BIGSERIAL PRIMARY KEY,
+    id BIGSERIAL,
     type_id SMALLINT NOT NULL REFERENCES types(id),
     user_id BIGINT NOT NULL REFERENCES users(id),
     spent_minutes INT NOT NULL CHECK (spent_minutes > 0),
     rating SMALLINT NOT NULL CHECK (rating BETWEEN 1 AND 5),
     happened_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
     day_of_week SMALLINT GENERATED ALWAYS AS (EXTRACT(DOW FROM happened_at)::SMALLINT) STORED,
-    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, happened_at)
+) PARTITION BY RANGE (happened_at);
 
 CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, happened_at DESC);
 CREATE INDEX IF NOT EXISTS idx_events_type ON events (type_id, happened_at DESC);
+
+-- Создаёт недостающие партиции events_YYYY_MM для месяцев [from_month, to_month].
+-- Вызывается одновременно из нескольких процессов бота: DDL идёт под
+-- advisory-локом до конца транзакции.
+CREATE OR REPLACE FUNCTION ensure_events_partitions(from_month DATE, to_month DATE) RETURNS INT AS $$
+DECLARE
+    month DATE := date_trunc('month', from_month)::date;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_events_partitions'));
+    WHILE month <= to_month LOOP
+        partition_name := format('events_%s', to_char(month, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month::timestamp AT TIME ZONE 'UTC',
+                (month + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            created := created + 1;
+        END IF;
+        month := (month + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_events_partitions(
+    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date,
+    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC' + INTERVAL '3 months')::date
+);
+
+-- Дневные агрегаты по пользователю и типу: из них читаются топы и статистика.
+-- Для уже существующих данных: python manage.py backfill-rollups
+CREATE TABLE IF NOT EXISTS user_type_daily (
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    type_id SMALLINT NOT NULL REFERENCES types(id),
+    day DATE NOT NULL,
+    events INT NOT NULL,
+    minutes BIGINT NOT NULL,
+    rating_sum BIGINT NOT NULL,
+    PRIMARY KEY (user_id, type_id, day)
+);
+
+-- Покрывающие индексы под запросы из bot/sql.py: топы по типу и rating_by_type
+-- читают (type_id, day), топ по времени и места за неделю — (day). Проверка
+-- планов: python -m bench.plans
+CREATE INDEX IF NOT EXISTS idx_user_type_daily_type_day_cover
+    ON user_type_daily (type_id, day) INCLUDE (user_id, events, minutes, rating_sum);
+CREATE INDEX IF NOT EXISTS idx_user_type_daily_day_cover
+    ON user_type_daily (day) INCLUDE (user_id, type_id, events, minutes);
+-- Index-only scan работает только по свежей карте видимости, а таблица
+-- обновляется на каждое событие.
+ALTER TABLE user_type_daily SET (autovacuum_vacuum_scale_factor = 0.02, autovacuum_vacuum_insert_scale_factor = 0.02);
+
+-- Гистограммы пользователя для /me details: оценки, минуты, день недели и
+-- час (UTC). dim — HIST_* из bot/sql.py.
+CREATE TABLE IF NOT EXISTS user_histogram (
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    dim SMALLINT NOT NULL,
+    bucket SMALLINT NOT NULL,
+    events INT NOT NULL,
+    minutes BIGINT NOT NULL,
+    PRIMARY KEY (user_id, dim, bucket)
+);
+
+-- Вклад отцеплённых партиций events в user_histogram: backfill-rollups
+-- пересобирает гистограммы как архив + живые события.
+CREATE TABLE IF NOT EXISTS user_histogram_archive (
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    dim SMALLINT NOT NULL,
+    bucket SMALLINT NOT NULL,
+    events INT NOT NULL,
+    minutes BIGINT NOT NULL,
+    PRIMARY KEY (user_id, dim, bucket)
+);
+
+-- Серии активных дней подряд (UTC).
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id),
+    last_day DATE NOT NULL,
+    current_streak INT NOT NULL,
+    best_streak INT NOT NULL,
+    active_days INT NOT NULL
+);
+
+-- Снимок еженедельной рассылки; sent_at отмечает доставленные пачки, чтобы
+-- после рестарта продолжить с места остановки.
+CREATE TABLE IF NOT EXISTS weekly_digest (
+    week DATE NOT NULL,
+    user_id BIGINT NOT NULL,
+    codes TEXT[] NOT NULL,
+    events BIGINT[] NOT NULL,
+    minutes BIGINT[] NOT NULL,
+    avg_ratings NUMERIC[] NOT NULL,
+    joke_rank INT,
+    story_rank INT,
+    time_rank INT,
+    sent_at TIMESTAMPTZ,
+    PRIMARY KEY (week, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_weekly_digest_pending ON weekly_digest (week, user_id) WHERE sent_at IS NULL;
+
+-- Состояние FSM при FSM_STORAGE=postgres: переживает рестарт и общее для процессов.
+CREATE TABLE IF NOT EXISTS fsm_state (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at);
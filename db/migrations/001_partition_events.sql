@@ -0,0 +1,63 @@
+-- Перевод существующей таблицы events на помесячные партиции.
+-- Запускать один раз на остановленном боте:
+--   psql "$DATABASE_URL" -f db/migrations/001_partition_events.sql
+BEGIN;
+
+LOCK TABLE events IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE events RENAME TO events_legacy;
+ALTER TABLE events_legacy RENAME CONSTRAINT events_pkey TO events_legacy_pkey;
+ALTER INDEX IF EXISTS idx_events_user RENAME TO idx_events_legacy_user;
+ALTER INDEX IF EXISTS idx_events_type RENAME TO idx_events_legacy_type;
+
+CREATE TABLE events (
+    id BIGINT NOT NULL DEFAULT nextval('events_id_seq'),
+    type_id SMALLINT NOT NULL REFERENCES types(id),
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    spent_minutes INT NOT NULL CHECK (spent_minutes > 0),
+    rating SMALLINT NOT NULL CHECK (rating BETWEEN 1 AND 5),
+    happened_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    day_of_week SMALLINT GENERATED ALWAYS AS (EXTRACT(DOW FROM happened_at)::SMALLINT) STORED,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, happened_at)
+) PARTITION BY RANGE (happened_at);
+
+CREATE INDEX idx_events_user ON events (user_id, happened_at DESC);
+CREATE INDEX idx_events_type ON events (type_id, happened_at DESC);
+
+CREATE OR REPLACE FUNCTION ensure_events_partitions(from_month DATE, to_month DATE) RETURNS INT AS $$
+DECLARE
+    month DATE := date_trunc('month', from_month)::date;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    WHILE month <= to_month LOOP
+        partition_name := format('events_%s', to_char(month, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month::timestamp AT TIME ZONE 'UTC',
+                (month + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            created := created + 1;
+        END IF;
+        month := (month + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_events_partitions(
+    (COALESCE((SELECT MIN(happened_at) FROM events_legacy), CURRENT_TIMESTAMP) AT TIME ZONE 'UTC')::date,
+    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC' + INTERVAL '3 months')::date
+);
+
+INSERT INTO events (id, type_id, user_id, spent_minutes, rating, happened_at, created_at)
+SELECT id, type_id, user_id, spent_minutes, rating, happened_at, created_at
+FROM events_legacy;
+
+ALTER SEQUENCE events_id_seq OWNED BY events.id;
+DROP TABLE events_legacy;
+
+COMMIT;
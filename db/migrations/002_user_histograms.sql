@@ -0,0 +1,23 @@
+-- Агрегаты для /me details. После применения заполнить их по истории:
+--   psql "$DATABASE_URL" -f db/migrations/002_user_histograms.sql
+--   python manage.py backfill-rollups
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS user_histogram (
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    dim SMALLINT NOT NULL,
+    bucket SMALLINT NOT NULL,
+    events INT NOT NULL,
+    minutes BIGINT NOT NULL,
+    PRIMARY KEY (user_id, dim, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id),
+    last_day DATE NOT NULL,
+    current_streak INT NOT NULL,
+    best_streak INT NOT NULL,
+    active_days INT NOT NULL
+);
+
+COMMIT;
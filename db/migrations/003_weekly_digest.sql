@@ -0,0 +1,19 @@
+-- Таблица для еженедельной рассылки (DIGEST_ENABLED=true):
+--   psql "$DATABASE_URL" -f db/migrations/003_weekly_digest.sql
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS weekly_digest (
+    week DATE NOT NULL,
+    user_id BIGINT NOT NULL,
+    codes TEXT[] NOT NULL,
+    events BIGINT[] NOT NULL,
+    minutes BIGINT[] NOT NULL,
+    avg_ratings NUMERIC[] NOT NULL,
+    joke_rank INT,
+    story_rank INT,
+    time_rank INT,
+    sent_at TIMESTAMPTZ,
+    PRIMARY KEY (week, user_id)
+);
+
+COMMIT;
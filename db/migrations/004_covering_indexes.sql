@@ -0,0 +1,17 @@
+-- Покрывающие индексы для user_type_daily. CONCURRENTLY нельзя внутри
+-- транзакции, поэтому без BEGIN/COMMIT; бот можно не останавливать:
+--   psql "$DATABASE_URL" -f db/migrations/004_covering_indexes.sql
+-- Если user_type_daily ещё нет, её индексы здесь упадут — таблицу с теми же
+-- индексами создаёт 008.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_type_daily_type_day_cover
+    ON user_type_daily (type_id, day) INCLUDE (user_id, events, minutes, rating_sum);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_type_daily_day_cover
+    ON user_type_daily (day) INCLUDE (user_id, type_id, events, minutes);
+DROP INDEX CONCURRENTLY IF EXISTS idx_user_type_daily_type_day;
+DROP INDEX CONCURRENTLY IF EXISTS idx_user_type_daily_day;
+
+ALTER TABLE user_type_daily SET (autovacuum_vacuum_scale_factor = 0.02, autovacuum_vacuum_insert_scale_factor = 0.02);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_weekly_digest_pending ON weekly_digest (week, user_id) WHERE sent_at IS NULL;
+
+VACUUM (ANALYZE) user_type_daily;
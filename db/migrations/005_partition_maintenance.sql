@@ -0,0 +1,26 @@
+-- ensure_events_partitions под advisory-локом: воркеры (WORKERS > 1) стартуют
+-- одновременно и раньше падали на "relation already exists".
+--   psql "$DATABASE_URL" -f db/migrations/005_partition_maintenance.sql
+CREATE OR REPLACE FUNCTION ensure_events_partitions(from_month DATE, to_month DATE) RETURNS INT AS $$
+DECLARE
+    month DATE := date_trunc('month', from_month)::date;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_events_partitions'));
+    WHILE month <= to_month LOOP
+        partition_name := format('events_%s', to_char(month, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month::timestamp AT TIME ZONE 'UTC',
+                (month + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            created := created + 1;
+        END IF;
+        month := (month + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
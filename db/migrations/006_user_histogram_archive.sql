@@ -0,0 +1,39 @@
+-- Архив гистограмм для отцеплённых партиций events: backfill-rollups больше
+-- не теряет историю, которой уже нет в events. Начальное наполнение — то, что
+-- user_histogram насчитала сверх живых событий.
+--   psql "$DATABASE_URL" -f db/migrations/006_user_histogram_archive.sql
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS user_histogram_archive (
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    dim SMALLINT NOT NULL,
+    bucket SMALLINT NOT NULL,
+    events INT NOT NULL,
+    minutes BIGINT NOT NULL,
+    PRIMARY KEY (user_id, dim, bucket)
+);
+
+LOCK TABLE events IN SHARE MODE;
+
+-- dim и корзины — как HIST_* и MINUTES_BUCKETS в bot/sql.py.
+WITH live AS (
+    SELECT s.user_id, h.dim, h.bucket, COUNT(*) AS events, SUM(s.spent_minutes) AS minutes
+    FROM events s
+    CROSS JOIN LATERAL (VALUES
+        (1, s.rating::int),
+        (2, width_bucket(s.spent_minutes, ARRAY[1, 6, 11, 21, 31, 61])),
+        (3, EXTRACT(DOW FROM s.happened_at AT TIME ZONE 'UTC')::int),
+        (4, EXTRACT(HOUR FROM s.happened_at AT TIME ZONE 'UTC')::int)
+    ) AS h(dim, bucket)
+    GROUP BY 1, 2, 3
+)
+INSERT INTO user_histogram_archive (user_id, dim, bucket, events, minutes)
+SELECT uh.user_id, uh.dim, uh.bucket,
+       uh.events - COALESCE(live.events, 0),
+       uh.minutes - COALESCE(live.minutes, 0)
+FROM user_histogram uh
+LEFT JOIN live USING (user_id, dim, bucket)
+WHERE uh.events > COALESCE(live.events, 0)
+ON CONFLICT (user_id, dim, bucket) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Состояние FSM для FSM_STORAGE=postgres:
+--   psql "$DATABASE_URL" -f db/migrations/007_fsm_state.sql
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS fsm_state (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at);
+
+COMMIT;
@@ -1,27 +1,70 @@
 import asyncio
+import logging
+import time
 
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
+from aiogram import Dispatcher
 
+from bot.app import build_bot, build_database, build_digest, build_outbox, build_storage, log_startup
 from bot.config import settings
-from bot.database import Database
 from bot.handlers import register_handlers
+from bot.metrics import setup_metrics, start_metrics_server
+from bot.sharding import run_sharded
+from bot.webhook import run_webhook
 
 
 async def main() -> None:
-    bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher()
+    if settings.workers > 1:
+        await run_sharded(settings.workers)
+        return
 
-    database = Database(dsn=settings.database_url)
+    started = time.perf_counter()
+    bot = build_bot()
+    storage = build_storage()
+    dp = Dispatcher(storage=storage)
+
+    database = build_database()
     await database.connect()
 
-    register_handlers(dp, database)
+    outbox = build_outbox(bot)
+    outbox.start()
+
+    register_handlers(dp, database, outbox)
+    setup_metrics(dp, bot)
+    digest = build_digest(database, outbox) if settings.digest_enabled else None
+    if digest is not None:
+        digest.start()
+    metrics_runner = None
+    if settings.metrics_port is not None:
+        metrics_runner = await start_metrics_server(settings.metrics_host, settings.metrics_port)
+    log_startup(started, database)
 
     try:
-        await dp.start_polling(bot)
+        if settings.run_mode == "webhook":
+            if not settings.webhook_url:
+                raise RuntimeError("WEBHOOK_URL is required in webhook mode")
+            await run_webhook(
+                bot,
+                dp,
+                url=settings.webhook_url,
+                path=settings.webhook_path,
+                host=settings.webhook_host,
+                port=settings.webhook_port,
+                secret=settings.webhook_secret,
+                workers=settings.update_workers,
+                queue_size=settings.update_queue_size,
+            )
+        else:
+            await dp.start_polling(bot)
     finally:
+        if digest is not None:
+            await digest.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await outbox.close()
+        await storage.close()
         await database.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
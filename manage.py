@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from bot.app import database_url
+from bot.bulk import EVENT_FIELDS, USER_STATS_FIELDS, import_events, write_rows
+from bot.database import Database
+
+
+async def backfill_rollups(database: Database, args: argparse.Namespace) -> None:
+    rows = await database.backfill_rollups()
+    print(f"user_type_daily: {rows} rows")
+
+
+async def partitions(database: Database, args: argparse.Namespace) -> None:
+    created, retired = await database.maintain_partitions(
+        months_ahead=args.ahead,
+        retain_months=args.retain_months,
+        drop=args.drop,
+    )
+    print(f"partitions created: {created}")
+    for name in retired:
+        print(f"{'dropped' if args.drop else 'archived'}: {name}")
+
+
+async def import_command(database: Database, args: argparse.Namespace) -> None:
+    with args.path.open(encoding="utf-8", newline="") as stream:
+        count = await import_events(database, stream, _format(args.path, args.format), chunk_size=args.chunk_size)
+    print(f"imported events: {count}", file=sys.stderr)
+
+
+async def export_command(database: Database, args: argparse.Namespace) -> None:
+    if args.what == "events":
+        rows, fields = database.export_events(), EVENT_FIELDS
+    else:
+        rows, fields = database.export_user_stats(), USER_STATS_FIELDS
+    fmt = _format(args.output, args.format)
+    if args.output is None:
+        count = await write_rows(rows, sys.stdout, fmt, fields)
+    else:
+        with args.output.open("w", encoding="utf-8", newline="") as stream:
+            count = await write_rows(rows, stream, fmt, fields)
+    print(f"exported rows: {count}", file=sys.stderr)
+
+
+def _format(path: Path | None, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    if path is not None and path.suffix.lower() == ".csv":
+        return "csv"
+    return "jsonl"
+
+
+COMMANDS = {
+    "backfill-rollups": backfill_rollups,
+    "partitions": partitions,
+    "import": import_command,
+    "export": export_command,
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Служебные команды anek-counter")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill-rollups", help="пересобрать user_type_daily из events")
+    partitions_parser = subparsers.add_parser("partitions", help="создать будущие и убрать старые партиции events")
+    partitions_parser.add_argument("--ahead", type=int, default=3, help="на сколько месяцев вперёд создать партиции")
+    partitions_parser.add_argument(
+        "--retain-months", type=int, default=None, help="сколько месяцев сырых событий хранить (по умолчанию все)"
+    )
+    partitions_parser.add_argument("--drop", action="store_true", help="удалять старые партиции, а не переносить в archive")
+    import_parser = subparsers.add_parser("import", help="залить историю событий из CSV/JSONL через COPY")
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], default=None, help="по умолчанию по расширению")
+    import_parser.add_argument("--chunk-size", type=int, default=50_000)
+    export_parser = subparsers.add_parser("export", help="выгрузить события или статистику пользователей")
+    export_parser.add_argument("what", choices=["events", "user-stats"])
+    export_parser.add_argument("--output", type=Path, default=None, help="по умолчанию stdout")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default=None, help="по умолчанию по расширению")
+    return parser
+
+
+async def run(args: argparse.Namespace) -> None:
+    database = Database(dsn=database_url())
+    await database.connect()
+    try:
+        await COMMANDS[args.command](database, args)
+    finally:
+        await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(build_parser().parse_args()))
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Generator
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+TOKEN = "42:TEST"
+BOT_ID = 42
+
+
+class FakeBotApi:
+    # Локальный Bot API: запоминает вызовы и отвечает правдоподобными объектами.
+    # retry_after — сколько раз подряд ответить 429 на sendMessage.
+
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, dict[str, Any]]] = []
+        self.retry_after: list[int] = []
+        self._message_ids = itertools.count(1)
+
+    def sent(self, method: str = "sendMessage") -> list[dict[str, Any]]:
+        return [params for name, params in self.calls if name == method]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {key: _decode(value) for key, value in (await request.post()).items()}
+        self.calls.append((method, params))
+        if method == "sendMessage" and self.retry_after:
+            retry_after = self.retry_after.pop(0)
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                },
+                status=429,
+            )
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: dict[str, Any]) -> Any:
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        if method == "sendMessage":
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params["text"],
+            }
+        return True
+
+
+@asynccontextmanager
+async def fake_bot_api() -> AsyncIterator[tuple[FakeBotApi, Bot]]:
+    api = FakeBotApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    server = TestServer(app)
+    await server.start_server()
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(str(server.make_url("")).rstrip("/"))))
+    try:
+        yield api, bot
+    finally:
+        await bot.session.close()
+        await server.close()
+
+
+def message_update(update_id: int, user_id: int, text: str, *, chat_id: int | None = None) -> dict[str, Any]:
+    chat = {"id": user_id, "type": "private"} if chat_id is None else {"id": chat_id, "type": "group", "title": "group"}
+    message: dict[str, Any] = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class FakeConnection:
+    # Соединение asyncpg для EventBatcher: пишет в списки, падает по заказу.
+
+    def __init__(self, owner: FakePool) -> None:
+        self._owner = owner
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        yield
+
+    async def copy_records_to_table(self, table: str, *, records: list[Any], columns: Any) -> None:
+        if self._owner.fail_copy:
+            raise RuntimeError("copy failed")
+        self._owner.copied.append(list(records))
+
+    async def execute(self, query: str, *args: Any) -> str:
+        return "SELECT 1"
+
+    async def fetch_prepared(self, name: str, *args: Any) -> list[Any]:
+        if name in self._owner.fail_statements:
+            raise asyncio.TimeoutError(name)
+        self._owner.calls.append(name)
+        if name == "insert_event":
+            if args in self._owner.bad_records:
+                raise ValueError(f"bad record {args}")
+            self._owner.inserted.append(args)
+        return self._owner.rows.get(name, [])
+
+    async def fetchrow_prepared(self, name: str, *args: Any) -> Any:
+        self._owner.calls.append(name)
+        row = self._owner.rows.get(name)
+        # Строку можно собрать из аргументов запроса, как сделал бы RETURNING.
+        return row(*args) if callable(row) else row
+
+
+class FakePool:
+    def __init__(self, size: int | None = None) -> None:
+        self.copied: list[list[Any]] = []
+        self.inserted: list[tuple[Any, ...]] = []
+        self.bad_records: set[tuple[Any, ...]] = set()
+        self.fail_copy = False
+        self.fail_statements: set[str] = set()
+        # Ответы подготовленных запросов по имени и журнал вызванных запросов.
+        self.rows: dict[str, Any] = {}
+        self.calls: list[str] = []
+        # Сколько следующих acquire() упадут, как Database._acquire с DatabaseBusy.
+        self.fail_acquire = 0
+        # Размер пула: лишние acquire ждут свободное соединение, как в asyncpg.
+        self._slots = asyncio.Semaphore(size) if size is not None else None
+
+    def acquire(self, *, timeout: float | None = None) -> _FakeAcquire:
+        # Как asyncpg.Pool.acquire: и await, и async with.
+        return _FakeAcquire(self, timeout)
+
+    async def release(self, conn: FakeConnection) -> None:
+        if self._slots is not None:
+            self._slots.release()
+
+    async def close(self) -> None:
+        pass
+
+    async def _checkout(self, timeout: float | None) -> FakeConnection:
+        if self.fail_acquire:
+            self.fail_acquire -= 1
+            raise ConnectionError("no connection")
+        if self._slots is not None:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        return FakeConnection(self)
+
+
+class _FakeAcquire:
+    def __init__(self, pool: FakePool, timeout: float | None) -> None:
+        self._pool = pool
+        self._timeout = timeout
+        self._conn: FakeConnection | None = None
+
+    def __await__(self) -> Generator[Any, None, FakeConnection]:
+        return self._pool._checkout(self._timeout).__await__()
+
+    async def __aenter__(self) -> FakeConnection:
+        self._conn = await self._pool._checkout(self._timeout)
+        return self._conn
+
+    async def __aexit__(self, *exc: object) -> None:
+        assert self._conn is not None
+        await self._pool.release(self._conn)
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, str) and value[:1] in "{[":
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
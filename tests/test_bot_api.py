@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import pytest
+from aiogram import Dispatcher, Router
+from aiogram.types import Message, Update
+from aiohttp.test_utils import TestClient, TestServer
+
+from bot.fsm import BoundedMemoryStorage
+from bot.handlers import register_handlers
+from bot.keyboards import JOKE_BUTTON
+from bot.outbox import INTERACTIVE, Outbox
+from bot.storage import DatabaseBusy
+from bot.texts import BUSY_TEXT, START_GREETING
+from bot.webhook import SECRET_HEADER, UpdateWorkerPool, build_app
+
+from .fakes import fake_bot_api, message_update
+
+pytest.importorskip("numpy")
+
+from bot.columnar import ColumnarStorage  # noqa: E402
+
+SECRET = "test-secret"
+
+
+def test_webhook_updates_reach_handlers_and_replies_reach_bot_api() -> None:
+    async def scenario() -> list[dict[str, Any]]:
+        async with fake_bot_api() as (api, bot):
+            dp = Dispatcher(storage=BoundedMemoryStorage())
+            outbox = Outbox(bot, chat_rate=100.0)
+            outbox.start()
+            register_handlers(dp, ColumnarStorage(), outbox)
+            # Один воркер — ответы в чат идут по порядку апдейтов.
+            pool = UpdateWorkerPool(dp, bot, workers=1, queue_size=4)
+            pool.start()
+
+            async def submit(payload: dict[str, Any]) -> None:
+                await pool.submit(Update.model_validate(payload, context={"bot": bot}))
+
+            async with TestClient(TestServer(build_app(submit, path="/webhook", secret=SECRET))) as client:
+                denied = await client.post("/webhook", json=message_update(1, 7, "/start"))
+                assert denied.status == 401
+                for update_id, text in enumerate(["/start", "/joke 15 4", "/me"], start=1):
+                    response = await client.post("/webhook", json=message_update(update_id, 7, text), headers={SECRET_HEADER: SECRET})
+                    assert response.status == 200
+            await pool.close()
+            await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+            await outbox.close()
+            return api.sent()
+
+    sent = asyncio.run(scenario())
+    texts = [params["text"] for params in sent]
+    assert texts[0] == START_GREETING
+    assert texts[1].startswith("Добавил:")
+    assert "15" in texts[2]
+    assert all(int(params["chat_id"]) == 7 for params in sent)
+
+
+def test_full_worker_queue_applies_backpressure() -> None:
+    async def scenario() -> None:
+        async with fake_bot_api() as (_, bot):
+            release = asyncio.Event()
+            handled: list[int] = []
+            router = Router()
+
+            @router.message()
+            async def slow(message: Message) -> None:
+                await release.wait()
+                handled.append(message.message_id)
+
+            dp = Dispatcher()
+            dp.include_router(router)
+            pool = UpdateWorkerPool(dp, bot, workers=1, queue_size=1)
+            pool.start()
+            updates = [Update.model_validate(message_update(index, 7, "hi"), context={"bot": bot}) for index in (1, 2, 3)]
+            await pool.submit(updates[0])
+            await asyncio.sleep(0.01)
+            await pool.submit(updates[1])
+            # Воркер занят, очередь полна — третий апдейт ждёт места.
+            blocked = asyncio.create_task(pool.submit(updates[2]))
+            await asyncio.sleep(0.05)
+            assert not blocked.done()
+            release.set()
+            await asyncio.wait_for(blocked, timeout=5)
+            await pool.close()
+            assert handled == [1, 2, 3]
+
+    asyncio.run(scenario())
+
+
+class BusyOnceStorage(ColumnarStorage):
+    # Первая запись события получает DatabaseBusy, как при перегрузке пула.
+    def __init__(self) -> None:
+        super().__init__()
+        self.busy = 1
+
+    async def insert_event(self, user_id: int, type_code: str, spent_minutes: int, rating: int) -> None:
+        if self.busy:
+            self.busy -= 1
+            raise DatabaseBusy("Connection pool is saturated")
+        await super().insert_event(user_id, type_code, spent_minutes, rating)
+
+
+def _rating_update(update_id: int, user_id: int, value: int) -> dict[str, Any]:
+    message = message_update(update_id, user_id, "Оценка? Жми звёзды.")["message"]
+    user = message["from"]
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": f"rating:{value}",
+            "message": message | {"from": {"id": 42, "is_bot": True, "first_name": "test"}},
+        },
+    }
+
+
+def test_busy_database_replies_and_keeps_the_fsm_step() -> None:
+    async def scenario() -> tuple[list[dict[str, Any]], list[str], str | None]:
+        async with fake_bot_api() as (api, bot):
+            fsm = BoundedMemoryStorage()
+            dp = Dispatcher(storage=fsm)
+            outbox = Outbox(bot, chat_rate=100.0)
+            outbox.start()
+            storage = BusyOnceStorage()
+            register_handlers(dp, storage, outbox)
+
+            async def feed(payload: dict[str, Any]) -> None:
+                await dp.feed_update(bot, Update.model_validate(payload, context={"bot": bot}))
+
+            await feed(message_update(1, 7, JOKE_BUTTON))
+            await feed(message_update(2, 7, "15"))
+            await feed(_rating_update(3, 7, 4))
+            # Оценка не записалась, но шаг FSM остался — повтор той же кнопки проходит.
+            state = await dp.fsm.get_context(bot, chat_id=7, user_id=7).get_state()
+            await feed(_rating_update(4, 7, 4))
+            storage.busy = 1
+            await feed(message_update(5, 7, "/joke 10 5"))
+            await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+            await outbox.close()
+            return api.sent("answerCallbackQuery"), [params["text"] for params in api.sent()], state
+
+    answers, texts, state = asyncio.run(scenario())
+    assert state == "AddEventState:waiting_for_rating"
+    assert answers[0]["text"] == BUSY_TEXT
+    assert answers[1]["text"] == "Зафиксировано!"
+    assert any(text.startswith("Добавил: анекдот") for text in texts)
+    assert texts[-1] == BUSY_TEXT
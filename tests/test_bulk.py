@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import os
+import random
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Mapping
+
+import pytest
+
+from bot.bulk import EVENT_FIELDS, import_events, write_rows
+from bot.database import Database
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+EVENTS = (("joke", 10, 4), ("joke", 20, 5), ("story", 30, 3))
+
+
+def _user_id() -> int:
+    return random.randint(10**12, 2 * 10**12)
+
+
+def _csv(user_id: int, events: tuple[tuple[str, int, int], ...]) -> io.StringIO:
+    now = datetime.now(timezone.utc).isoformat()
+    lines = ["user_id,username,first_name,type,spent_minutes,rating,happened_at"]
+    lines += [f"{user_id},,imported,{code},{minutes},{rating},{now}" for code, minutes, rating in events]
+    return io.StringIO("\n".join(lines) + "\n")
+
+
+async def _aggregates(database: Database, user_id: int) -> dict[str, list[tuple[Any, ...]]]:
+    async with database._acquire() as conn:
+        daily = await conn.fetch(
+            "SELECT type_id, day, events, minutes, rating_sum FROM user_type_daily WHERE user_id = $1 ORDER BY 1, 2",
+            user_id,
+        )
+        histogram = await conn.fetch(
+            "SELECT dim, bucket, events, minutes FROM user_histogram WHERE user_id = $1 ORDER BY 1, 2", user_id
+        )
+        activity = await conn.fetch(
+            "SELECT last_day, current_streak, best_streak, active_days FROM user_activity WHERE user_id = $1", user_id
+        )
+    return {
+        "daily": [tuple(row) for row in daily],
+        "histogram": [tuple(row) for row in histogram],
+        "activity": [tuple(row) for row in activity],
+    }
+
+
+def test_chunked_import_matches_live_writes() -> None:
+    async def scenario() -> tuple[dict[str, Any], dict[str, Any], str | None]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            live, imported = _user_id(), _user_id()
+            user = await database.get_or_create_user(live, None, "live")
+            for code, minutes, rating in EVENTS:
+                await database.insert_event(user.id, code, minutes, rating)
+            # Пользователь уже есть: импорт не трогает его профиль.
+            await database.get_or_create_user(imported, "existing", "existing")
+            count = await import_events(database, _csv(imported, EVENTS), "csv", chunk_size=2)
+            assert count == len(EVENTS)
+            async with database._acquire() as conn:
+                username = await conn.fetchval("SELECT username FROM users WHERE id = $1", imported)
+            return await _aggregates(database, live), await _aggregates(database, imported), username
+        finally:
+            await database.close()
+
+    live, imported, username = asyncio.run(scenario())
+    assert imported == live
+    assert live["daily"] and live["histogram"] and live["activity"]
+    assert username == "existing"
+
+
+def test_import_with_unknown_type_writes_nothing() -> None:
+    async def scenario() -> dict[str, Any]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            user_id = _user_id()
+            with pytest.raises(ValueError, match="Unknown type_code: poem"):
+                await import_events(database, _csv(user_id, (("joke", 10, 4), ("poem", 5, 5))), "csv")
+            return await _aggregates(database, user_id)
+        finally:
+            await database.close()
+
+    assert asyncio.run(scenario()) == {"daily": [], "histogram": [], "activity": []}
+
+
+def test_export_round_trips_through_import() -> None:
+    async def scenario() -> tuple[dict[str, Any], dict[str, Any]]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            source, target = _user_id(), _user_id()
+            await import_events(database, _csv(source, EVENTS), "csv")
+
+            async def only_source() -> AsyncIterator[Mapping[str, Any]]:
+                async for row in database.export_events():
+                    if row["user_id"] == source:
+                        yield row
+
+            exported = io.StringIO()
+            assert await write_rows(only_source(), exported, "jsonl", EVENT_FIELDS) == len(EVENTS)
+            # Та же выгрузка под другим пользователем, чтобы не задвоить source.
+            rows = [json.loads(line) | {"user_id": target} for line in exported.getvalue().splitlines()]
+            stream = io.StringIO("".join(json.dumps(row) + "\n" for row in rows))
+            assert await import_events(database, stream, "jsonl") == len(EVENTS)
+            return await _aggregates(database, source), await _aggregates(database, target)
+        finally:
+            await database.close()
+
+    source, target = asyncio.run(scenario())
+    assert target == source
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from datetime import date
+
+import pytest
+
+from bot import cache
+from bot.cache import TTLCache
+from bot.user_stats import UserStats, UserStatsCache
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires(clock: list[float]) -> None:
+    ttl: TTLCache[str, int] = TTLCache(maxsize=10, ttl=5)
+    ttl.set("a", 1)
+    clock[0] += 4
+    assert ttl.get("a") == 1
+    clock[0] += 2
+    assert ttl.get("a") is None
+    assert len(ttl) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used(clock: list[float]) -> None:
+    ttl: TTLCache[str, int] = TTLCache(maxsize=2, ttl=60)
+    ttl.set("a", 1)
+    ttl.set("b", 2)
+    assert ttl.get("a") == 1
+    ttl.set("c", 3)
+    assert ttl.get("b") is None
+    assert sorted(ttl.items()) == [("a", 1), ("c", 3)]
+    assert ttl.pop("a") == 1
+    assert ttl.pop("a") is None
+
+
+def test_ttl_cache_rejects_empty_size() -> None:
+    with pytest.raises(ValueError):
+        TTLCache(maxsize=0, ttl=1)
+
+
+def _stats(day: date) -> UserStats:
+    return UserStats.from_rows([{"code": "joke", "day": day, "events": 2, "minutes": 30, "rating_sum": 8}])
+
+
+def test_user_stats_rows_by_period() -> None:
+    today = date(2026, 3, 10)
+    stats = UserStats.from_rows(
+        [
+            {"code": "joke", "day": today, "events": 2, "minutes": 30, "rating_sum": 8},
+            {"code": "joke", "day": None, "events": 10, "minutes": 100, "rating_sum": 30},
+            {"code": "story", "day": date(2026, 3, 5), "events": 1, "minutes": 20, "rating_sum": 5},
+        ]
+    )
+    stats.record(today, "story", 10, 3)
+    assert stats.rows("day", today) == [
+        {"code": "joke", "total_events": 2, "total_minutes": 30, "avg_rating": 4.0},
+        {"code": "story", "total_events": 1, "total_minutes": 10, "avg_rating": 3.0},
+    ]
+    assert stats.rows("week", today)[1] == {"code": "story", "total_events": 2, "total_minutes": 30, "avg_rating": 4.0}
+    assert stats.rows("all", today)[0]["total_events"] == 12
+
+
+def test_user_stats_cache_keeps_clean_load_and_records_writes() -> None:
+    users = UserStatsCache(maxsize=10)
+    users.begin_load(1)
+    users.finish_load(1, _stats(date.today()))
+    users.begin_write(1)
+    users.record(1, "joke", 10, 5)
+    users.end_write(1)
+    stats = users.get(1)
+    assert stats is not None
+    assert stats.totals["joke"] == [3, 40, 13]
+
+
+def test_user_stats_cache_skips_load_overlapping_a_write() -> None:
+    users = UserStatsCache(maxsize=10)
+    # Запись началась до загрузки, а закончится после: снимок мог её уже увидеть.
+    users.begin_write(1)
+    users.begin_load(1)
+    users.finish_load(1, _stats(date.today()))
+    users.record(1, "joke", 10, 5)
+    users.end_write(1)
+    assert users.get(1) is None
+
+    users.begin_load(1)
+    users.finish_load(1, _stats(date.today()))
+    assert users.get(1) is not None
+
+
+def test_user_stats_cache_skips_load_raced_by_discard() -> None:
+    users = UserStatsCache(maxsize=10)
+    users.begin_load(1)
+    users.discard([1])
+    users.finish_load(1, _stats(date.today()))
+    assert users.get(1) is None
+
+
+def test_user_stats_cache_is_bounded() -> None:
+    users = UserStatsCache(maxsize=2)
+    for user_id in (1, 2, 3):
+        users.begin_load(user_id)
+        users.finish_load(user_id, _stats(date.today()))
+    assert len(users) == 2
+    assert users.get(1) is None
+
+
+def test_user_stats_cache_reloads_after_ttl(clock: list[float]) -> None:
+    users = UserStatsCache(maxsize=10, ttl=60)
+    users.begin_load(1)
+    users.finish_load(1, _stats(date.today()))
+    clock[0] += 59
+    users.record(1, "joke", 10, 5)
+    assert users.get(1) is not None
+    # Записи процесса не продлевают жизнь снимку: чужой импорт всё равно подтянется.
+    clock[0] += 2
+    assert users.get(1) is None
+    assert len(users) == 0
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from bot.columnar import ColumnarStorage  # noqa: E402
+from bot.sql import HIST_MINUTES  # noqa: E402
+from bot.storage import ImportedEvent  # noqa: E402
+
+
+def _imported(user_id: int, type_code: str, minutes: int, rating: int, days_ago: int) -> ImportedEvent:
+    return ImportedEvent(
+        user_id=user_id,
+        username=f"user{user_id}",
+        first_name=f"user{user_id}",
+        type_code=type_code,
+        spent_minutes=minutes,
+        rating=rating,
+        happened_at=datetime.now(timezone.utc) - timedelta(days=days_ago),
+    )
+
+
+async def _fill(storage: ColumnarStorage) -> None:
+    await storage.get_or_create_user(1, "alice", "Alice")
+    await storage.get_or_create_user(2, None, "Bob")
+    await storage.insert_event(1, "joke", 10, 5)
+    await storage.insert_event(1, "joke", 20, 3)
+    await storage.insert_event(2, "story", 45, 4)
+    await storage.bulk_import([_imported(2, "joke", 5, 1, days_ago=20)])
+
+
+def test_personal_stats_and_details() -> None:
+    async def scenario() -> None:
+        storage = ColumnarStorage()
+        await _fill(storage)
+        assert await storage.personal_stats(1, "day") == [
+            {"code": "joke", "total_events": 2, "total_minutes": 30, "avg_rating": 4.0}
+        ]
+        assert [row["code"] for row in await storage.personal_stats(2, "week")] == ["story"]
+        assert [row["code"] for row in await storage.personal_stats(2, "month")] == ["joke", "story"]
+
+        details = await storage.personal_details(1)
+        minutes = {row["bucket"]: row["events"] for row in details.histogram if row["dim"] == HIST_MINUTES}
+        # 10 — корзина 6-10, 20 — 11-20.
+        assert minutes == {2: 1, 3: 1}
+        assert details.activity is not None and details.activity["current_streak"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_global_top_and_weekly_ranks() -> None:
+    async def scenario() -> None:
+        storage = ColumnarStorage()
+        await _fill(storage)
+        top = await storage.global_top("week", min_records=1)
+        assert top["joke_count"] == [{"display_name": "alice", "total": 2}]
+        assert top["time"] == [{"display_name": "Bob", "total_minutes": 45}, {"display_name": "alice", "total_minutes": 30}]
+        # Порог по событиям своего типа: у Боба одна шутка за месяц.
+        assert (await storage.global_top("month", min_records=2))["joke_count"] == [{"display_name": "alice", "total": 2}]
+
+        summary = await storage.weekly_summary(2)
+        assert summary.ranks == {"joke_rank": None, "story_rank": 1, "time_rank": 1}
+        assert (await storage.weekly_summary(3)).records == []
+
+    asyncio.run(scenario())
+
+
+def test_unknown_type_is_rejected() -> None:
+    async def scenario() -> None:
+        storage = ColumnarStorage()
+        with pytest.raises(ValueError):
+            await storage.insert_event(1, "poem", 10, 5)
+
+    asyncio.run(scenario())
+
+
+def test_survives_restart(tmp_path: Path) -> None:
+    async def scenario() -> None:
+        storage = ColumnarStorage(tmp_path)
+        await storage.connect()
+        # Импорт сразу пишет снимок, следующие строки остаются только в журнале.
+        await _fill(storage)
+        await storage.insert_event(1, "story", 15, 5)
+        expected = await storage.personal_stats(1, "all")
+
+        # Рестарт после падения: close() не было.
+        restored = ColumnarStorage(tmp_path)
+        await restored.connect()
+        assert await restored.personal_stats(1, "all") == expected
+        assert (await restored.global_top("all", min_records=1))["time"][0]["display_name"] == "Bob"
+        await restored.close()
+
+    asyncio.run(scenario())
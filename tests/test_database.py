@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+import pytest
+
+from bot.database import Database
+from bot.leaderboard import Leaderboard
+from bot.metrics import DB_SHED
+from bot.sql import PERIOD_DAYS, statement_name
+from bot.storage import DatabaseBusy, WeeklySummary
+
+from .fakes import FakePool
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+# Реплика; без неё чтения идут во второй пул к той же базе.
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL") or DATABASE_URL
+
+
+def test_recent_writers_read_from_primary() -> None:
+    database = Database(dsn="postgresql://primary", read_dsn="postgresql://replica", read_your_writes_window=60)
+    assert database._reader(1) is None
+    replica = object()
+    database._read_pool = replica  # type: ignore[assignment]
+    database._recent_writers.set(1, True)
+    assert database._reader(1) is None
+    assert database._reader(2) is replica
+    assert database._reader() is replica
+
+
+def test_summary_after_insert_does_not_join_an_older_query(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario() -> None:
+        database = Database(dsn="postgresql://primary")
+        database._pool = object()  # type: ignore[assignment]
+        events = 0
+        release = asyncio.Event()
+
+        async def fetch(user_id: int) -> WeeklySummary:
+            seen = events
+            await release.wait()
+            return WeeklySummary(records=[{"code": "joke", "total_events": seen}], ranks={})
+
+        async def write(*args: object) -> None:
+            nonlocal events
+            events += 1
+
+        monkeypatch.setattr(database, "_fetch_weekly_summary", fetch)
+        monkeypatch.setattr(database, "_write_event", write)
+        before = asyncio.create_task(database.weekly_summary(1))
+        await asyncio.sleep(0.01)
+        await database.insert_event(1, "joke", 10, 5)
+        after = asyncio.create_task(database.weekly_summary(1))
+        await asyncio.sleep(0.01)
+        release.set()
+        assert (await before).records[0]["total_events"] == 0
+        assert (await after).records[0]["total_events"] == 1
+        assert database._summary_last.get(1).records[0]["total_events"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_in_memory_leaderboard_summary_falls_back_at_the_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario() -> tuple[WeeklySummary, WeeklySummary]:
+        database = Database(dsn="postgresql://primary", leaderboard=True, summary_deadline_ms=20)
+        database._pool = object()  # type: ignore[assignment]
+        hang = asyncio.Event()
+
+        async def personal_stats(user_id: int, period: str) -> list[dict[str, object]]:
+            if hang.is_set():
+                await asyncio.Event().wait()
+            return [{"code": "joke", "total_events": 1}]
+
+        monkeypatch.setattr(database, "personal_stats", personal_stats)
+        fresh = await database.weekly_summary(1)
+        hang.set()
+        stale = await database.weekly_summary(1)
+        database._summary_inflight.pop(1).cancel()
+        return fresh, stale
+
+    fresh, stale = asyncio.run(scenario())
+    assert not fresh.stale_records
+    assert stale.stale_records and not stale.stale_ranks
+    assert stale.records == fresh.records
+    assert stale.ranks == fresh.ranks
+
+
+def test_leaderboard_refresh_skips_a_reload_overlapping_a_write(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario() -> tuple[bool, bool, dict[str, int | None]]:
+        database = Database(dsn="postgresql://primary", leaderboard=True)
+        database._pool = object()  # type: ignore[assignment]
+        write_during_load = True
+
+        async def load(leaderboard: Leaderboard) -> None:
+            leaderboard.load_total(1, "joke", 3, 30, 12)
+            if write_during_load:
+                await database.insert_event(2, "joke", 10, 5)
+
+        async def write(*args: object) -> None:
+            pass
+
+        monkeypatch.setattr(database, "_load_leaderboard", load)
+        monkeypatch.setattr(database, "_write_event", write)
+        raced = await database.refresh_leaderboard()
+        write_during_load = False
+        clean = await database.refresh_leaderboard()
+        assert database._leaderboard is not None
+        return raced, clean, database._leaderboard.ranks("all", 1)
+
+    raced, clean, ranks = asyncio.run(scenario())
+    assert not raced
+    assert clean
+    assert ranks["joke_rank"] == 1
+
+
+def test_saturated_pool_sheds_reads_and_times_out_writes() -> None:
+    async def scenario() -> dict[tuple[str, ...], float]:
+        database = Database(dsn="postgresql://primary", acquire_timeout=0.05, shed_queue_depth=1)
+        database._pool = FakePool(size=1)  # type: ignore[assignment]
+        before = dict(DB_SHED._values)
+        release = asyncio.Event()
+        held = asyncio.Event()
+
+        async def hold() -> None:
+            async with database._acquire():
+                held.set()
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await held.wait()
+        # Запись встаёт в очередь к пулу, пока соединение занято.
+        writer = asyncio.create_task(_acquire_once(database))
+        await asyncio.sleep(0)
+        with pytest.raises(DatabaseBusy, match="saturated"):
+            await _acquire_once(database, read=True)
+        with pytest.raises(DatabaseBusy, match="Timed out"):
+            await writer
+        release.set()
+        await holder
+        # Соединение вернулось в пул — запросы снова проходят.
+        await _acquire_once(database, read=True)
+        return {key: value - before.get(key, 0.0) for key, value in DB_SHED._values.items()}
+
+    shed = asyncio.run(scenario())
+    assert shed[("saturated",)] == 1
+    assert shed[("acquire_timeout",)] == 1
+
+
+async def _acquire_once(database: Database, *, read: bool = False) -> None:
+    async with database._acquire(read=read):
+        pass
+
+
+def test_cached_user_skips_the_upsert_until_the_profile_changes() -> None:
+    async def scenario() -> tuple[list[str], list[str | None]]:
+        database = Database(dsn="postgresql://primary")
+        pool = FakePool()
+        pool.rows["upsert_user"] = lambda telegram_id, username, first_name: {
+            "id": telegram_id,
+            "username": username,
+            "first_name": first_name,
+            "joined_at": None,
+        }
+        database._pool = pool  # type: ignore[assignment]
+        users = [
+            await database.get_or_create_user(7, "old", "Seven"),
+            await database.get_or_create_user(7, "old", "Seven"),
+            await database.get_or_create_user(7, "new", "Seven"),
+            await database.get_or_create_user(7, "new", "Seven"),
+        ]
+        return pool.calls, [user.username for user in users]
+
+    calls, usernames = asyncio.run(scenario())
+    assert calls == ["upsert_user", "upsert_user"]
+    assert usernames == ["old", "old", "new", "new"]
+
+
+def test_unknown_type_is_inserted_by_code_and_refreshes_the_registry() -> None:
+    async def scenario() -> tuple[list[str], dict[str, int]]:
+        database = Database(dsn="postgresql://primary")
+        pool = FakePool()
+        pool.rows["insert_event_by_code"] = {"id": 1}
+        pool.rows["select_types"] = [{"code": "joke", "id": 1}, {"code": "poem", "id": 3}]
+        database._pool = pool  # type: ignore[assignment]
+        database._types = {"joke": 1}
+        await database.insert_event(7, "poem", 5, 4)
+        # Тип уже в реестре: следующая запись идёт обычным insert_event.
+        await database.insert_event(7, "poem", 5, 4)
+        pool.rows["insert_event_by_code"] = None
+        with pytest.raises(ValueError, match="Unknown type_code: ode"):
+            await database.insert_event(7, "ode", 5, 4)
+        return pool.calls, dict(database.types)
+
+    calls, types = asyncio.run(scenario())
+    assert calls == ["insert_event_by_code", "select_types", "insert_event", "insert_event_by_code"]
+    assert types == {"joke": 1, "poem": 3}
+
+
+def _write_snapshot(path: Path, *, age: float) -> None:
+    snapshot = {
+        "saved_at": time.time() - age,
+        "users": [[7, 7, "cached", "Cached", "2024-01-01T00:00:00+00:00"]],
+        "tops": [["week", 5, {"joke_count": [{"user_id": 7, "total": 1}], "story_count": [], "time": [], "rating_by_type": []}]],
+    }
+    path.write_text(json.dumps(snapshot), encoding="utf-8")
+
+
+def test_cache_snapshot_older_than_an_hour_is_ignored(tmp_path: Path) -> None:
+    async def scenario() -> tuple[int, int, int, int]:
+        stale, fresh = Database(dsn="postgresql://primary"), Database(dsn="postgresql://primary")
+        _write_snapshot(tmp_path / "stale.json", age=3601)
+        _write_snapshot(tmp_path / "fresh.json", age=60)
+        await stale.restore_cache_snapshot(tmp_path / "stale.json")
+        await fresh.restore_cache_snapshot(tmp_path / "fresh.json")
+        return len(stale._users), len(stale._top_last), len(fresh._users), len(fresh._top_last)
+
+    assert asyncio.run(scenario()) == (0, 0, 1, 1)
+
+
+def test_restored_top_is_only_a_deadline_fallback(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    async def top_after_restore(*, hang: bool) -> dict[str, object]:
+        database = Database(dsn="postgresql://primary", top_deadline_ms=20)
+        database._pool = object()  # type: ignore[assignment]
+        _write_snapshot(tmp_path / "snapshot.json", age=60)
+        await database.restore_cache_snapshot(tmp_path / "snapshot.json")
+
+        async def compute(period: str, min_records: int) -> dict[str, object]:
+            if hang:
+                await asyncio.Event().wait()
+            return {"joke_count": [{"user_id": 8, "total": 2}], "story_count": [], "time": [], "rating_by_type": []}
+
+        monkeypatch.setattr(database, "_compute_global_top", compute)
+        try:
+            return await database.global_top("week")
+        finally:
+            for task in database._top_inflight.values():
+                task.cancel()
+
+    # Восстановленный топ не лежит в свежем кеше: запрос идёт в базу...
+    fresh = asyncio.run(top_after_restore(hang=False))
+    assert fresh["joke_count"] == [{"user_id": 8, "total": 2}]
+    assert "approximate" not in fresh
+    # ...и отдаётся, только когда база не успела к дедлайну.
+    fallback = asyncio.run(top_after_restore(hang=True))
+    assert fallback["joke_count"] == [{"user_id": 7, "total": 1}]
+    assert fallback["approximate"] is True
+
+
+def test_failing_warm_up_query_does_not_stop_connect(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario() -> tuple[dict[str, float], set[tuple[str, int]]]:
+        database = Database(dsn="postgresql://primary", warmup=True, pool_min_size=2)
+        pool = FakePool()
+        pool.fail_statements = {statement_name("top_joke", "week")}
+
+        async def create_pool(dsn: str) -> FakePool:
+            return pool
+
+        async def noop(*args: object, **kwargs: object) -> None:
+            pass
+
+        monkeypatch.setattr(database, "_create_pool", create_pool)
+        monkeypatch.setattr(database, "refresh_types", noop)
+        monkeypatch.setattr(database, "maintain_partitions", noop)
+        await database.connect()
+        warmed = {key for key, _ in database._top_last.items()}
+        await database.close()
+        return database.startup_timings, warmed
+
+    timings, warmed = asyncio.run(scenario())
+    assert "warmup" in timings
+    assert warmed == {(period, 5) for period in PERIOD_DAYS if period != "week"}
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_summary_right_after_insert_sees_the_event() -> None:
+    async def scenario() -> None:
+        database = Database(dsn=DATABASE_URL, read_dsn=DATABASE_READ_URL, user_stats_cache_size=100)
+        await database.connect()
+        try:
+            user = await database.get_or_create_user(random.randint(10**12, 2 * 10**12), None, "test")
+            before = await database.personal_stats(user.id, "day")
+            await database.insert_event(user.id, "joke", 17, 4)
+            rows = await database.personal_stats(user.id, "day")
+            summary = await database.weekly_summary(user.id)
+        finally:
+            await database.close()
+        assert before == []
+        assert rows == [{"code": "joke", "total_events": 1, "total_minutes": 17, "avg_rating": 4.0}]
+        assert summary.ranks["joke_rank"] is not None
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_tied_users_share_a_weekly_rank() -> None:
+    async def scenario() -> list[dict[str, int | None]]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            ranks = []
+            # Двое с одинаковыми итогами и один с большим: остальные пользователи базы
+            # сдвигают места, но не разводят ничью.
+            for jokes in (2, 2, 3):
+                user = await database.get_or_create_user(random.randint(10**12, 2 * 10**12), None, "tie")
+                for _ in range(jokes):
+                    await database.insert_event(user.id, "joke", 10, 4)
+                ranks.append((await database.weekly_summary(user.id)).ranks)
+        finally:
+            await database.close()
+        return ranks
+
+    first, second, leader = asyncio.run(scenario())
+    assert first == second
+    assert first["story_rank"] is None
+    assert leader["joke_rank"] is not None and first["joke_rank"] is not None
+    assert leader["joke_rank"] < first["joke_rank"]
+    assert leader["time_rank"] < first["time_rank"]
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_prepared_statements_survive_pool_release() -> None:
+    async def scenario() -> list[int]:
+        database = Database(dsn=DATABASE_URL, pool_min_size=1, pool_max_size=1)
+        await database.connect()
+        try:
+            counts = []
+            # Одно соединение: второй acquire получает то же, уже возвращённое в пул.
+            for _ in range(2):
+                async with database._acquire() as conn:
+                    counts.append(len(await conn.fetch_prepared("select_types")))
+        finally:
+            await database.close()
+        return counts
+
+    first, second = asyncio.run(scenario())
+    assert first == second > 0
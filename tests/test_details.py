@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any
+
+import pytest
+
+from bot.database import Database
+from bot.sql import HIST_DOW, HIST_HOUR, HIST_MINUTES, HIST_RATING
+from bot.storage import ImportedEvent
+from bot.texts import personal_details_text
+from bot.utils import build_personal_details
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+TODAY = date(2030, 1, 9)
+
+
+def _row(dim: int, bucket: int, events: int) -> dict[str, int]:
+    return {"dim": dim, "bucket": bucket, "events": events}
+
+
+def test_details_place_rows_into_buckets() -> None:
+    rows = [
+        _row(HIST_RATING, 5, 3),
+        _row(HIST_MINUTES, 6, 2),
+        _row(HIST_DOW, 0, 4),
+        _row(HIST_HOUR, 23, 1),
+        # Чужие измерения и корзины вне диапазона молча пропускаются.
+        _row(99, 0, 7),
+        _row(HIST_HOUR, 24, 7),
+    ]
+    details = build_personal_details(rows, None, TODAY)
+    assert details["rating"] == [0, 0, 0, 0, 0, 3]
+    assert details["minutes"] == [0, 0, 0, 0, 0, 0, 2]
+    assert details["dow"] == [4, 0, 0, 0, 0, 0, 0]
+    assert details["hour"][23] == 1 and sum(details["hour"]) == 1
+    assert details["streak"] == {"current": 0, "best": 0, "active_days": 0}
+
+
+@pytest.mark.parametrize(("last_day", "current"), [(TODAY, 3), (TODAY - timedelta(days=1), 3), (TODAY - timedelta(days=2), 0)])
+def test_streak_is_current_only_through_yesterday(last_day: date, current: int) -> None:
+    activity = {"last_day": last_day, "current_streak": 3, "best_streak": 5, "active_days": 9}
+    details = build_personal_details([], activity, TODAY)
+    assert details["streak"] == {"current": current, "best": 5, "active_days": 9}
+
+
+def test_details_text_starts_week_on_monday_and_lists_active_hours() -> None:
+    rows = [_row(HIST_DOW, 0, 2), _row(HIST_DOW, 1, 4), _row(HIST_HOUR, 7, 1), _row(HIST_MINUTES, 1, 1)]
+    activity = {"last_day": TODAY, "current_streak": 2, "best_streak": 4, "active_days": 6}
+    lines = personal_details_text(build_personal_details(rows, activity, TODAY)).splitlines()
+    assert "Оценки: пока пусто" in lines
+    days = lines[lines.index("Дни недели:") + 1 : lines.index("Дни недели:") + 8]
+    assert days[0] == "пн ▇▇▇▇▇▇▇▇▇▇ 4"
+    assert days[-1] == "вс ▇▇▇▇▇ 2"
+    assert lines[lines.index("Часы (UTC):") + 1 :][:1] == ["07 ▇▇▇▇▇▇▇▇▇▇ 1"]
+    assert lines[lines.index("Минуты:") + 1] == "1-5 ▇▇▇▇▇▇▇▇▇▇ 1"
+    assert lines[-1] == "Серия: сейчас 2 дн., рекорд 4 дн., активных дней 6"
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_import_buckets_in_utc_and_rebuilds_streaks() -> None:
+    # Две серии: три дня подряд, пропуск, ещё два дня.
+    first = datetime.now(timezone.utc).date() - timedelta(days=10)
+    days = [first, first + timedelta(days=1), first + timedelta(days=2), first + timedelta(days=5), first + timedelta(days=6)]
+    # 01:30 по Москве — это 22:30 UTC предыдущего дня.
+    moscow = timezone(timedelta(hours=3))
+
+    async def scenario() -> tuple[dict[tuple[int, int], int], Any]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            user_id = random.randint(10**12, 2 * 10**12)
+            events = [
+                ImportedEvent(user_id, None, "details", "joke", minutes, 4, datetime.combine(day, time(12), timezone.utc))
+                for day, minutes in zip(days, (5, 6, 20, 61, 500))
+            ]
+            events.append(
+                ImportedEvent(user_id, None, "details", "story", 1, 2, datetime.combine(days[1] + timedelta(days=1), time(1, 30), moscow))
+            )
+            assert await database.bulk_import(events) == len(events)
+            details = await database.personal_details(user_id)
+            buckets = {(row["dim"], row["bucket"]): row["events"] for row in details.histogram}
+            return buckets, details.activity
+        finally:
+            await database.close()
+
+    buckets, activity = asyncio.run(scenario())
+    assert [buckets.get((HIST_MINUTES, bucket), 0) for bucket in range(1, 7)] == [2, 1, 1, 0, 0, 2]
+    assert buckets[(HIST_RATING, 4)] == 5 and buckets[(HIST_RATING, 2)] == 1
+    assert buckets[(HIST_HOUR, 12)] == 5 and buckets[(HIST_HOUR, 22)] == 1
+    assert buckets[(HIST_DOW, (days[1].isoweekday()) % 7)] == 2
+    # Московское событие легло во второй день серии, новых дней не добавило.
+    assert activity["last_day"] == days[-1]
+    assert (activity["current_streak"], activity["best_streak"], activity["active_days"]) == (2, 3, 5)
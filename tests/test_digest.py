@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+from datetime import date, timedelta
+from typing import Any
+
+import pytest
+
+from bot.database import Database
+from bot.digest import WeeklyDigest
+from bot.outbox import Outbox
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+WEEK = date(2030, 1, 7)
+ROW = {
+    "codes": ["joke"],
+    "events": [1],
+    "minutes": [10],
+    "avg_ratings": [4],
+    "joke_rank": 1,
+    "story_rank": None,
+    "time_rank": 1,
+}
+
+
+class SnapshotDatabase:
+    # Снимок недели в памяти: user_id -> отправлен ли дайджест.
+    def __init__(self, user_ids: list[int], *, crash_after_marks: int | None = None) -> None:
+        self.sent = {user_id: False for user_id in user_ids}
+        self.pages: list[list[int]] = []
+        self._crash_after_marks = crash_after_marks
+
+    async def prepare_weekly_digest(self, week: date) -> int:
+        return 0
+
+    async def weekly_digest_pending(self, week: date, *, after_user_id: int, limit: int) -> list[dict[str, Any]]:
+        pending = [user_id for user_id, sent in sorted(self.sent.items()) if not sent and user_id > after_user_id]
+        self.pages.append(pending[:limit])
+        return [ROW | {"user_id": user_id} for user_id in pending[:limit]]
+
+    async def mark_digest_sent(self, week: date, user_ids: list[int]) -> None:
+        if self._crash_after_marks == 0:
+            raise ConnectionError("database went away")
+        for user_id in user_ids:
+            self.sent[user_id] = True
+        if self._crash_after_marks is not None:
+            self._crash_after_marks -= 1
+
+
+class DeliveringBot:
+    def __init__(self, *, unreachable: set[int] | None = None) -> None:
+        self.chats: list[int] = []
+        self._unreachable = unreachable or set()
+
+    async def send_message(self, **kwargs: Any) -> None:
+        if kwargs["chat_id"] in self._unreachable:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+        self.chats.append(kwargs["chat_id"])
+
+
+async def _send(database: SnapshotDatabase, bot: DeliveringBot) -> int:
+    outbox = Outbox(bot, chat_rate=100.0)  # type: ignore[arg-type]
+    outbox.start()
+    try:
+        digest = WeeklyDigest(database, outbox, chunk_size=2)  # type: ignore[arg-type]
+        return await asyncio.wait_for(digest.send(WEEK), timeout=5)
+    finally:
+        await outbox.close()
+
+
+def test_undelivered_recipients_stay_pending() -> None:
+    database = SnapshotDatabase([1, 2, 3, 4, 5])
+    sent = asyncio.run(_send(database, DeliveringBot(unreachable={2, 5})))
+    assert sent == 3
+    assert [user_id for user_id, done in database.sent.items() if not done] == [2, 5]
+    # Курсор идёт дальше недоставленных — пачки не зацикливаются.
+    assert database.pages == [[1, 2], [3, 4], [5], []]
+
+
+def test_resume_after_crash_skips_marked_chunks() -> None:
+    database = SnapshotDatabase([1, 2, 3, 4, 5], crash_after_marks=1)
+    first = DeliveringBot()
+    with pytest.raises(ConnectionError):
+        asyncio.run(_send(database, first))
+    assert first.chats == [1, 2, 3, 4]
+
+    database.pages.clear()
+    second = DeliveringBot()
+    assert asyncio.run(_send(database, second)) == 3
+    # Повторно уходит только пачка, которую не успели отметить.
+    assert second.chats == [3, 4, 5]
+    assert all(database.sent.values())
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_snapshot_covers_seven_full_days_before_the_week() -> None:
+    async def scenario() -> tuple[int, list[Any], int]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            user_id = random.randint(10**12, 2 * 10**12)
+            await database.get_or_create_user(user_id, None, "digest")
+            joke = database.types["joke"]
+            days = [WEEK - timedelta(days=8), WEEK - timedelta(days=7), WEEK - timedelta(days=1), WEEK]
+            async with database._acquire() as conn:
+                await conn.execute("DELETE FROM weekly_digest WHERE week = $1", WEEK)
+                await conn.executemany(
+                    "INSERT INTO user_type_daily (user_id, type_id, day, events, minutes, rating_sum)"
+                    " VALUES ($1, $2, $3, 1, $4, 4)",
+                    [(user_id, joke, day, minutes) for day, minutes in zip(days, (1, 10, 100, 1000))],
+                )
+            try:
+                prepared = await database.prepare_weekly_digest(WEEK)
+                repeated = await database.prepare_weekly_digest(WEEK)
+                async with database._acquire() as conn:
+                    row = await conn.fetchrow(
+                        "SELECT events, minutes FROM weekly_digest WHERE week = $1 AND user_id = $2", WEEK, user_id
+                    )
+            finally:
+                async with database._acquire() as conn:
+                    await conn.execute("DELETE FROM user_type_daily WHERE user_id = $1", user_id)
+                    await conn.execute("DELETE FROM weekly_digest WHERE week = $1", WEEK)
+            return prepared, list(row), repeated
+        finally:
+            await database.close()
+
+    prepared, row, repeated = asyncio.run(scenario())
+    assert prepared >= 1
+    # В окно попадают дни с week-7 по week-1 включительно.
+    assert row == [[2], [110]]
+    assert repeated == 0
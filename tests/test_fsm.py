@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from bot import fsm
+from bot.fsm import BoundedMemoryStorage, PostgresStorage
+from bot.states import AddEventState
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    now = [1000.0]
+    monkeypatch.setattr(fsm.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_state_and_data_round_trip(clock: list[float]) -> None:
+    async def scenario() -> None:
+        storage = BoundedMemoryStorage()
+        await storage.set_state(_key(1), AddEventState.waiting_for_minutes)
+        await storage.set_data(_key(1), {"type_code": "joke"})
+        assert await storage.get_state(_key(1)) == AddEventState.waiting_for_minutes.state
+        assert await storage.get_data(_key(1)) == {"type_code": "joke"}
+        assert await storage.get_state(_key(2)) is None
+        assert await storage.get_data(_key(2)) == {}
+
+        # Пустое состояние и данные — записи больше нет.
+        await storage.set_state(_key(1), None)
+        await storage.set_data(_key(1), {})
+        assert len(storage) == 0
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_flows_expire(clock: list[float]) -> None:
+    async def scenario() -> None:
+        storage = BoundedMemoryStorage(ttl=60)
+        await storage.set_state(_key(1), AddEventState.waiting_for_minutes)
+        clock[0] += 30
+        await storage.set_state(_key(2), AddEventState.waiting_for_rating)
+        clock[0] += 31
+        assert await storage.get_state(_key(1)) is None
+        assert await storage.get_state(_key(2)) == AddEventState.waiting_for_rating.state
+        assert len(storage) == 1
+
+    asyncio.run(scenario())
+
+
+def test_entries_are_bounded(clock: list[float]) -> None:
+    async def scenario() -> None:
+        storage = BoundedMemoryStorage(max_entries=2)
+        for user_id in (1, 2, 3):
+            clock[0] += 1
+            await storage.set_state(_key(user_id), AddEventState.waiting_for_minutes)
+        assert len(storage) == 2
+        assert await storage.get_state(_key(1)) is None
+        assert await storage.get_state(_key(3)) == AddEventState.waiting_for_minutes.state
+
+    asyncio.run(scenario())
+
+
+def test_postgres_storage_creates_one_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    created: list[object] = []
+
+    async def create_pool(**kwargs: object) -> object:
+        await asyncio.sleep(0.01)
+        created.append(object())
+        return created[-1]
+
+    async def scenario() -> None:
+        storage = PostgresStorage("postgresql://fsm")
+        pools = await asyncio.gather(*(storage._connect() for _ in range(16)))
+        assert len(created) == 1
+        assert all(pool is created[0] for pool in pools)
+
+    monkeypatch.setattr(fsm.asyncpg, "create_pool", create_pool)
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_postgres_flow_after_expiry_starts_clean() -> None:
+    async def scenario() -> list[object]:
+        storage = PostgresStorage(DATABASE_URL, ttl=60)
+        key = _key(random.randint(10**12, 2 * 10**12))
+
+        async def expire() -> None:
+            pool = await storage._connect()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "UPDATE fsm_state SET updated_at = CURRENT_TIMESTAMP - INTERVAL '2 minutes' WHERE key = $1",
+                    storage._key(key),
+                )
+
+        try:
+            await storage.set_state(key, AddEventState.waiting_for_rating)
+            await storage.set_data(key, {"type_code": "joke", "minutes": 15})
+            await expire()
+            # Вернулся после TTL: новый сценарий без минут из старого.
+            await storage.set_state(key, AddEventState.waiting_for_minutes)
+            fresh_data = await storage.get_data(key)
+            await storage.set_data(key, {"type_code": "story"})
+            await expire()
+            await storage.set_data(key, {"type_code": "joke"})
+            fresh_state = await storage.get_state(key)
+            await storage.set_state(key, None)
+            await storage.set_data(key, {})
+            return [fresh_data, fresh_state]
+        finally:
+            await storage.close()
+
+    fresh_data, fresh_state = asyncio.run(scenario())
+    assert fresh_data == {}
+    assert fresh_state is None
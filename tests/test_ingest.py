@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from bot.ingest import EventBatcher
+
+from .fakes import FakePool
+
+
+async def _submit_all(batcher: EventBatcher, records: list[tuple[int, int, int, int]]) -> list[BaseException | None]:
+    return await asyncio.gather(*(batcher.submit(record) for record in records), return_exceptions=True)
+
+
+def test_batches_are_copied_in_one_go() -> None:
+    async def scenario() -> FakePool:
+        pool = FakePool()
+        batcher = EventBatcher(pool.acquire, max_rows=3, max_delay=0.05)
+        batcher.start()
+        first = await _submit_all(batcher, [(1, user_id, 10, 5) for user_id in range(1, 4)])
+        # Пачка неполная — уходит по max_delay.
+        second = await _submit_all(batcher, [(2, 1, 10, 5)])
+        await batcher.close()
+        assert first == [None] * 3 and second == [None]
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert [len(batch) for batch in pool.copied] == [3, 1]
+    assert pool.inserted == []
+
+
+def test_bad_row_fails_alone() -> None:
+    async def scenario() -> tuple[FakePool, list[BaseException | None]]:
+        pool = FakePool()
+        pool.fail_copy = True
+        pool.bad_records.add((1, 2, 10, 5))
+        batcher = EventBatcher(pool.acquire, max_rows=3, max_delay=1.0)
+        batcher.start()
+        results = await _submit_all(batcher, [(1, 1, 10, 5), (1, 2, 10, 5), (1, 3, 10, 5)])
+        await batcher.close()
+        return pool, results
+
+    pool, results = asyncio.run(scenario())
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], ValueError)
+    assert pool.inserted == [(1, 1, 10, 5), (1, 3, 10, 5)]
+
+
+def test_fallback_without_connection_keeps_batcher_alive() -> None:
+    async def scenario() -> FakePool:
+        pool = FakePool()
+        batcher = EventBatcher(pool.acquire, max_rows=2, max_delay=1.0)
+        batcher.start()
+        # База недоступна: ни для COPY, ни для построчной досылки соединения нет.
+        pool.fail_acquire = 2
+        results = await asyncio.wait_for(_submit_all(batcher, [(1, 1, 10, 5), (1, 2, 10, 5)]), timeout=5)
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+        await asyncio.wait_for(batcher.submit((1, 3, 10, 5)), timeout=5)
+        await batcher.close()
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.copied == [[(1, 3, 10, 5)]]
+
+
+def test_submit_requires_running_batcher() -> None:
+    async def scenario() -> None:
+        batcher = EventBatcher(FakePool().acquire, max_rows=2, max_delay=0.01)
+        with pytest.raises(RuntimeError):
+            await batcher.submit((1, 1, 10, 5))
+
+    asyncio.run(scenario())
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from bot import leaderboard
+from bot.leaderboard import Leaderboard, RankedSet
+
+
+def test_ranked_set_matches_sorted_list() -> None:
+    rng = random.Random(1)
+    ranked = RankedSet()
+    reference: list[tuple[int, int]] = []
+    for _ in range(2000):
+        key = (rng.randint(-50, 0), rng.randint(1, 200))
+        if key in reference and rng.random() < 0.5:
+            ranked.remove(key)
+            reference.remove(key)
+        elif key not in reference:
+            ranked.add(key)
+            reference.append(key)
+    reference.sort()
+    assert list(ranked) == reference
+    assert len(ranked) == len(reference)
+    assert ranked.head(10) == reference[:10]
+    for probe in rng.sample(reference, 50):
+        assert ranked.count_less(probe) == reference.index(probe)
+
+
+@pytest.fixture
+def today(monkeypatch: pytest.MonkeyPatch) -> list[date]:
+    current = [date(2026, 3, 10)]
+    monkeypatch.setattr(leaderboard, "_utc_today", lambda: current[0])
+    return current
+
+
+def test_rank_counts_only_strictly_better_users(today: list[date]) -> None:
+    board = Leaderboard()
+    for user_id, jokes in ((1, 3), (2, 3), (3, 1)):
+        for _ in range(jokes):
+            board.record(user_id, "joke", 10, 5)
+    assert board.rank("week", "joke", 1) == 1
+    assert board.rank("week", "joke", 2) == 1
+    assert board.rank("week", "joke", 3) == 3
+    assert board.rank("week", "story", 1) is None
+
+
+def test_top_applies_min_records_per_type(today: list[date]) -> None:
+    board = Leaderboard()
+    board.set_display_name(1, "many-stories")
+    board.set_display_name(2, "jokes")
+    for _ in range(5):
+        board.record(1, "story", 10, 4)
+    for _ in range(2):
+        board.record(1, "joke", 60, 4)
+    for _ in range(3):
+        board.record(2, "joke", 5, 4)
+    top = board.top("week", min_records=3)
+    # У первого 7 событий, но шуток только две — как HAVING COUNT(*) в SQL.
+    assert top["joke_count"] == [{"display_name": "jokes", "total": 3}]
+    assert top["story_count"] == [{"display_name": "many-stories", "total": 5}]
+    assert [row["display_name"] for row in top["time"]] == ["many-stories", "jokes"]
+
+
+def test_window_slides_with_the_day(today: list[date]) -> None:
+    board = Leaderboard()
+    board.record(1, "joke", 10, 5)
+    board.load_day(today[0] - timedelta(days=5), 2, "joke", 4, 40)
+    assert board.rank("day", "joke", 2) is None
+    assert board.rank("week", "joke", 2) == 1
+
+    # Окно в N дней — сегодня и N-1 предыдущих суток (UTC), как _since в SQL.
+    today[0] += timedelta(days=1)
+    assert board.rank("day", "joke", 1) is None
+    assert board.rank("week", "joke", 1) == 2
+    assert board.rank("week", "joke", 2) == 1
+    today[0] += timedelta(days=1)
+    assert board.rank("week", "joke", 1) == 1
+    assert board.rank("week", "joke", 2) is None
+    assert board.rank("month", "joke", 2) == 1
+
+
+@pytest.mark.parametrize("min_records", [0, 1, 3, 8, 40])
+def test_top_matches_a_full_scan(today: list[date], min_records: int) -> None:
+    rng = random.Random(min_records)
+    board = Leaderboard()
+    for _ in range(3000):
+        board.record(rng.randint(1, 300), rng.choice(["joke", "story", "poem"]), rng.randint(1, 60), 4)
+    scores = board._boards["all"].scores
+    for metric, counts in (("joke", "joke"), ("story", "story"), ("minutes", "events")):
+        eligible = [user_id for user_id, score in scores[metric].items() if scores[counts].get(user_id, 0) >= min_records]
+        expected = sorted(eligible, key=lambda user_id: (-scores[metric][user_id], user_id))[:10]
+        top = board._boards["all"].top(metric, 10, min_records)
+        assert [user_id for user_id, _ in top] == expected
+        assert [score for _, score in top] == [scores[metric][user_id] for user_id in expected]
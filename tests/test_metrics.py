@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+import pytest
+
+from bot import metrics
+from bot.metrics import (
+    DB_METHOD_ERRORS,
+    DB_METHOD_SECONDS,
+    Registry,
+    SlowQueryExplainer,
+    UpdateTimings,
+    bind_update_timings,
+    timed_method,
+    unbind_update_timings,
+)
+
+
+def test_registry_renders_prometheus_text() -> None:
+    registry = Registry()
+    counter = registry.counter("test_total", "Things counted", ("kind",))
+    histogram = registry.histogram("test_seconds", "Time spent")
+    histogram.buckets = (0.1, 1.0)
+    counter.inc(kind='say "hi"\n')
+    counter.inc(2, kind="a")
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+    assert registry.render() == (
+        "# HELP test_total Things counted\n"
+        "# TYPE test_total counter\n"
+        'test_total{kind="a"} 2.0\n'
+        'test_total{kind="say \\"hi\\"\\n"} 1.0\n'
+        "# HELP test_seconds Time spent\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{le="0.1"} 1\n'
+        'test_seconds_bucket{le="1.0"} 2\n'
+        'test_seconds_bucket{le="+Inf"} 3\n'
+        "test_seconds_sum 5.55\n"
+        "test_seconds_count 3\n"
+    )
+
+
+def test_nested_timed_methods_count_once_per_update(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Часы: outer стартует в 0, inner идёт с 1 до 3, outer заканчивается в 4.
+    clock = iter([0.0, 1.0, 3.0, 4.0])
+    monkeypatch.setattr(metrics.time, "perf_counter", lambda: next(clock))
+
+    @timed_method
+    async def inner() -> None:
+        raise ValueError("boom")
+
+    @timed_method
+    async def outer() -> None:
+        with pytest.raises(ValueError):
+            await inner()
+
+    async def scenario() -> UpdateTimings:
+        timings = UpdateTimings()
+        token = bind_update_timings(timings)
+        try:
+            await outer()
+        finally:
+            unbind_update_timings(token)
+        return timings
+
+    errors = DB_METHOD_ERRORS._values.get(("inner",), 0.0)
+    timings = asyncio.run(scenario())
+    assert timings.db == 4.0
+    assert DB_METHOD_SECONDS._values[("inner",)][1][0] >= 2.0
+    assert DB_METHOD_ERRORS._values[("inner",)] == errors + 1
+    assert ("outer",) not in DB_METHOD_ERRORS._values
+
+
+class ExplainConnection:
+    def __init__(self) -> None:
+        self.queries: list[str] = []
+
+    async def fetch(self, query: str, *args: Any, timeout: float | None = None) -> list[Any]:
+        raise AssertionError("EXPLAIN must bypass the instrumented fetch")
+
+    async def fetch_uninstrumented(self, query: str, *args: Any, timeout: float | None = None) -> list[Any]:
+        self.queries.append(query)
+        return [("Seq Scan on events",)]
+
+
+def test_explainer_uses_the_uninstrumented_path(caplog: pytest.LogCaptureFixture) -> None:
+    conn = ExplainConnection()
+
+    @asynccontextmanager
+    async def acquire() -> AsyncIterator[ExplainConnection]:
+        yield conn
+
+    async def scenario() -> None:
+        explainer = SlowQueryExplainer(acquire)
+        explainer.submit("SELECT * FROM events WHERE user_id = $1", (1,), 0.5)
+        task = explainer._task
+        assert task is not None
+        await task
+        # Повтор того же оператора внутри interval только логируется.
+        explainer.submit("SELECT * FROM events WHERE user_id = $1", (1,), 0.5)
+        assert explainer._task is None
+
+    with caplog.at_level(logging.WARNING, logger="bot.slow_query"):
+        asyncio.run(scenario())
+    assert conn.queries == ["EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM events WHERE user_id = $1"]
+    assert any("Seq Scan on events" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import pytest
+from aiogram import Dispatcher
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+from aiogram.types import Update
+
+from bot.fsm import BoundedMemoryStorage
+from bot.handlers import register_handlers
+from bot.metrics import UPDATE_API_SECONDS, ApiMetricsMiddleware, UpdateMetricsMiddleware
+from bot.outbox import BROADCAST, INTERACTIVE, Outbox, TokenBucket
+
+from .fakes import fake_bot_api, message_update
+
+
+class FakeBot:
+    # retry_after: чат -> сколько раз подряд ответить 429 и с какой паузой.
+    def __init__(self, *, retry_after: dict[int, list[int]] | None = None) -> None:
+        self.sent: list[dict[str, Any]] = []
+        self.sent_at: list[float] = []
+        self._retry_after = retry_after or {}
+
+    async def send_message(self, **kwargs: Any) -> None:
+        pending = self._retry_after.get(kwargs["chat_id"])
+        if pending:
+            raise TelegramRetryAfter(SendMessage(**kwargs), "Too Many Requests", pending.pop(0))
+        self.sent.append(kwargs)
+        self.sent_at.append(asyncio.get_running_loop().time())
+
+
+def test_token_bucket_refills_at_rate() -> None:
+    bucket = TokenBucket(rate=2.0, capacity=2.0)
+    now = bucket.updated_at
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == 0.5
+    assert bucket.delay(now + 0.5) == 0.0
+
+
+def test_back_to_back_summaries_collapse_into_latest() -> None:
+    async def scenario() -> FakeBot:
+        bot = FakeBot()
+        outbox = Outbox(bot, chat_rate=100.0)
+        for index in range(5):
+            outbox.send(1, f"summary {index}", coalesce_key="summary")
+        outbox.send(1, "other")
+        assert outbox.pending() == 2
+        outbox.start()
+        await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+        await outbox.close()
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert [message["text"] for message in bot.sent] == ["summary 4", "other"]
+
+
+def test_interactive_lane_goes_before_broadcast() -> None:
+    async def scenario() -> FakeBot:
+        bot = FakeBot()
+        outbox = Outbox(bot, max_in_flight=1)
+        for chat_id in range(1, 4):
+            outbox.send(chat_id, "digest", lane=BROADCAST)
+        outbox.send(10, "reply")
+        outbox.start()
+        await asyncio.wait_for(outbox.drain(BROADCAST), timeout=5)
+        await outbox.close()
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert bot.sent[0]["text"] == "reply"
+    assert len(bot.sent) == 4
+
+
+def test_per_chat_limit_spaces_out_messages() -> None:
+    async def scenario() -> tuple[FakeBot, float]:
+        bot = FakeBot()
+        outbox = Outbox(bot, chat_rate=20.0, chat_burst=1.0)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for index in range(3):
+            outbox.send(1, str(index))
+        outbox.start()
+        await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+        elapsed = loop.time() - started
+        await outbox.close()
+        return bot, elapsed
+
+    bot, elapsed = asyncio.run(scenario())
+    assert [message["text"] for message in bot.sent] == ["0", "1", "2"]
+    # Первое — из запаса корзины, два следующих — по 1/20 секунды.
+    assert elapsed >= 0.09
+
+
+def test_retry_after_requeues_the_message() -> None:
+    async def scenario() -> FakeBot:
+        bot = FakeBot(retry_after={1: [0]})
+        outbox = Outbox(bot, chat_rate=100.0)
+        outbox.send(1, "hello")
+        outbox.start()
+        await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+        await outbox.close()
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert [message["text"] for message in bot.sent] == ["hello"]
+
+
+def test_retry_after_outlives_the_cached_bucket() -> None:
+    async def scenario() -> tuple[FakeBot, float]:
+        bot = FakeBot(retry_after={1: [2]})
+        # Корзина чата уходит из кеша через 0.1 с, а блокировка — 2 с.
+        outbox = Outbox(bot, chat_rate=10.0, chat_burst=1.0)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        outbox.send(1, "hello")
+        outbox.start()
+        # Сторонний трафик будит отправителя, пока чат 1 заблокирован.
+        for chat_id in range(2, 7):
+            await asyncio.sleep(0.3)
+            outbox.send(chat_id, "other")
+        await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=10)
+        await outbox.close()
+        return bot, bot.sent_at[[message["chat_id"] for message in bot.sent].index(1)] - started
+
+    bot, resent_after = asyncio.run(scenario())
+    assert len(bot.sent) == 6
+    assert resent_after >= 2.0
+
+
+def test_gives_up_after_max_attempts() -> None:
+    async def scenario() -> FakeBot:
+        bot = FakeBot(retry_after={1: [0, 0]})
+        outbox = Outbox(bot, chat_rate=100.0, max_attempts=2)
+        outbox.send(1, "hello")
+        outbox.send(2, "world")
+        outbox.start()
+        await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+        await outbox.close()
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert [message["text"] for message in bot.sent] == ["world"]
+
+
+def test_outbox_retries_after_bot_api_429() -> None:
+    async def scenario() -> tuple[list[str], int]:
+        async with fake_bot_api() as (api, bot):
+            api.retry_after = [1]
+            outbox = Outbox(bot, chat_rate=100.0)
+            outbox.start()
+            for index in range(3):
+                outbox.send(7, f"summary {index}", coalesce_key="summary")
+            await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+            await outbox.close()
+            return [params["text"] for params in api.sent()], len(api.calls)
+
+    texts, calls = asyncio.run(scenario())
+    # Одна сводка вместо трёх; первая попытка получила 429.
+    assert texts == ["summary 2", "summary 2"]
+    assert calls == 2
+
+
+def test_outbox_sends_count_towards_the_update_api_time() -> None:
+    async def scenario() -> tuple[list[float], list[float], int]:
+        async with fake_bot_api() as (api, bot):
+            bot.session.middleware(ApiMetricsMiddleware())
+            outbox = Outbox(bot, chat_rate=100.0)
+            outbox.start()
+            update = Update.model_validate(message_update(1, 7, "hi"), context={"bot": bot})
+            before = list(UPDATE_API_SECONDS._values.get(("message",), ([], [0.0, 0.0]))[1])
+
+            async def handler(event: object, data: dict[str, object]) -> None:
+                outbox.send(7, "first")
+                outbox.send(7, "second")
+
+            await UpdateMetricsMiddleware()(handler, update, {})
+            # Хендлер вернулся, а ответы ещё в очереди — время API пока не записано.
+            pending = list(UPDATE_API_SECONDS._values.get(("message",), ([], [0.0, 0.0]))[1])
+            await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+            await outbox.close()
+            after = UPDATE_API_SECONDS._values[("message",)][1]
+            return [after[0] - before[0], after[1] - before[1]], [pending[1] - before[1]], len(api.sent())
+
+    (api_time, observed), (pending,), sent = asyncio.run(scenario())
+    assert sent == 2
+    assert pending == 0
+    assert observed == 1
+    assert api_time > 0
+
+
+def test_group_summaries_of_different_users_are_not_coalesced() -> None:
+    pytest.importorskip("numpy")
+    from bot.columnar import ColumnarStorage
+
+    async def scenario() -> list[str]:
+        async with fake_bot_api() as (api, bot):
+            dp = Dispatcher(storage=BoundedMemoryStorage())
+            # Outbox не запущен: обе сводки успевают встать в очередь одного чата.
+            outbox = Outbox(bot, chat_rate=100.0)
+            register_handlers(dp, ColumnarStorage(), outbox)
+            for update_id, user_id in ((1, 7), (2, 8)):
+                payload = message_update(update_id, user_id, "/joke 15 4", chat_id=-100)
+                await dp.feed_update(bot, Update.model_validate(payload, context={"bot": bot}))
+            outbox.start()
+            await asyncio.wait_for(outbox.drain(INTERACTIVE), timeout=5)
+            await outbox.close()
+            return [params["text"] for params in api.sent()]
+
+    texts = asyncio.run(scenario())
+    assert len(texts) == 2
+    assert all(text.startswith("Добавил:") for text in texts)
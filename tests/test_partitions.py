@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+from datetime import date, datetime, timezone
+
+import pytest
+
+from bot.database import Database
+from bot.storage import ImportedEvent
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+# Месяцы далеко от «сейчас»: их партиции не пересекаются с живыми данными.
+OLD_MONTH = date(2001, 1, 1)
+FUTURE_MONTHS = [date(2090, month, 1) for month in range(1, 7)]
+HAPPENED_AT = datetime(OLD_MONTH.year, OLD_MONTH.month, 15, 12, tzinfo=timezone.utc)
+
+
+async def _drop_month(database: Database, month: date) -> None:
+    name = f"events_{month:%Y_%m}"
+    async with database._acquire() as conn:
+        await conn.execute(f"DROP TABLE IF EXISTS archive.{name}")
+        await conn.execute(f"DROP TABLE IF EXISTS {name}")
+        await conn.execute(
+            "DELETE FROM user_type_daily WHERE day >= $1 AND day < $1 + INTERVAL '1 month'", month
+        )
+
+
+def _event(user_id: int) -> ImportedEvent:
+    return ImportedEvent(user_id, None, "old", "joke", 10, 4, HAPPENED_AT)
+
+
+def test_import_into_retired_month_is_refused() -> None:
+    async def scenario() -> tuple[list[str], int]:
+        database = Database(dsn=DATABASE_URL)
+        await database.connect()
+        try:
+            await _drop_month(database, OLD_MONTH)
+            user_id = random.randint(10**12, 2 * 10**12)
+            # Месяц ещё ни разу не архивировали — история заливается.
+            assert await database.bulk_import([_event(user_id)]) == 1
+            today = datetime.now(timezone.utc).date()
+            retain = today.year * 12 + today.month - (OLD_MONTH.year * 12 + OLD_MONTH.month + 1)
+            _, retired = await database.maintain_partitions(months_ahead=1, retain_months=retain)
+            with pytest.raises(ValueError, match=f"{OLD_MONTH:%Y-%m}"):
+                await database.bulk_import([_event(user_id)])
+            async with database._acquire() as conn:
+                events = await conn.fetchval(
+                    "SELECT events FROM user_type_daily WHERE user_id = $1 AND day = $2", user_id, HAPPENED_AT.date()
+                )
+            await _drop_month(database, OLD_MONTH)
+            return retired, events
+        finally:
+            await database.close()
+
+    retired, events = asyncio.run(scenario())
+    assert f"events_{OLD_MONTH:%Y_%m}" in retired
+    assert events == 1
+
+
+def test_concurrent_partition_creation_creates_each_month_once() -> None:
+    async def scenario() -> list[int]:
+        database = Database(dsn=DATABASE_URL, pool_min_size=4, pool_max_size=4)
+        await database.connect()
+        try:
+            for month in FUTURE_MONTHS:
+                await _drop_month(database, month)
+
+            async def ensure() -> int:
+                async with database._acquire() as conn:
+                    return await conn.fetchval(
+                        "SELECT ensure_events_partitions($1, $2)", FUTURE_MONTHS[0], FUTURE_MONTHS[-1]
+                    )
+
+            created = await asyncio.gather(*(ensure() for _ in range(4)))
+            for month in FUTURE_MONTHS:
+                await _drop_month(database, month)
+            return created
+        finally:
+            await database.close()
+
+    created = asyncio.run(scenario())
+    # Под advisory-локом партиции создаёт ровно один вызов, остальные видят их готовыми.
+    assert sorted(created) == [0, 0, 0, len(FUTURE_MONTHS)]
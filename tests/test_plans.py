@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import pytest
+
+from bench.plans import build_parser, run
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+PLANS_SEED_EVENTS = os.environ.get("PLANS_SEED_EVENTS")
+
+# Бюджеты сканов и буферов рассчитаны на засеянный объём: на пустой тестовой
+# базе планировщик честно выбирает Seq Scan, и проверка ничего не значит.
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL or not PLANS_SEED_EVENTS, reason="DATABASE_URL and PLANS_SEED_EVENTS are not set"
+)
+
+
+def test_query_plans_stay_within_budget() -> None:
+    # Таблицы очищаются и засеваются синтетикой заново.
+    args = build_parser().parse_args(["--dsn", DATABASE_URL, "--seed-events", PLANS_SEED_EVENTS])
+    results = asyncio.run(run(args))
+    failed = {result.name: result.problems for result in results if result.problems}
+    assert not failed, failed
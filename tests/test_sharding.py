@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+from typing import Any
+
+from aiogram.methods import DeleteWebhook, GetUpdates, TelegramMethod
+from aiogram.types import Update
+
+from .fakes import message_update
+
+# bot.sharding тянет настройки приложения, а им нужен токен.
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+
+from bot.sharding import _OrderedFeeder, _poll, shard_for  # noqa: E402
+
+
+def test_shard_for_pins_a_user_to_one_shard() -> None:
+    message = message_update(1, 7, "/me")
+    callback = {"update_id": 2, "callback_query": {"id": "1", "from": {"id": 7}, "chat_instance": "7", "data": "x"}}
+    assert shard_for(message, 4) == shard_for(callback, 4) == 7 % 4
+    assert shard_for(message_update(3, 8, "/me"), 4) == 0
+    assert shard_for({"update_id": 4}, 4) == 0
+
+
+class RecordingDispatcher:
+    def __init__(self) -> None:
+        self.handled: list[tuple[int, int]] = []
+
+    async def feed_update(self, bot: Any, update: Update) -> None:
+        await asyncio.sleep(random.random() / 100)
+        assert update.message is not None and update.message.from_user is not None
+        self.handled.append((update.message.from_user.id, update.update_id))
+
+
+def test_ordered_feeder_keeps_per_user_order() -> None:
+    async def scenario() -> list[tuple[int, int]]:
+        dp = RecordingDispatcher()
+        feeder = _OrderedFeeder(dp, None, concurrency=8)  # type: ignore[arg-type]
+        for update_id in range(1, 61):
+            payload = message_update(update_id, update_id % 3, "hi")
+            await feeder.submit(Update.model_validate(payload))
+        await feeder.drain()
+        return dp.handled
+
+    handled = asyncio.run(scenario())
+    assert len(handled) == 60
+    for user_id in range(3):
+        ids = [update_id for owner, update_id in handled if owner == user_id]
+        assert ids == sorted(ids)
+
+
+class PollingBot:
+    # Первый getUpdates отдаёт пачку, второй висит до отмены.
+    def __init__(self, updates: list[Update]) -> None:
+        self.calls: list[TelegramMethod[Any]] = []
+        self._updates = updates
+
+    async def delete_webhook(self) -> bool:
+        self.calls.append(DeleteWebhook())
+        return True
+
+    async def __call__(self, method: TelegramMethod[Any], request_timeout: int | None = None) -> Any:
+        self.calls.append(method)
+        if isinstance(method, GetUpdates) and method.timeout:
+            if method.offset is None:
+                return self._updates
+            await asyncio.Event().wait()
+        return []
+
+
+class CollectingRouter:
+    def __init__(self) -> None:
+        self.submitted: list[dict[str, Any]] = []
+
+    async def submit(self, payload: dict[str, Any]) -> None:
+        self.submitted.append(payload)
+
+
+def test_poll_confirms_the_offset_before_exiting() -> None:
+    async def scenario() -> tuple[PollingBot, CollectingRouter]:
+        bot = PollingBot([Update.model_validate(message_update(update_id, 7, "hi")) for update_id in (10, 11)])
+        router = CollectingRouter()
+        task = asyncio.create_task(_poll(bot, router))  # type: ignore[arg-type]
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return bot, router
+
+    bot, router = asyncio.run(scenario())
+    assert [payload["update_id"] for payload in router.submitted] == [10, 11]
+    confirm = bot.calls[-1]
+    assert isinstance(confirm, GetUpdates)
+    assert confirm.offset == 12 and confirm.timeout == 0